@@ -1,10 +1,10 @@
 import os
 import signal
 import sys
-import time
 
 
 import rocketchat
+import rocketchat.bot
 
 from eliza import eliza, therapist
 
@@ -19,34 +19,36 @@ class Bot(object):
 
     def __init__(self, room):
         self.me = rocketchat.models.User.me
-        self.room = rocketchat.channels()[room]
+        self.room = rocketchat.models.Channel(name=room).get()
+        self.bot = rocketchat.bot.Bot(rocketchat.bot.PollingSource(
+            rooms=[self.room], interval=Bot.SLEEP_TIMEOUT))
+        self.bot.on(room=self.room._id, mention=True)(self.counsel)
         signal.signal(signal.SIGINT, self.quit)
 
-    def run(self):
-        self.room.send('_greetings! I am here to counsel you. '
-                       'No direct messages. Messages must mention @{}_'.format(
-                           self.me.name))
         rules = []
         for pattern, transforms in therapist.rules.items():
             pattern = eliza.remove_punct(str(pattern.upper()))
             transforms = [str(t).upper() for t in transforms]
             rules.append((pattern, transforms))
+        self.rules = eliza.CompiledRules(rules)
+
+    def run(self):
+        self.room.send('_greetings! I am here to counsel you. '
+                       'No direct messages. Messages must mention @{}_'.format(
+                           self.me.name))
+        self.bot.run()
 
-        while True:
-            messages = self.room.messages.unread
-            for message in messages:
-                if self.me != message.user and self.me in message.user_mentions:
-                    print(message)
-                    response = eliza.respond(
-                        rules,
-                        eliza.remove_punct(message.msg).upper(),
-                        list(map(str.upper, therapist.default_responses))
-                    )
-                    self.room.send(response)
-            time.sleep(Bot.SLEEP_TIMEOUT)
+    def counsel(self, message, match):
+        print(message)
+        response = self.rules.respond(
+            eliza.remove_punct(message.msg).upper(),
+            list(map(str.upper, therapist.default_responses))
+        )
+        self.bot.reply(message, response)
 
     def quit(self, signum, frame):
         print('quitting')
+        self.bot.stop()
         sys.exit(0)
 
 
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+"""
+Compares the time `respond` and `CompiledRules` take to find the rules
+matching a sentence, with the therapist rules and with a large generated rule
+set, and checks both find the same rules.
+
+    $ python -m eliza.benchmark
+"""
+
+import random
+import timeit
+
+from eliza import eliza, therapist
+
+
+def therapist_rules():
+    """Rules as the bot prepares them."""
+    return [(eliza.remove_punct(pattern.upper()),
+             [transform.upper() for transform in transforms])
+            for pattern, transforms in therapist.rules.items()]
+
+
+def generated_rules(count, vocabulary):
+    """Rules of one to three words, between and around segment variables."""
+    rng = random.Random(count)
+    rules = []
+    for number in range(count):
+        words = rng.sample(vocabulary, rng.randint(1, 3))
+        pattern = '?*X {} ?*Y'.format(' '.join(words))
+        if number % 4 == 0:
+            pattern = '?*X {} ?Z ?*Y'.format(words[0])
+        rules.append((pattern, ['RULE {} ?Y'.format(number)]))
+    return rules
+
+
+def sentences(count, vocabulary, length=12):
+    rng = random.Random(length)
+    return [' '.join(rng.choice(vocabulary) for _ in range(length))
+            for _ in range(count)]
+
+
+def matching_rules(rules, sentence):
+    """Rules matched by `match_pattern`, as `respond` finds them."""
+    input = sentence.split()
+    matches = []
+    for pattern, transforms in rules:
+        replacements = eliza.match_pattern(pattern.split(), input)
+        if replacements:
+            matches.append((transforms, replacements))
+    return matches
+
+
+def benchmark(name, rules, inputs, number=3):
+    compiled = eliza.CompiledRules(rules)
+    for sentence in inputs:
+        assert matching_rules(rules, sentence) == \
+            compiled.matching_rules(sentence), sentence
+
+    def run(match):
+        return min(timeit.repeat(
+            lambda: [match(sentence) for sentence in inputs],
+            number=1, repeat=number)) / len(inputs)
+
+    current = run(lambda sentence: matching_rules(rules, sentence))
+    indexed = run(compiled.matching_rules)
+    print('{}: {} rules, {:.1f}us per message with match_pattern, '
+          '{:.1f}us compiled ({:.0f}x)'.format(
+              name, len(rules), current * 1e6, indexed * 1e6, current / indexed))
+
+
+if __name__ == '__main__':
+    words = sorted(set(' '.join(pattern for pattern, _ in therapist_rules())
+                       .replace('?*X', '').replace('?*Y', '').split()))
+    vocabulary = ['WORD{}'.format(number) for number in range(2000)]
+    benchmark('therapist', therapist_rules(),
+              sentences(200, words + ['HELLO', 'THERE', 'MY', 'DOG']))
+    benchmark('generated', generated_rules(5000, vocabulary),
+              sentences(100, vocabulary[:300] + words))
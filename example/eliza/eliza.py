@@ -63,6 +63,12 @@ def respond(rules, input, default_responses):
         if replacements:
             matching_rules.append((transforms, replacements))
 
+    return choose_response(matching_rules, default_responses)
+
+
+def choose_response(matching_rules, default_responses):
+    """Pick a response of a matching rule and fill in its variables."""
+
     # When rules are found, choose one and one of its responses at random.
     # If no rule applies, we use the default rule.
     if matching_rules:
@@ -179,6 +185,152 @@ def match_variable(var, replacement, bindings):
     return False
 
 
+## Compiled rules
+
+LITERAL, VARIABLE, SEGMENT = range(3)
+
+
+class CompiledRules(object):
+    """
+    Rules preprocessed once for fast matching.
+
+    Each input pattern is split into typed tokens, and rules are indexed by
+    one of their literal words, the one fewest rules share. A sentence is
+    only matched against rules whose anchor word it contains, and whose other
+    literal words it contains as well. Rules without literal words are always
+    tried. Matching gives the same results as `match_pattern`, but without
+    recursion or copies of the bindings.
+    """
+
+    def __init__(self, rules):
+        self.rules = []
+        self.index = {}
+        self.unanchored = []
+        counts = {}
+        for pattern, transforms in rules:
+            tokens = [compile_token(token) for token in pattern.split()]
+            literals = frozenset(value for kind, value, _ in tokens
+                                 if kind == LITERAL)
+            self.rules.append((tokens, literals, transforms))
+            for word in literals:
+                counts[word] = counts.get(word, 0) + 1
+        for number, (tokens, literals, transforms) in enumerate(self.rules):
+            if literals:
+                anchor = min(literals, key=lambda word: (counts[word], word))
+                self.index.setdefault(anchor, []).append(number)
+            else:
+                self.unanchored.append(number)
+
+    def candidates(self, words):
+        """Numbers of the rules that may match the words, in rule order."""
+        numbers = list(self.unanchored)
+        for word in words:
+            numbers.extend(self.index.get(word, ()))
+        return sorted(numbers)
+
+    def matching_rules(self, input):
+        """List of (transforms, bindings) of the rules matching the input."""
+        input = input.split()
+        words = frozenset(input)
+        matching_rules = []
+        for number in self.candidates(words):
+            tokens, literals, transforms = self.rules[number]
+            if not literals <= words:
+                continue
+            replacements = match_tokens(tokens, input)
+            if replacements:
+                matching_rules.append((transforms, replacements))
+        return matching_rules
+
+    def respond(self, input, default_responses):
+        """Respond to an input sentence, like `respond`."""
+        return choose_response(self.matching_rules(input), default_responses)
+
+
+def compile_token(token):
+    """Return (kind, value, token) for a token of an input pattern."""
+    if is_segment([token]):
+        return SEGMENT, token[2:], token
+    if is_variable(token):
+        return VARIABLE, token[1:], token
+    return LITERAL, token, token
+
+
+def match_tokens(tokens, input):
+    """
+    Match compiled pattern tokens against a list of input words.
+
+    Returns the bindings, or None when the input doesn't match. Segment
+    variables first take the fewest words, and backtracking tries the next
+    occurrence of the word that follows them.
+    """
+    bindings = {}
+    trail = []     # (variable, previous binding) to undo when backtracking
+    choices = []   # (token index, segment start, next position, trail size)
+    t = i = 0
+    while True:
+        matched = False
+        if t == len(tokens):
+            matched = i == len(input)
+            if matched:
+                # Like match_pattern, a match must bind some variable
+                return bindings or None
+        else:
+            kind, value, token = tokens[t]
+            if kind == LITERAL:
+                matched = i < len(input) and input[i] == value
+                if matched:
+                    t, i = t + 1, i + 1
+            elif kind == VARIABLE:
+                matched = i < len(input) and bind(
+                    bindings, trail, value, [input[i]])
+                if matched:
+                    t, i = t + 1, i + 1
+            elif t + 1 == len(tokens):
+                matched = bind(bindings, trail, value, input[i:])
+                if matched:
+                    t, i = t + 1, len(input)
+            else:
+                choices.append((t, i, i, len(trail)))
+        if matched:
+            continue
+        # Backtrack to the last segment with another place to end
+        while choices:
+            t, start, pos, size = choices.pop()
+            undo(bindings, trail, size)
+            boundary = tokens[t + 1][2]
+            try:
+                pos = input.index(boundary, pos)
+            except ValueError:
+                continue
+            choices.append((t, start, pos + 1, size))
+            if bind(bindings, trail, tokens[t][1], input[start:pos]):
+                t, i = t + 1, pos
+                break
+        else:
+            return None
+
+
+def bind(bindings, trail, var, replacement):
+    """Bind the variable, or check it is bound to the replacement."""
+    binding = bindings.get(var)
+    if binding:
+        return binding == replacement
+    trail.append((var, binding))
+    bindings[var] = replacement
+    return True
+
+
+def undo(bindings, trail, size):
+    """Restore the bindings made before the trail had the given size."""
+    while len(trail) > size:
+        var, binding = trail.pop()
+        if binding is None:
+            del bindings[var]
+        else:
+            bindings[var] = binding
+
+
 ## Pattern matching utilities
 
 def contains_tokens(pattern):
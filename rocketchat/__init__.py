@@ -18,6 +18,7 @@ def configure(monkey_patch=False, config=None, **kwargs):
         config = {}
     config['monkey_patch'] = monkey_patch
     v1.api.configure(config=config, **kwargs)
+    v1.api.session.configure()
 
 
 def create_creds_file(username, password):
@@ -38,6 +39,7 @@ def set_creds_env(username, password):
 
 def load_config():
     v1.api.load_configurations()
+    v1.api.session.configure()
     if v1.api.get_config('monkey_patch'):
         monkey_patch_ssl()
 
@@ -0,0 +1,662 @@
+'''
+Asyncio flavour of :mod:`rocketchat.v1` and :mod:`rocketchat.models`.
+
+Every route defined in :mod:`rocketchat.v1` is available here under the same
+name, but its request methods (``get``, ``post``, ...) are coroutines. Responses
+go through the same handlers, so :func:`rocketchat.v1.validate_response`
+and :class:`rocketchat.v1.Token` behave the same as in the synchronous client.
+The models have the same methods as in :mod:`rocketchat.models`, as
+coroutines, and ``iter_all`` and ``Messages.walk`` are async generators.
+Objects listed with a ``fields`` projection are partial, as in the
+synchronous client, but reading a field they left out raises
+:class:`AttributeError` instead of fetching it: ``await obj.load()`` first.
+
+Requires ``aiohttp``.
+
+Usage::
+
+    >>> from rocketchat import aio
+    >>> async def main():
+    ...     room = await aio.Channel(name='general').get()
+    ...     await room.send('hello')
+    ...     messages = await room.messages.count(10).get()
+    ...     foo = await aio.User(username='foo').get()
+    ...     await foo.send('hello foo')
+    ...     await aio.close()
+'''
+import asyncio
+import datetime
+import json
+
+import cosmicray
+import requests
+
+from six.moves.urllib.parse import urlparse
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from . import v1, models
+
+
+class Response(object):
+    '''
+    Exposes the parts of :class:`requests.Response` used by the response
+    handlers in :mod:`rocketchat.v1`
+    '''
+    def __init__(self, response, content):
+        self.status_code = response.status
+        self.reason = response.reason
+        self.headers = response.headers
+        self.url = str(response.url)
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', 'replace')
+
+    def json(self):
+        return json.loads(self.text)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError('{} Error: {} for url: {}'.format(
+                self.status_code, self.reason, self.url), response=self)
+
+
+class Session(object):
+    '''
+    Lazily creates :class:`aiohttp.ClientSession` for the running event loop.
+    Changes to the ``HTTP_*`` settings apply to sessions created after them,
+    see :func:`close`.
+    '''
+
+    def __init__(self):
+        self.session = None
+        self.loop = None
+
+    def get_session(self):
+        if aiohttp is None:
+            raise ImportError('rocketchat.aio requires aiohttp')
+        loop = asyncio.get_event_loop()
+        if self.session is None or self.session.closed or self.loop is not loop:
+            self.session = aiohttp.ClientSession(
+                connector=self.get_connector(),
+                timeout=aiohttp.ClientTimeout(
+                    total=v1.api.get_config('HTTP_TIMEOUT')))
+            self.loop = loop
+        return self.session
+
+    def get_connector(self):
+        '''Connection pool sized by the same settings as :class:`rocketchat.v1.Session`'''
+        keep_alive = v1.api.get_config('HTTP_KEEP_ALIVE')
+        kwargs = {'keepalive_timeout': keep_alive} if keep_alive else {'force_close': True}
+        return aiohttp.TCPConnector(
+            limit=(v1.api.get_config('HTTP_POOL_CONNECTIONS') *
+                   v1.api.get_config('HTTP_POOL_MAXSIZE')),
+            limit_per_host=v1.api.get_config('HTTP_POOL_MAXSIZE'),
+            **kwargs)
+
+    async def request(self, request):
+        kwargs = {}
+        if request.extra.get('verify') is False:
+            kwargs['ssl'] = False
+        if request.extra.get('timeout'):
+            kwargs['timeout'] = aiohttp.ClientTimeout(total=request.extra['timeout'])
+        params = dict((k, str(v) if isinstance(v, bool) else v)
+                      for k, v in request.params.items())
+        async with self.get_session().request(
+                request.method, request.url, headers=request.headers,
+                params=params, data=request.data, json=request.json,
+                **kwargs) as response:
+            return Response(response, await response.read())
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+
+session = Session()
+
+
+async def close():
+    '''Closes the underlying HTTP session'''
+    await session.close()
+
+
+async def authenticate(request):
+    '''Authenticates the request, logging in on a worker thread if needed'''
+    if v1.Token.token:
+        return request.authenticate()
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, request.authenticate)
+
+
+class Request(object):
+    '''Awaitable counterpart of :class:`cosmicray.routes.Request`'''
+
+    def __init__(self, request):
+        self.request = request
+
+    def __getattr__(self, attr):
+        return getattr(self.request, attr)
+
+    async def send(self, method):
+        request = self.request.set_method(method).validate()
+        request = await authenticate(request)
+        response = await self.send_retried(request)
+        if response.status_code == 401 and 'X-Auth-Token' in request.headers:
+            loop = asyncio.get_event_loop()
+            token = await loop.run_in_executor(
+                None, v1.Token.reauthenticate, request.headers['X-Auth-Token'])
+            request.set_headers(**{
+                'X-Auth-Token': token.authToken,
+                'X-User-Id': token.userId})
+            response = await self.send_retried(request)
+        if request.route.get_config('raise_for_status'):
+            response.raise_for_status()
+        return request.handle_response(response)
+
+    async def send_retried(self, request):
+        '''Retries the request as :class:`rocketchat.v1.Session` does'''
+        retry_policy = v1.Session.retry_policy
+        endpoint = urlparse(request.url).path
+        attempt = 0
+        while True:
+            failure = None
+            try:
+                response = await self.send_paced(request)
+                delay = retry_policy.delay(
+                    request.method, endpoint, attempt,
+                    status_code=response.status_code)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+                failure = error
+                delay = retry_policy.delay(
+                    request.method, endpoint, attempt, error=error,
+                    sent=not isinstance(error, aiohttp.ClientConnectorError))
+            if delay is None:
+                if failure is not None:
+                    raise failure
+                return response
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def send_paced(self, request):
+        '''Sends the request within the limits of :class:`rocketchat.v1.Session`'''
+        rate_limiter = v1.Session.rate_limiter
+        endpoint = urlparse(request.url).path
+        retries = v1.api.get_config('RATE_LIMIT_RETRIES') or 0
+        for _ in range(retries + 1):
+            while True:
+                delay = rate_limiter.reserve(
+                    endpoint, v1.api.get_config('RATE_LIMIT_PER_SECOND'))
+                if delay <= 0:
+                    break
+                await asyncio.sleep(delay)
+            response = await session.request(request)
+            rate_limiter.update(endpoint, response.headers, response.status_code)
+            if response.status_code != 429:
+                break
+        return response
+
+    async def get(self):
+        return await self.send('GET')
+
+    async def post(self):
+        return await self.send('POST')
+
+    async def put(self):
+        return await self.send('PUT')
+
+    async def delete(self):
+        return await self.send('DELETE')
+
+    def __repr__(self):
+        return '<Async {!r}>'.format(self.request)
+
+
+class Route(object):
+    '''Wraps :class:`cosmicray.Route` so that its requests are awaitable'''
+
+    def __init__(self, route):
+        self.route = route
+
+    def __call__(self, model_cls=None, **kwargs):
+        return Request(self.route(model_cls, **kwargs))
+
+    def __repr__(self):
+        return '<Async {!r}>'.format(self.route)
+
+
+for name, route in list(vars(v1).items()):
+    if isinstance(route, cosmicray.Route):
+        globals()[name] = Route(route)
+
+
+async def paginate(request, count=None, prefetch=False):
+    '''
+    Async generator counterpart of :func:`rocketchat.v1.paginate`. If
+    ``prefetch`` is True, the next page is requested while the current one
+    is consumed.
+    '''
+    count = count or v1.api.get_config('PAGE_SIZE')
+
+    async def fetch(offset):
+        page = Request(request.route(
+            request.model_cls, urlargs=request.urlargs, headers=request.headers,
+            params=dict(request.params, offset=offset, count=count)))
+        v1.listing.total = None
+        # Read before the next await, when no other page can replace it
+        return list(await page.get() or []), v1.listing.total
+
+    following = None
+    try:
+        offset, (page, total) = 0, await fetch(0)
+        while page:
+            offset += len(page)
+            last = total is not None and offset >= total
+            if prefetch and not last:
+                following = asyncio.ensure_future(fetch(offset))
+            for item in page:
+                yield item
+            if last:
+                return
+            page, total = await (following or fetch(offset))
+            following = None
+    finally:
+        if following is not None:
+            following.cancel()
+
+
+def partial_getattr(self, name):
+    # Only called for fields left unset by a projection, which are not
+    # fetched when read as that would block
+    if name in self.__slots__ and self.__dict__.get('_partial'):
+        raise AttributeError('{} of a partial {} is not loaded, see load()'.format(
+            name, self.__class__.__name__))
+    raise AttributeError(name)
+
+
+class User(models.User):
+    __getattr__ = partial_getattr
+
+    @classmethod
+    def iter_all(cls, prefetch=False, fields=None, query=None):
+        return paginate(v1.users_list(
+            models.Projection(cls, fields) if fields else cls,
+            params={'fields': fields, 'query': query}), prefetch=prefetch)
+
+    @classmethod
+    def from_cache(cls, user):
+        '''Async user with the fields of a user of :data:`rocketchat.models.user_cache`'''
+        fields = user.fields()
+        fields.pop('_direct', None)
+        return cls(**fields)
+
+    async def get(self, refresh=False):
+        user = None if refresh else models.user_cache.get(self._id, self.username)
+        if user is None:
+            user = await self.fetch(self._id, self.username)
+        self.dict = user.fields()
+        return self
+
+    async def load(self):
+        # Only the id is read, other fields of a partial user may be unset
+        self.dict = (await self.fetch(self._id)).fields()
+        self._partial = False
+        return self
+
+    @classmethod
+    async def lookup(cls, _id=None, username=None):
+        user = models.user_cache.get(_id, username)
+        if user is None:
+            return await cls.fetch(_id, username)
+        return cls.from_cache(user)
+
+    @classmethod
+    async def fetch(cls, _id=None, username=None):
+        params = {'userId': _id} if _id else {'username': username}
+        return cls.from_cache(models.user_cache.add(
+            await users_info(models.User, params=params).get()))
+
+    @classmethod
+    async def resolve(cls, usernames=(), ids=(), max_workers=8):
+        '''Resolves the users with :func:`rocketchat.models.User.resolve` on a worker thread'''
+        loop = asyncio.get_event_loop()
+        resolved = await loop.run_in_executor(
+            None, models.User.resolve, usernames, ids, max_workers)
+        return dict((key, cls.from_cache(user)) for key, user in resolved.items())
+
+    async def send(self, text, alias=None, emoji=None, avatar=None, attachments=None):
+        direct = await self.get_direct()
+        return await direct.send(
+            text, alias=alias, emoji=emoji, avatar=avatar, attachments=attachments)
+
+    async def send_later(self, text, **kwargs):
+        direct = await self.get_direct()
+        return direct.send_later(text, **kwargs)
+
+    @property
+    async def direct(self):
+        return await self.get_direct()
+
+    async def get_direct(self):
+        '''Returns direct message room with the user, opening it if needed'''
+        if self.username is None:
+            await self.get()
+        loop = asyncio.get_event_loop()
+        room = await loop.run_in_executor(
+            None, models.direct_rooms.get, self.username)
+        if room is None:
+            room = await Direct(username=self.username).create()
+        return Direct(**room.dict)
+
+
+class Channel(models.Channel):
+    __getattr__ = partial_getattr
+
+    @classmethod
+    def iter_all(cls, prefetch=False, fields=None, query=None):
+        return paginate(v1.channels_list(
+            models.Projection(cls, fields) if fields else cls,
+            urlargs={'channel_type': cls.CHANNEL_TYPE},
+            params={'fields': fields, 'query': query}), prefetch=prefetch)
+
+    @property
+    def messages(self):
+        return Messages(channel=self)
+
+    @property
+    async def users(self):
+        usernames = self.usernames or []
+        users = await User.resolve(usernames=usernames)
+        return [users[username] for username in usernames if username in users]
+
+    async def get(self):
+        self.channel_type = self.CHANNEL_TYPE
+        self.dict = (await Request(self(**self.get_params())).get()).dict
+        return self
+
+    async def add_all(self, active_users_only=False):
+        return await channels_add_all(**self.get_payload(
+            {'activeUsersOnly': active_users_only}),
+            urlargs={'channel_type': self.CHANNEL_TYPE}).post()
+
+    async def send(self, text, alias=None, emoji=None, avatar=None, attachments=None):
+        return await Message(msg=text, rid=self._id,
+                             alias=alias, emoji=emoji, avatar=avatar,
+                             attachments=attachments).create()
+
+    async def invite(self, user=None, userid=None, username=None):
+        userid = (user and user._id or userid or
+                  (await User.lookup(username=username))._id)
+        return await channels_invite(
+            self.__class__, **self.get_payload({'userId': userid}),
+            urlargs={'channel_type': self.CHANNEL_TYPE}).post()
+
+    async def kick(self, user=None, userid=None, username=None):
+        userid = (user and user._id or userid or
+                  (await User.lookup(username=username))._id)
+        return await channels_kick(
+            self.__class__, **self.get_payload({'userId': userid}),
+            urlargs={'channel_type': self.CHANNEL_TYPE}).post()
+
+    async def open(self):
+        return await channels_open(
+            **self.get_payload(),
+            urlargs={'channel_type': self.CHANNEL_TYPE}).post()
+
+    async def close(self):
+        return await channels_close(
+            **self.get_payload(),
+            urlargs={'channel_type': self.CHANNEL_TYPE}).post()
+
+    async def leave(self):
+        return await channels_leave(
+            self.__class__, **self.get_payload(),
+            urlargs={'channel_type': self.CHANNEL_TYPE}).post()
+
+    async def create(self):
+        return await channels_create(Channel, json={
+            'name': self.name,
+            'members': self.usernames,
+            'readOnly': True if self.ro else False
+        }, urlargs={'channel_type': self.CHANNEL_TYPE}).post()
+
+    async def update(self):
+        pass
+
+    async def delete(self):
+        return await channels_archive(
+            **self.get_payload(),
+            urlargs={'channel_type': self.CHANNEL_TYPE}).post()
+
+    async def sync_members(self, desired, dry_run=False, max_workers=8):
+        '''
+        Coroutine counterpart of :func:`rocketchat.models.Channel.sync_members`,
+        with at most ``max_workers`` invites and kicks at the same time
+        '''
+        desired = set(getattr(user, 'username', user) for user in desired)
+        current = set((await self.get()).usernames or [])
+        own = (await me(User).get()).username
+        actions = dict((username, 'invite') for username in desired - current)
+        actions.update((username, 'kick') for username in
+                       current - desired - set([own]))
+        if dry_run or not actions:
+            return actions
+
+        users = await User.resolve(usernames=list(actions))
+        slots = asyncio.Semaphore(max_workers)
+
+        async def apply(username):
+            try:
+                if username not in users:
+                    raise v1.RocketChatError(
+                        'User not found: {}'.format(username),
+                        'error-invalid-user', None)
+                async with slots:
+                    if actions[username] == 'invite':
+                        await self.invite(users[username])
+                        return 'invited'
+                    await self.kick(users[username])
+                    return 'kicked'
+            except Exception as error:
+                return error
+
+        return dict(zip(actions, await asyncio.gather(
+            *[apply(username) for username in actions])))
+
+
+class Direct(Channel):
+    CHANNEL_TYPE = 'im'
+
+    async def create(self):
+        '''Opens direct message room with ``self.username`` and indexes it'''
+        room = await im_create(Direct, json={'username': self.username}).post()
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            None, models.direct_rooms.add, room, self.username)
+
+
+class Group(Channel):
+    CHANNEL_TYPE = 'groups'
+
+
+class Message(models.Message):
+
+    @property
+    async def user(self):
+        return await User.lookup(_id=self.u['_id'])
+
+    @property
+    async def channel(self):
+        if self.channel_type == 'channels':
+            return await Channel(_id=self.rid, channel_type=self.channel_type).get()
+        elif self.channel_type == 'groups':
+            return await Group(_id=self.rid, channel_type=self.channel_type).get()
+        else:
+            return Direct(_id=self.rid, channel_type=self.channel_type)
+
+    async def get(self):
+        self.dict = (await message_get(Message, **self.get_payload()).post()).dict
+        return self
+
+    async def update(self):
+        return await message_update(
+            Message, **self.get_payload({
+                'roomId': self.rid,
+                'text': self.msg
+            })).post()
+
+    async def create(self):
+        return await message_post(
+            Message, **self.get_payload({
+                'roomId': self.rid,
+                'text': self.msg,
+                'alias': self.alias,
+                'emoji': self.emoji,
+                'avatar': self.avatar,
+                'attachments': self.attachments
+            })).post()
+
+    async def delete(self, as_user=True):
+        return await message_delete(**self.get_payload({
+            'roomId': self.rid,
+            'text': self.msg,
+            'asUser': as_user
+        })).post()
+
+    async def pin(self):
+        return await message_pin(Message, **self.get_payload()).post()
+
+    async def unpin(self):
+        return await message_unpin(**self.get_payload()).post()
+
+    async def react(self):
+        return await message_react(**self.get_payload({
+            'emoji': self.emoji
+        })).post()
+
+    async def unreact(self):
+        return await message_react(**self.get_payload({
+            'emoji': self.emoji,
+            'shouldReact': False
+        })).post()
+
+
+class Messages(models.Messages):
+
+    @property
+    async def recent(self):
+        return self._sort(await self.get())
+
+    @property
+    async def last(self):
+        return await self.count(1).get()
+
+    @property
+    async def unread(self):
+        last_message_dt = self.channel.cache.get(
+            'last_message_dt', datetime.date.today().isoformat())
+
+        messages = await self.include_unread_count\
+                             .count(1)\
+                             .by_daterange(last_message_dt, None)\
+                             .get()
+        if messages:
+            recent_message_dt = messages[0].ts
+            unread = messages[0].unreadNotLoaded
+            if unread:
+                messages.extend(await self.count(unread)\
+                                          .by_daterange(last_message_dt, recent_message_dt)\
+                                          .get())
+            self.channel.lm = messages[0]._updatedAt
+            self.channel.cache['last_message_dt'] = messages[0]._updatedAt
+        return self._sort(messages)
+
+    async def get(self):
+        request = self.channel._messages(params=self.params)
+        request.model_cls = Message
+        return list(await Request(request).get())
+
+    async def delete(self):
+        if not self.params.get('oldest') or not self.params.get('latest'):
+            raise TypeError('Missing required parameters: oldest/latest')
+        if self.channel.CHANNEL_TYPE == Channel.CHANNEL_TYPE:
+            clean_history = channels_remove_messages
+        else:
+            clean_history = rooms_clean_history
+        return await clean_history(json={
+            'roomId': self.channel._id,
+            'oldest': self.params['oldest'],
+            'latest': self.params['latest'],
+            'inclusive': self.params.get('inclusive', False)
+        }).post()
+
+    async def walk(self, direction='backward', count=100):
+        '''Async generator counterpart of :func:`rocketchat.models.Messages.walk`'''
+        forward = direction == 'forward'
+        oldest, latest = self.params.get('oldest'), self.params.get('latest')
+        inclusive = self.params.get('inclusive', False)
+
+        def in_range(ts):
+            return ((not oldest or ts > oldest or inclusive and ts == oldest) and
+                    (not latest or ts < latest or inclusive and ts == latest))
+
+        cursor, seen = oldest if forward else latest, set()
+        while True:
+            if forward:
+                page = await self._page_forward(cursor, latest, count)
+            else:
+                request = self.channel._messages(params=dict(
+                    self.params, oldest=oldest, latest=cursor, inclusive=True,
+                    count=count))
+                request.model_cls = Message
+                page = list(await Request(request).get())
+            # Pages overlap on the date they start from
+            fresh = [m for m in page if m._id not in seen]
+            for message in fresh:
+                if in_range(message.ts):
+                    yield message
+            if len(page) < count:
+                return
+            if not fresh:
+                # More messages share one date than fit a page
+                count *= 2
+                continue
+            if fresh[-1].ts != cursor:
+                cursor, seen = fresh[-1].ts, set()
+            seen.update(m._id for m in fresh if m.ts == cursor)
+
+    async def _page_forward(self, oldest, latest, count):
+        ts = {}
+        if oldest:
+            ts['$gte'] = models.to_ejson_date(oldest)
+        if latest:
+            ts['$lte'] = models.to_ejson_date(latest)
+        params = {'roomId': self.channel._id, 'sort': json.dumps({'ts': 1}),
+                  'count': count}
+        if ts:
+            params['query'] = json.dumps({'ts': ts})
+        return list(await channels_list_messages(
+            Message, urlargs={'channel_type': self.channel.CHANNEL_TYPE},
+            params=params).get())
+
+    async def sync(self, store=None):
+        '''
+        Stores new messages of the channel in a local
+        :class:`rocketchat.store.MessageStore` on a worker thread, and
+        returns how many
+        '''
+        channel = SYNC_MODELS[self.channel.CHANNEL_TYPE](**self.channel.dict)
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            None, models.Messages(channel, self.params).sync, store)
+
+
+# Synchronous models of the rooms synced to a MessageStore, by room type
+SYNC_MODELS = dict((cls.CHANNEL_TYPE, cls) for cls in (
+    models.Channel, models.Direct, models.Group))
@@ -0,0 +1,258 @@
+'''
+Runtime for bots: messages are read from a source, routed to the handlers
+registered for them, and handled on a pool of worker threads.
+
+Messages of one room are handled one at a time, in the order they were
+posted, while rooms are handled in parallel. When ``max_pending`` messages are
+waiting for a worker, reading from the source blocks until some are handled.
+
+Usage::
+
+    >>> from rocketchat.bot import Bot, PollingSource
+    >>> bot = Bot(PollingSource(interval=1), workers=8)
+    >>> @bot.on(mention=True)
+    ... def hello(message, match):
+    ...     bot.reply(message, 'hello @{}'.format(message.u['username']))
+    >>> @bot.on(room='GENERAL', pattern=r'^!deploy (\\w+)')
+    ... def deploy(message, match):
+    ...     bot.reply(message, 'deploying {}'.format(match.group(1)))
+    >>> bot.run()
+'''
+import asyncio
+import collections
+import logging
+import threading
+import time
+
+from six.moves import queue
+
+from . import models
+from .routing import Handler, Router
+
+
+log = logging.getLogger(__name__)
+
+
+class PollingSource(object):
+    '''
+    Messages polled with :class:`rocketchat.models.RoomWatcher`
+
+    :param rooms: rooms to read. Default: all rooms of the user
+    :param interval: seconds between polls
+    '''
+    def __init__(self, rooms=None, interval=3):
+        self.watcher = models.RoomWatcher(rooms=rooms)
+        self.interval = interval
+        self.closed = False
+
+    def messages(self):
+        while not self.closed:
+            for message in self.watcher.poll():
+                yield message
+            time.sleep(self.interval)
+
+    def close(self):
+        self.closed = True
+
+
+class RealtimeSource(object):
+    '''
+    Messages pushed by the realtime api, see :mod:`rocketchat.realtime`.
+    The client runs its own event loop on a background thread.
+
+    :param rooms: rooms to read. Default: all rooms of the user
+    :param max_pending: messages received but not yet read from the source
+    '''
+    def __init__(self, rooms=None, max_pending=1000):
+        self.rooms = rooms
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.loop = None
+        self.client = None
+
+    def messages(self):
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+        while True:
+            message = self.queue.get()
+            if message is None:
+                return
+            yield message
+
+    def run(self):
+        self.loop = asyncio.new_event_loop()
+        try:
+            self.loop.run_until_complete(self.receive())
+        finally:
+            self.queue.put(None)
+
+    async def receive(self):
+        from . import realtime
+
+        self.client = realtime.Realtime()
+        for room in self.rooms or [None]:
+            await self.client.subscribe_room(room)
+        async for message in self.client.messages():
+            # Blocks the client while the queue is full
+            await self.loop.run_in_executor(None, self.queue.put, message)
+
+    def close(self):
+        if self.loop is not None and self.client is not None:
+            asyncio.run_coroutine_threadsafe(self.client.close(), self.loop)
+
+
+class WorkerPool(object):
+    '''
+    Runs tasks on ``workers`` threads. Tasks with the same key run one at a
+    time in the order they were submitted. At most ``max_pending`` tasks wait
+    to run: submitting more blocks until some are done.
+    '''
+    def __init__(self, workers=8, max_pending=1000):
+        self.workers = workers
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.pending = {}
+        self.ready = queue.Queue()
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.threads = []
+        self.busy = 0
+        self.done = 0
+        self.failed = 0
+
+    def start(self):
+        for _ in range(self.workers - len(self.threads)):
+            thread = threading.Thread(target=self.work)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, key, func, *args):
+        self.slots.acquire()
+        with self.lock:
+            tasks = self.pending.get(key)
+            if tasks is None:
+                # No task of this key is waiting or running
+                tasks = self.pending[key] = collections.deque()
+                self.ready.put(key)
+            tasks.append((func, args))
+
+    def work(self):
+        while True:
+            key = self.ready.get()
+            if key is None:
+                return
+            with self.lock:
+                func, args = self.pending[key][0]
+                self.busy += 1
+            failed = False
+            try:
+                func(*args)
+            except Exception:
+                log.exception('Handler %r failed', func)
+                failed = True
+            with self.lock:
+                self.busy -= 1
+                self.done += 1
+                self.failed += failed
+                tasks = self.pending[key]
+                tasks.popleft()
+                if tasks:
+                    self.ready.put(key)
+                else:
+                    del self.pending[key]
+                    if not self.pending:
+                        self.idle.notify_all()
+            self.slots.release()
+
+    @property
+    def depth(self):
+        '''Number of tasks waiting or running'''
+        with self.lock:
+            return sum(len(tasks) for tasks in self.pending.values())
+
+    @property
+    def depths(self):
+        '''Number of tasks waiting or running per key'''
+        with self.lock:
+            return dict((key, len(tasks)) for key, tasks in self.pending.items())
+
+    def join(self):
+        '''Waits until all submitted tasks are done'''
+        with self.idle:
+            while self.pending:
+                self.idle.wait()
+
+    def stop(self):
+        '''Waits for submitted tasks, then stops the threads'''
+        self.join()
+        for _ in self.threads:
+            self.ready.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+
+class Bot(object):
+    '''
+    :param source: where messages come from. Default: :class:`PollingSource`
+    :param workers: number of threads handling messages
+    :param max_pending: messages waiting to be handled before reading blocks
+    '''
+    def __init__(self, source=None, workers=8, max_pending=1000):
+        self.source = source or PollingSource()
+        self.pool = WorkerPool(workers=workers, max_pending=max_pending)
+        self.router = Router()
+        self.received = 0
+        self.user_id = None
+        self.running = False
+
+    def on(self, room=None, mention=False, keywords=None, pattern=None):
+        '''
+        Decorator registering a handler, see
+        :class:`rocketchat.routing.Handler`
+        '''
+        def register(func):
+            self.router.add(Handler(func, room, mention, keywords, pattern))
+            return func
+        return register
+
+    def dispatch(self, message):
+        '''Queues the message for each handler it triggers'''
+        self.received += 1
+        if (message.u or {}).get('_id') == self.user_id:
+            return
+        for handler, match in self.router.route(message, self.user_id):
+            self.pool.submit(message.rid, handler.func, message, match)
+
+    def reply(self, message, text, **kwargs):
+        '''Sends a message to the room of the given message'''
+        return models.Channel(_id=message.rid).send(text, **kwargs)
+
+    def run(self):
+        '''Handles messages from the source until :func:`stop` is called'''
+        self.user_id = self.user_id or models.User.me._id
+        self.running = True
+        self.pool.start()
+        try:
+            for message in self.source.messages():
+                self.dispatch(message)
+                if not self.running:
+                    break
+        finally:
+            self.pool.stop()
+
+    def stop(self):
+        self.running = False
+        self.source.close()
+
+    @property
+    def metrics(self):
+        '''Messages received and handled, and the depth of the queues'''
+        return {
+            'received': self.received,
+            'handled': self.pool.done,
+            'failed': self.pool.failed,
+            'busy': self.pool.busy,
+            'queue_depth': self.pool.depth,
+            'room_depths': self.pool.depths,
+        }
@@ -0,0 +1,122 @@
+'''
+Direct messages to many users at once.
+
+The direct rooms of all recipients are looked up, and the missing ones
+opened, before anything is sent. Messages are then sent from a pool of
+threads, paced by the session's rate limiter. With a journal, recipients that
+were sent the message are recorded as it goes, and running the broadcast
+again only sends to the others.
+
+Usage::
+
+    >>> from rocketchat.broadcast import Broadcast
+    >>> broadcast = Broadcast('Maintenance tonight at 22:00',
+    ...                       journal='maintenance.jsonl', max_workers=16)
+    >>> report = broadcast.send(user.username for user in models.User.iter_all())
+    >>> print(report)
+    9874 sent, 3 failed, 0 skipped in 212.4s
+    >>> report.failed
+    {'jdoe': RocketChatError(...)}
+'''
+import json
+import threading
+import time
+
+from concurrent import futures
+
+from . import models
+
+
+class Report(object):
+    '''Recipients sent the message, skipped as already sent, and failed'''
+
+    def __init__(self):
+        self.sent = {}
+        self.skipped = set()
+        self.failed = {}
+        self.started = time.time()
+        self.finished = None
+
+    @property
+    def seconds(self):
+        return (self.finished or time.time()) - self.started
+
+    def __str__(self):
+        return '{} sent, {} failed, {} skipped in {:.1f}s'.format(
+            len(self.sent), len(self.failed), len(self.skipped), self.seconds)
+
+
+class Broadcast(object):
+    '''
+    :param text: message sent to every recipient
+    :param journal: file recording who was sent the message, to resume from
+    :param max_workers: number of rooms opened and messages sent at a time
+    :param kwargs: ``alias``, ``emoji``, ``avatar`` or ``attachments`` of the message
+    '''
+    def __init__(self, text, journal=None, max_workers=8, **kwargs):
+        self.text = text
+        self.journal = journal
+        self.max_workers = max_workers
+        self.kwargs = kwargs
+        self.lock = threading.Lock()
+
+    def read_journal(self):
+        '''Usernames the message was sent to by earlier runs'''
+        sent = set()
+        if not self.journal:
+            return sent
+        try:
+            with open(self.journal) as fobj:
+                for line in fobj:
+                    try:
+                        sent.add(json.loads(line)['username'])
+                    except (ValueError, KeyError):
+                        # Line cut short by an interrupted run
+                        continue
+        except (IOError, OSError):
+            pass
+        return sent
+
+    def record(self, username, message):
+        if self.journal:
+            with self.lock:
+                with open(self.journal, 'a') as fobj:
+                    fobj.write(json.dumps(
+                        {'username': username, '_id': message._id}) + '\n')
+
+    def send(self, recipients):
+        '''
+        Sends the message to the recipients, usernames or :class:`User`
+        objects, and returns a :class:`Report`
+        '''
+        report = Report()
+        done = self.read_journal()
+        usernames, seen = [], set()
+        for recipient in recipients:
+            username = getattr(recipient, 'username', recipient)
+            if username in done:
+                report.skipped.add(username)
+            elif username not in seen:
+                seen.add(username)
+                usernames.append(username)
+
+        rooms = models.direct_rooms.warm(usernames, max_workers=self.max_workers)
+
+        def send_to(username):
+            room = rooms[username]
+            if isinstance(room, Exception):
+                raise room
+            message = models.Message(msg=self.text, rid=room._id, **self.kwargs).create()
+            self.record(username, message)
+            return message
+
+        with futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            jobs = dict((executor.submit(send_to, username), username)
+                        for username in usernames)
+            for job in futures.as_completed(jobs):
+                try:
+                    report.sent[jobs[job]] = job.result()
+                except Exception as error:
+                    report.failed[jobs[job]] = error
+        report.finished = time.time()
+        return report
@@ -1,3 +1,5 @@
+import itertools
+
 import click
 import cosmicray
 import rocketchat
@@ -83,7 +85,8 @@ def channels(channel_names, recent, last, unread):
                 formattings=[
                     pprint.Formatting(formatter=MESSAGE_FORMAT)])]
 
-    channels = list(((rocketchat.channels()[name] for name in channel_names)
+    channels = list(((rocketchat.models.Channel(name=name).get()
+                      for name in channel_names)
                      if channel_names else rocketchat.models.Channel.channels))
     pprint.pprint(
         channels,
@@ -122,10 +125,88 @@ def ls():
     pass
 
 
+@click.command()
+@click.argument('text')
+@click.option('--room', help='Room id or name to search in')
+@click.option('--user', help='Username of the author')
+@click.option('--since', help='Date of the oldest message, such as 2018-01-01')
+@click.option('--until', help='Date the messages were posted before')
+@click.option('--count', help='Maximum number of messages', default=50)
+@click.option('--sync/--no-sync', help='Sync rooms before searching', default=False)
+def search(text, room, user, since, until, count, sync):
+    from rocketchat.store import MessageStore
+
+    if not text.split():
+        raise click.BadParameter('must contain a word', param_hint='TEXT')
+    store = MessageStore()
+    if sync:
+        rooms = itertools.chain(rocketchat.models.Channel.channels,
+                                rocketchat.models.Channel.groups,
+                                rocketchat.models.Channel.direct)
+        for channel in rooms:
+            if not room or room in (channel._id, channel.name):
+                store.sync(channel)
+    for message in store.search(text, room=room, username=user, since=since,
+                                until=until, count=count):
+        click.echo(MESSAGE_FORMAT.format(message))
+
+
+@click.command()
+@click.argument('directory')
+@click.option('--room', '-r', multiple=True, help='Room id or name to export')
+@click.option('--workers', help='Rooms exported at the same time', default=4)
+def export(directory, room, workers):
+    from rocketchat.export import Exporter
+
+    exporter = Exporter(directory, max_workers=workers)
+    rooms = [channel for channel in exporter.rooms()
+             if not room or channel._id in room or channel.name in room]
+    report = exporter.export(rooms)
+    for rid, error in report.errors.items():
+        click.echo('{}: {}'.format(rid, error), err=True)
+    click.echo(str(report))
+
+
+@click.command()
+@click.argument('path')
+@click.option('--journal', help='File recording the users done, to resume from')
+@click.option('--workers', help='Users created or updated at the same time', default=8)
+@click.option('--update/--no-update', help='Update existing users', default=True)
+def provision(path, journal, workers, update):
+    from rocketchat.provision import Provisioner, read_records
+
+    provisioner = Provisioner(journal=journal, max_workers=workers, update=update)
+    report = provisioner.run(read_records(path))
+    for username, error in report.failed.items():
+        click.echo('{}: {}'.format(username, error), err=True)
+    click.echo(str(report))
+
+
+@click.command()
+@click.option('--days', help='Days of history kept', type=int, required=True)
+@click.option('--room', '-r', multiple=True, help='Room id or name to purge')
+@click.option('--journal', help='File recording how far rooms were purged, to resume from')
+@click.option('--workers', help='Rooms purged at the same time', default=2)
+def purge(days, room, journal, workers):
+    from rocketchat.retention import Retention
+
+    retention = Retention(days, journal=journal, max_workers=workers)
+    rooms = [channel for channel in retention.rooms()
+             if not room or channel._id in room or channel.name in room]
+    report = retention.purge(rooms)
+    for rid, error in report.errors.items():
+        click.echo('{}: {}'.format(rid, error), err=True)
+    click.echo(str(report))
+
+
 cli.add_command(info)
 cli.add_command(configure)
 cli.add_command(whoami)
 cli.add_command(ls)
+cli.add_command(search)
+cli.add_command(export)
+cli.add_command(provision)
+cli.add_command(purge)
 configure.add_command(domain)
 configure.add_command(password)
 ls.add_command(channels)
@@ -0,0 +1,157 @@
+'''
+Export of room histories to gzipped JSON lines files, one per room.
+
+Rooms are exported concurrently, oldest message first. After every batch of
+messages a checkpoint records what was written, so an interrupted export
+resumes where it stopped, and the next export of the same directory only
+appends messages posted since.
+
+Usage::
+
+    >>> from rocketchat.export import Exporter
+    >>> report = Exporter('/var/backups/chat', max_workers=8).export()
+    >>> print(report)
+    312 rooms, 1843022 messages, 201.3 MB in 1204.7s (1530 messages/s)
+'''
+import gzip
+import itertools
+import json
+import os
+import threading
+import time
+
+from concurrent import futures
+
+from . import models
+
+
+class Report(object):
+    '''Messages and bytes exported per room, and errors of failed rooms'''
+
+    def __init__(self):
+        self.rooms = {}
+        self.errors = {}
+        self.messages = 0
+        self.bytes = 0
+        self.started = time.time()
+        self.finished = None
+        self.lock = threading.Lock()
+
+    @property
+    def seconds(self):
+        return (self.finished or time.time()) - self.started
+
+    @property
+    def rate(self):
+        '''Messages exported per second'''
+        return self.messages / max(self.seconds, 1e-6)
+
+    def add(self, rid, messages, size):
+        with self.lock:
+            self.rooms[rid] = self.rooms.get(rid, 0) + messages
+            self.messages += messages
+            self.bytes += size
+
+    def __str__(self):
+        report = '{} rooms, {} messages, {:.1f} MB in {:.1f}s ({:.0f} messages/s)'.format(
+            len(self.rooms), self.messages, self.bytes / 1e6, self.seconds, self.rate)
+        if self.errors:
+            report += ', {} rooms failed'.format(len(self.errors))
+        return report
+
+
+class Exporter(object):
+    '''
+    :param directory: where ``<channel_type>/<room id>.jsonl.gz`` files and
+        their checkpoints are written
+    :param max_workers: number of rooms exported at the same time
+    :param count: number of messages requested per history page
+    :param checkpoint_every: number of messages written between checkpoints
+    '''
+    def __init__(self, directory, max_workers=4, count=100, checkpoint_every=1000):
+        self.directory = directory
+        self.max_workers = max_workers
+        self.count = count
+        self.checkpoint_every = checkpoint_every
+
+    def rooms(self):
+        '''All channels, groups and direct rooms of the user'''
+        return itertools.chain(
+            models.Channel.channels, models.Channel.groups, models.Channel.direct)
+
+    def path(self, room, suffix='.jsonl.gz'):
+        return os.path.join(self.directory, room.CHANNEL_TYPE, room._id + suffix)
+
+    def export(self, rooms=None):
+        '''Exports the given rooms, or all rooms, and returns a :class:`Report`'''
+        for room_cls in (models.Channel, models.Group, models.Direct):
+            directory = os.path.join(self.directory, room_cls.CHANNEL_TYPE)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+        report = Report()
+        with futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            jobs = dict((executor.submit(self.export_room, room, report), room)
+                        for room in (self.rooms() if rooms is None else rooms))
+            for job in futures.as_completed(jobs):
+                room = jobs[job]
+                try:
+                    job.result()
+                except Exception as error:
+                    report.errors[room._id] = error
+        report.finished = time.time()
+        return report
+
+    def export_room(self, room, report):
+        '''Appends messages of the room posted since its last checkpoint'''
+        checkpoint = self.read_checkpoint(room)
+        # Drops anything written after the last checkpoint
+        with open(self.path(room), 'ab') as f:
+            f.truncate(checkpoint['size'])
+        messages = room.messages
+        if checkpoint['ts']:
+            messages = messages.by_daterange(checkpoint['ts'], None).inclusive
+        batch = []
+        for message in messages.walk('forward', count=self.count):
+            if message.ts == checkpoint['ts'] and message._id in checkpoint['ids']:
+                continue
+            batch.append(message)
+            if len(batch) >= self.checkpoint_every:
+                self.write(room, batch, checkpoint, report)
+                batch = []
+        self.write(room, batch, checkpoint, report)
+        report.add(room._id, 0, 0)
+
+    def write(self, room, batch, checkpoint, report):
+        '''Appends the messages to the room's file and saves a checkpoint'''
+        if not batch:
+            return
+        path = self.path(room)
+        with gzip.open(path, 'ab') as f:
+            for message in batch:
+                f.write((json.dumps(message.dict) + '\n').encode('utf-8'))
+        size = os.path.getsize(path)
+        last = batch[-1].ts
+        ids = [message._id for message in batch if message.ts == last]
+        if last == checkpoint['ts']:
+            ids.extend(checkpoint['ids'])
+        report.add(room._id, len(batch), size - checkpoint['size'])
+        checkpoint.update(ts=last, ids=ids, size=size,
+                          count=checkpoint['count'] + len(batch))
+        self.write_checkpoint(room, checkpoint)
+
+    def read_checkpoint(self, room):
+        '''
+        Date and ids of the last message exported, and the size of the file
+        and number of messages up to it
+        '''
+        try:
+            with open(self.path(room, '.checkpoint.json')) as f:
+                return json.load(f)
+        except (IOError, OSError):
+            return {'ts': None, 'ids': [], 'size': 0, 'count': 0}
+
+    def write_checkpoint(self, room, checkpoint):
+        path = self.path(room, '.checkpoint.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(checkpoint, f)
+        os.rename(path + '.tmp', path)
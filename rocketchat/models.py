@@ -1,16 +1,121 @@
+import collections
 import json
 import datetime
+import itertools
+import threading
+import time
+
+from concurrent import futures
 
 import cosmicray
 import cosmicray.util
 
 from cosmicray import model
 
-from . import v1
+from . import state, v1
+
+
+# Rooms listed by relationships leave out their members, loaded on demand
+ROOM_LIST_FIELDS = {'usernames': 0}
+
+
+def all_pages(model_ref, model_obj):
+    '''
+    Relationship getter that fetches every page of a listing route. With a
+    ``fields`` parameter the objects are partial, see :class:`Projection`
+    '''
+    request = model_obj()
+    if request.params.get('fields'):
+        request.model_cls = Projection(request.model_cls, request.params['fields'])
+    return v1.paginate(request)
+
+
+def parse_date(date):
+    '''Parses an ISO date, as in message ``ts``'''
+    for date_format in ('%Y-%m-%dT%H:%M:%S.%fZ', '%Y-%m-%dT%H:%M:%SZ', '%Y-%m-%d'):
+        try:
+            return datetime.datetime.strptime(date, date_format)
+        except ValueError:
+            continue
+    raise ValueError('Unsupported date: {!r}'.format(date))
+
+
+def format_date(date):
+    '''Formats a datetime as an ISO date with milliseconds, as in message ``ts``'''
+    return date.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+
+def to_ejson_date(date):
+    '''Converts an ISO date, as in message ``ts``, to an EJSON date'''
+    epoch = datetime.datetime(1970, 1, 1)
+    return {'$date': int((parse_date(date) - epoch).total_seconds() * 1000)}
 
 
 class Base(model.Model):
     __ignore__ = ['success']
+    # Fields not returned by the api
+    __local__ = []
+
+    @classmethod
+    def partial(cls, fields, loaded):
+        '''
+        Returns an object of the fields of a projection. Fields of ``cls``
+        not in ``loaded`` are left unset, and reading one fetches the object
+        '''
+        obj = cls._make(fields)
+        for field in cls.__slots__:
+            if field not in loaded and field not in cls.__local__:
+                delattr(obj, field)
+        obj._partial = True
+        return obj
+
+    def __getattr__(self, name):
+        # Only called for fields left unset by :func:`partial`
+        if name in self.__slots__ and self.__dict__.get('_partial'):
+            # Unset while loading, so that reading unset fields does not load
+            self._partial = False
+            try:
+                self.load()
+            except Exception:
+                self._partial = True
+                raise
+            return getattr(self, name)
+        raise AttributeError(name)
+
+    def items(self):
+        '''Returns iterator of key-value pairs of the fields that are loaded'''
+        for field in self.__slots__:
+            try:
+                yield field, object.__getattribute__(self, field)
+            except AttributeError:
+                continue
+
+    def load(self):
+        '''Fetches all fields of the object'''
+        return self.get()
+
+
+class Projection(object):
+    '''
+    Model class of requests with a ``fields`` parameter: makes partial
+    objects, see :func:`Base.partial`
+
+    :param model_cls: class of the objects
+    :param fields: Mongo projection, as dict or JSON string. Fields set to 0
+        are left out, or all but those set to 1 and ``_id`` are
+    '''
+    def __init__(self, model_cls, fields):
+        if not isinstance(fields, dict):
+            fields = json.loads(fields)
+        self.model_cls = model_cls
+        if fields and not any(fields.values()):
+            self.loaded = set(model_cls.__slots__) - set(fields)
+        else:
+            self.loaded = set(field for field, value in fields.items() if value)
+            self.loaded.add('_id')
+
+    def _make(self, fields):
+        return self.model_cls.partial(fields, self.loaded)
 
 
 class User(Base):
@@ -37,49 +142,149 @@ class User(Base):
         # Non-API fields
         '_direct'
     ]
+    __local__ = ['_direct']
     __route__ = v1.users_info
 
     me = model.relationship(
         'User', v1.me, is_static=True)
     channels =  model.relationship(
-        'Channel', v1.channels_list_joined, is_sequence=True, is_static=True)
+        'Channel', v1.channels_list_joined, is_sequence=True, is_static=True,
+        params={'fields': ROOM_LIST_FIELDS}, get=all_pages)
     users = model.relationship(
-        'User', v1.users_list, is_sequence=True, is_static=True)
+        'User', v1.users_list, is_sequence=True, is_static=True,
+        get=all_pages)
 
-    def get(self):
-        params = {'userId': self._id} if self._id else {'username': self.username}
-        self.dict = self(params=params).get().dict
+    @classmethod
+    def iter_all(cls, prefetch=False, fields=None, query=None):
+        '''
+        Yields all users on the server, or those matching the Mongo ``query``,
+        one page at a time. With a Mongo projection as ``fields``, the users
+        are partial, see :class:`Projection`
+        '''
+        return v1.paginate(v1.users_list(
+            Projection(cls, fields) if fields else cls,
+            params={'fields': fields, 'query': query}), prefetch=prefetch)
+
+    def get(self, refresh=False):
+        user = None if refresh else user_cache.get(self._id, self.username)
+        if user is None:
+            user = self.fetch(self._id, self.username)
+        if user is not self:
+            self.dict = user.fields()
+        return self
+
+    def load(self):
+        # Only the id is read, other fields of a partial user may be unset
+        user = self.fetch(self._id)
+        if user is not self:
+            self.dict = user.fields()
         return self
 
+    @classmethod
+    def lookup(cls, _id=None, username=None):
+        '''
+        Returns the shared user object for the given id or username,
+        fetching it only if it is not cached
+        '''
+        user = user_cache.get(_id, username)
+        if user is None:
+            user = cls.fetch(_id, username)
+        return user
+
+    @classmethod
+    def fetch(cls, _id=None, username=None):
+        '''Fetches the user with users.info, caches it and returns the shared object'''
+        params = {'userId': _id} if _id else {'username': username}
+        return user_cache.add(cls(_id=_id, username=username)(params=params).get())
+
+    @classmethod
+    def resolve(cls, usernames=(), ids=(), max_workers=8):
+        '''
+        Returns dict of the given usernames and ids to their shared user
+        objects. Cached users are not fetched. Many misses are fetched with
+        filtered ``users.list`` queries, a few, or all of them if the server
+        rejects the query, with concurrent ``users.info`` requests. Unknown
+        users are left out.
+        '''
+        resolved, missing, seen = {}, [], set()
+        for key, _id, username in itertools.chain(
+                ((username, None, username) for username in usernames),
+                ((_id, _id, None) for _id in ids)):
+            user = user_cache.get(_id, username)
+            if user is not None:
+                resolved[key] = user
+            elif key not in seen:
+                seen.add(key)
+                missing.append((key, _id, username))
+        if len(missing) >= v1.api.get_config('USER_RESOLVE_QUERY_MIN'):
+            try:
+                listed = cls._list_users(
+                    [username for _, _, username in missing if username],
+                    [_id for _, _id, _ in missing if _id])
+            except v1.RocketChatError:
+                listed = []
+            # Taken from the response, as the cache may not hold them all
+            found = dict((user.username, user) for user in listed)
+            found.update((user._id, user) for user in listed)
+            for key, _, _ in missing:
+                if key in found:
+                    resolved[key] = found[key]
+            missing = [m for m in missing if m[0] not in resolved]
+
+        def fetch(key_id_username):
+            try:
+                return cls.lookup(*key_id_username[1:])
+            except v1.RocketChatError:
+                return None
+
+        if missing:
+            with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+                for (key, _, _), user in zip(missing, executor.map(fetch, missing)):
+                    if user is not None:
+                        resolved[key] = user
+        return resolved
+
+    @classmethod
+    def _list_users(cls, usernames, ids, chunk=200):
+        '''
+        Fetches the users in one paged users.list query per chunk of names,
+        adds them to the cache and returns them
+        '''
+        users = []
+        for start in range(0, max(len(usernames), len(ids)), chunk):
+            query = {'$or': [
+                {'username': {'$in': usernames[start:start + chunk]}},
+                {'_id': {'$in': ids[start:start + chunk]}}]}
+            request = v1.users_list(cls, params={'query': json.dumps(query)})
+            for user in v1.paginate(request):
+                users.append(user_cache.add(user))
+        return users
+
+    def fields(self):
+        '''Returns dict of the fields that are set'''
+        return dict((k, v) for k, v in self.items() if v is not None)
+
     def send(self, text, alias=None, emoji=None, avatar=None, attachments=None):
         return self.direct.send(
             text, alias=alias, emoji=emoji, avatar=avatar, attachments=attachments)
 
+    def send_later(self, text, **kwargs):
+        '''Queues a direct message, returns a future of the sent message'''
+        return self.direct.send_later(text, **kwargs)
+
     @property
     def direct(self):
         '''
         Open direct message with the given user
         '''
         if self._direct is None:
-            if self._id is None:
+            if self.username is None:
                 self.get()
-            self._direct = self._get_direct_room()
+            self._direct = direct_rooms.get(self.username)
             if self._direct is None:
-                try:
-                    d = Direct(_id=self._id).open()
-                except Exception as error:
-                    # returns 400 if room is already opened
-                    pass
-                self._direct = self._get_direct_room()
+                self._direct = Direct(username=self.username).create()
         return self._direct
 
-    def _get_direct_room(self):
-        try:
-            Channel.direct.clear()
-            return next(u for u in Channel.direct if self.username in u.usernames)
-        except StopIteration:
-            pass
-
     def __eq__(self, obj):
         if isinstance(obj, (User, cosmicray.model.ModelInstanceAttribute)):
             return self._id == obj._id
@@ -114,33 +319,50 @@ class Channel(Base):
         # Non-api fields
         'channel_type'
     ]
+    __local__ = ['channel_type']
     __route__ = v1.channels_info
 
     channels = model.relationship(
         'Channel', v1.channels_list,
         urlargs={'channel_type': 'channels'},
-        is_sequence=True, is_static=True)
+        params={'fields': ROOM_LIST_FIELDS},
+        is_sequence=True, is_static=True, get=all_pages)
     direct = model.relationship(
         'Direct', v1.channels_list,
         urlargs={'channel_type': 'im'},
-        is_sequence=True, is_static=True)
+        is_sequence=True, is_static=True, get=all_pages)
     groups = model.relationship(
         'Group', v1.channels_list,
         urlargs={'channel_type': 'groups'},
-        is_sequence=True, is_static=True)
+        params={'fields': ROOM_LIST_FIELDS},
+        is_sequence=True, is_static=True, get=all_pages)
     _messages = model.relationship(
         'Message', v1.channels_messages, is_sequence=True,
         params={'roomId': model.ModelParam('_id')},
         urlargs={'channel_type': model.ModelParam('CHANNEL_TYPE')},
         lazy=True)
 
+    @classmethod
+    def iter_all(cls, prefetch=False, fields=None, query=None):
+        '''
+        Yields all rooms of ``cls.CHANNEL_TYPE``, or those matching the Mongo
+        ``query``, one page at a time. With a Mongo projection as ``fields``,
+        the rooms are partial, see :class:`Projection`
+        '''
+        return v1.paginate(v1.channels_list(
+            Projection(cls, fields) if fields else cls,
+            urlargs={'channel_type': cls.CHANNEL_TYPE},
+            params={'fields': fields, 'query': query}), prefetch=prefetch)
+
     @property
     def messages(self):
         return Messages(channel=self)
 
     @property
     def users(self):
-        return list(User(username=username).get() for username in self.usernames)
+        usernames = self.usernames or []
+        users = User.resolve(usernames=usernames)
+        return [users[username] for username in usernames if username in users]
 
     @property
     def cache(self):
@@ -158,17 +380,54 @@ class Channel(Base):
             urlargs={'channel_type': self.CHANNEL_TYPE}).post()
 
     def invite(self, user=None, userid=None, username=None):
-        userid = user and user._id or userid or User(username=username).get()._id
+        userid = user and user._id or userid or User.lookup(username=username)._id
         return v1.channels_invite(
             self.__class__, **self.get_payload({'userId': userid}),
             urlargs={'channel_type': self.CHANNEL_TYPE}).post()
 
     def kick(self, user=None, userid=None, username=None):
-        userid = user and user._id or userid or User(username=username).get()._id
+        userid = user and user._id or userid or User.lookup(username=username)._id
         return v1.channels_kick(
             self.__class__, **self.get_payload({'userId': userid}),
             urlargs={'channel_type': self.CHANNEL_TYPE}).post()
 
+    def sync_members(self, desired, dry_run=False, max_workers=8):
+        '''
+        Invites and kicks users so that the members of the channel are the
+        desired usernames (or users). The calling user is never kicked.
+        Users are resolved in bulk, then invited and kicked concurrently.
+
+        Returns dict of each username invited or kicked to ``'invited'`` or
+        ``'kicked'``, or to the error raised doing so. With ``dry_run``
+        nothing is changed, and the values are ``'invite'`` or ``'kick'``.
+        '''
+        desired = set(getattr(user, 'username', user) for user in desired)
+        current = set(self.get().usernames or [])
+        actions = dict((username, 'invite') for username in desired - current)
+        actions.update((username, 'kick') for username in
+                       current - desired - set([User.me.username]))
+        if dry_run or not actions:
+            return actions
+
+        users = User.resolve(usernames=list(actions))
+
+        def apply(username):
+            try:
+                if username not in users:
+                    raise v1.RocketChatError(
+                        'User not found: {}'.format(username),
+                        'error-invalid-user', None)
+                if actions[username] == 'invite':
+                    self.invite(users[username])
+                    return 'invited'
+                self.kick(users[username])
+                return 'kicked'
+            except Exception as error:
+                return error
+
+        with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return dict(zip(actions, executor.map(apply, actions)))
+
     def open(self):
         return v1.channels_open(
             **self.get_payload(),
@@ -204,6 +463,13 @@ class Channel(Base):
                        alias=alias, emoji=emoji, avatar=avatar,
                        attachments=attachments).create()
 
+    def send_later(self, text, **kwargs):
+        '''
+        Queues the message on :data:`send_queue`, returns a future of the
+        sent message
+        '''
+        return send_queue.send(self._id, text, **kwargs)
+
     def get_params(self):
         return {'params': {'roomId': self._id} if self._id else {'roomName': self.name}}
 
@@ -216,6 +482,11 @@ class Channel(Base):
 class Direct(Channel):
     CHANNEL_TYPE = 'im'
 
+    def create(self):
+        '''Opens direct message room with ``self.username`` and indexes it'''
+        room = v1.im_create(Direct, json={'username': self.username}).post()
+        return direct_rooms.add(room, self.username)
+
 
 class Group(Channel):
     CHANNEL_TYPE = 'groups'
@@ -251,14 +522,16 @@ class Message(Base):
         'channel_type',
         'unreadNotLoaded'
     ]
+    __local__ = ['emoji', 'avatar', 'channel_name', 'channel_type', 'unreadNotLoaded']
 
     @property
     def user(self):
-        return User(_id=self.u['_id']).get()
+        return User.lookup(_id=self.u['_id'])
 
     @property
     def user_mentions(self):
-        return list(User(**m) for m in self.mentions)
+        return list(user_cache.get(m.get('_id'), m.get('username')) or User(**m)
+                    for m in self.mentions)
 
     @property
     def channel(self):
@@ -370,28 +643,28 @@ class Messages(object):
 
     @property
     def asc(self):
-        return Messages(self.channel, self.get_params(), 'asc')
+        return self.__class__(self.channel, self.get_params(), 'asc')
 
     @property
     def desc(self):
-        return Messages(self.channel, self.get_params(), 'desc')
+        return self.__class__(self.channel, self.get_params(), 'desc')
 
     @property
     def inclusive(self):
-        return Messages(
+        return self.__class__(
             self.channel, self.get_params(inclusive=True), self.sort_order)
 
     @property
     def include_unread_count(self):
-        return Messages(
+        return self.__class__(
             self.channel, self.get_params(unreads=True), self.sort_order)
 
     def count(self, count):
-        return Messages(
+        return self.__class__(
             self.channel, self.get_params(count=count), self.sort_order)
 
     def by_daterange(self, start, end):
-        return Messages(
+        return self.__class__(
             self.channel, self.get_params(oldest=start, latest=end), self.sort_order)
 
     def _sort(self, messages):
@@ -401,38 +674,444 @@ class Messages(object):
     def get(self):
         return list(self.channel._messages(params=self.params).get())
 
+    def walk(self, direction='backward', count=100):
+        '''
+        Yields every message of the channel between the ``oldest`` and
+        ``latest`` dates, newest first, or oldest first if ``direction`` is
+        ``forward``. Each page starts at the date of the last message yielded,
+        so only one page is held in memory whatever the size of the history.
+
+        Usage::
+
+            >>> for message in channel.messages.by_daterange('2018-01-01', None).walk():
+            ...     print(message.msg)
+        '''
+        forward = direction == 'forward'
+        oldest, latest = self.params.get('oldest'), self.params.get('latest')
+        inclusive = self.params.get('inclusive', False)
+
+        def in_range(ts):
+            return ((not oldest or ts > oldest or inclusive and ts == oldest) and
+                    (not latest or ts < latest or inclusive and ts == latest))
+
+        cursor, seen = oldest if forward else latest, set()
+        while True:
+            if forward:
+                page = self._page_forward(cursor, latest, count)
+            else:
+                page = list(self.channel._messages(params=dict(
+                    self.params, oldest=oldest, latest=cursor, inclusive=True,
+                    count=count)).get())
+            # Pages overlap on the date they start from
+            fresh = [m for m in page if m._id not in seen]
+            for message in fresh:
+                if in_range(message.ts):
+                    yield message
+            if len(page) < count:
+                return
+            if not fresh:
+                # More messages share one date than fit a page
+                count *= 2
+                continue
+            if fresh[-1].ts != cursor:
+                cursor, seen = fresh[-1].ts, set()
+            seen.update(m._id for m in fresh if m.ts == cursor)
+
+    def _page_forward(self, oldest, latest, count):
+        '''Next page of messages from the oldest date on, oldest first'''
+        ts = {}
+        if oldest:
+            ts['$gte'] = to_ejson_date(oldest)
+        if latest:
+            ts['$lte'] = to_ejson_date(latest)
+        params = {'roomId': self.channel._id, 'sort': json.dumps({'ts': 1}),
+                  'count': count}
+        if ts:
+            params['query'] = json.dumps({'ts': ts})
+        return list(v1.channels_list_messages(
+            Message, urlargs={'channel_type': self.channel.CHANNEL_TYPE},
+            params=params).get())
+
+    def sync(self, store=None):
+        '''
+        Stores new messages of the channel in a local
+        :class:`rocketchat.store.MessageStore`, and returns how many
+        '''
+        from .store import MessageStore
+        return (store or MessageStore()).sync(self.channel)
+
     def delete(self):
-        if 'oldest' not in self.params or 'latest' not in self.params:
+        '''
+        Deletes the messages between the ``oldest`` and ``latest`` dates.
+        Requires the clean-channel-history permission
+        '''
+        if not self.params.get('oldest') or not self.params.get('latest'):
             raise TypeError('Missing required parameters: oldest/latest')
-        return v1.channels_remove_messages(json={
+        if self.channel.CHANNEL_TYPE == Channel.CHANNEL_TYPE:
+            clean_history = v1.channels_remove_messages
+        else:
+            clean_history = v1.rooms_clean_history
+        return clean_history(json={
             'roomId': self.channel._id,
-            'oldest': self.params['start'],
-            'latest': self.param['end'],
-            'inclusive': self.param.get('inclusive', False)
+            'oldest': self.params['oldest'],
+            'latest': self.params['latest'],
+            'inclusive': self.params.get('inclusive', False)
         }).post()
 
 
-class Cache(object):
-    def __init__(self, identifier):
-        self.fpath = v1.api.cache_dir(identifier)
+class RoomWatcher(object):
+    '''
+    Polls many rooms for new messages. Each poll asks the server which rooms
+    changed since the previous one, and fetches history only for those.
+
+    :param rooms: channels to watch. Default: all rooms of the user
+    :param since: only messages after this date are returned. Default: only
+        messages posted after the first poll
+    :param count: number of messages fetched per history request
+
+    Usage::
+
+        >>> watcher = RoomWatcher(rooms=[rocketchat.channels()['general']])
+        >>> for message in watcher.watch(interval=3):
+        ...     print(message.msg)
+    '''
+    ROOM_TYPES = {'c': Channel, 'p': Group, 'd': Direct}
+
+    def __init__(self, rooms=None, since=None, count=100):
+        self.room_ids = set(room._id for room in rooms) if rooms else None
+        self.since = since
+        self.count = count
+        self.updated_since = None
+        self.last_message = {}
+
+    def poll(self):
+        '''Returns new messages in all changed rooms, oldest first'''
+        updated_since = self.updated_since
+        params = {'updatedSince': updated_since} if updated_since else {}
+        rooms = v1.rooms_get(params=params).get().get('update', [])
+        messages = []
+        for room in rooms:
+            self.updated_since = max(self.updated_since or '', room['_updatedAt'])
+            last_message = room.get('lm')
+            if not last_message or (self.room_ids is not None and
+                                    room['_id'] not in self.room_ids):
+                continue
+            oldest = self.last_message.get(room['_id'])
+            if oldest is None:
+                if updated_since is None and self.since is None:
+                    # First poll, only watch for messages from now on
+                    self.last_message[room['_id']] = last_message
+                    continue
+                oldest = updated_since or self.since
+            if last_message > oldest:
+                new = self.history(room, oldest)
+                if new:
+                    self.last_message[room['_id']] = new[-1].ts
+                    messages.extend(new)
+        return sorted(messages, key=lambda obj: obj.ts)
+
+    def history(self, room, oldest):
+        '''Returns all messages of the room posted after oldest, oldest first'''
+        channel_cls = self.ROOM_TYPES.get(room.get('t'), Channel)
+        messages = channel_cls(_id=room['_id'], name=room.get('name')).messages
+        result, latest = [], None
+        while True:
+            page = messages.by_daterange(oldest, latest).count(self.count).get()
+            result.extend(page)
+            if len(page) < self.count:
+                break
+            latest = page[-1].ts
+        return sorted(result, key=lambda obj: obj.ts)
+
+    def watch(self, interval=3):
+        '''Generator that polls every ``interval`` seconds and yields new messages'''
+        while True:
+            for message in self.poll():
+                yield message
+            time.sleep(interval)
+
+
+class SendQueue(object):
+    '''
+    Sends messages on background threads and returns futures of the sent
+    :class:`Message`. Messages to one room are sent one at a time in the
+    order they were queued, different rooms in parallel. Requests are paced
+    by the session's rate limiter like any other.
+
+    If ``coalesce`` is set, messages queued to a room within that many
+    seconds of each other are joined into one message, up to
+    ``max_length`` characters. Only messages sent without alias, emoji,
+    avatar or attachments are joined.
+
+    :param workers: number of rooms sent to at the same time.
+        Default: ``SEND_QUEUE_WORKERS``
+    :param coalesce: seconds to wait for more messages to the same room.
+        Default: ``SEND_QUEUE_COALESCE``
+
+    Usage::
+
+        >>> futures = [channel.send_later('line {}'.format(i)) for i in range(10)]
+        >>> message = futures[-1].result()
+    '''
+    def __init__(self, workers=None, coalesce=None, max_length=5000):
+        self.workers = workers
+        self.coalesce = coalesce
+        self.max_length = max_length
+        self.rooms = {}
+        self.unsent = set()
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def send(self, rid, text, **kwargs):
+        '''Queues a message to the room and returns its future'''
+        future = futures.Future()
+        future.add_done_callback(self.sent)
+        with self.lock:
+            self.unsent.add(future)
+            if self.executor is None:
+                self.executor = futures.ThreadPoolExecutor(
+                    max_workers=self.workers or v1.api.get_config('SEND_QUEUE_WORKERS'))
+            pending = self.rooms.get(rid)
+            if pending is None:
+                # No messages of this room are being sent
+                pending = self.rooms[rid] = collections.deque()
+                self.executor.submit(self.drain, rid)
+            pending.append((text, kwargs, future))
+        return future
+
+    def sent(self, future):
+        with self.lock:
+            self.unsent.discard(future)
+
+    def drain(self, rid):
+        '''Sends queued messages of the room until there are none left'''
+        coalesce = self.coalesce
+        if coalesce is None:
+            coalesce = v1.api.get_config('SEND_QUEUE_COALESCE')
         try:
-            self.cache = cosmicray.util.read_artifact_file(self.fpath, json.loads)
-        except (FileNotFoundError, ValueError, TypeError):
-            self.cache = {}
+            while True:
+                if coalesce:
+                    time.sleep(coalesce)
+                with self.lock:
+                    pending = self.rooms[rid]
+                    if not pending:
+                        del self.rooms[rid]
+                        return
+                    batch = [pending.popleft()]
+                    while (coalesce and pending and not batch[0][1] and
+                           not pending[0][1] and
+                           sum(len(text) + 1 for text, _, _ in batch) +
+                           len(pending[0][0]) <= self.max_length):
+                        batch.append(pending.popleft())
+                # Cancelled messages are not sent
+                batch = [item for item in batch if item[2].set_running_or_notify_cancel()]
+                if not batch:
+                    continue
+                text = '\n'.join(text for text, _, _ in batch)
+                try:
+                    message = Message(msg=text, rid=rid, **batch[0][1]).create()
+                except Exception as error:
+                    for _, _, future in batch:
+                        future.set_exception(error)
+                else:
+                    for _, _, future in batch:
+                        future.set_result(message)
+        except BaseException as error:
+            # Fails the queued messages, and lets the next send to the room
+            # start a new drain
+            with self.lock:
+                pending = self.rooms.pop(rid, ())
+            for _, _, future in pending:
+                if future.set_running_or_notify_cancel():
+                    future.set_exception(error)
+            raise
+
+    def join(self):
+        '''Waits until all messages queued so far are sent, failed or cancelled'''
+        with self.lock:
+            unsent = list(self.unsent)
+        futures.wait(unsent)
+
+    def close(self):
+        '''Sends the queued messages and stops the threads'''
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+
+class Cache(object):
+    '''
+    State of a channel, read from memory and written behind by
+    :class:`rocketchat.state.StateStore`
+    '''
+    def __init__(self, identifier, store=None):
+        self.identifier = identifier
+        self.store = store or state.store
+
+    @property
+    def cache(self):
+        return self.store.load(self.identifier)
 
     def save(self):
-        cosmicray.util.write_artifact_file(self.fpath, self.cache, json.dumps)
+        self.store.flush()
 
     def get(self, key, default=None):
-        return self.cache.get(key, default)
+        return self.store.get(self.identifier, key, default)
 
     def __getitem__(self, key):
         return self.cache[key]
 
     def __setitem__(self, key, value):
-        self.cache[key] = value
-        self.save()
+        self.store.set(self.identifier, key, value)
 
     def __delitem__(self, key):
-        del self.cache[key]
-        self.save()
+        self.store.delete(self.identifier, key)
+
+
+class UserCache(object):
+    '''
+    Process-wide identity map of users keyed by ``_id`` and ``username``.
+    Entries expire after ``USER_CACHE_TTL`` seconds and the least recently
+    used entries are evicted once there are more than ``USER_CACHE_SIZE``.
+    '''
+    def __init__(self):
+        self.users = collections.OrderedDict()
+        self.ids = {}
+        self.lock = threading.RLock()
+
+    @property
+    def ttl(self):
+        return v1.api.get_config('USER_CACHE_TTL')
+
+    @property
+    def maxsize(self):
+        return v1.api.get_config('USER_CACHE_SIZE')
+
+    def get(self, _id=None, username=None):
+        with self.lock:
+            _id = _id or self.ids.get(username)
+            try:
+                fetched_on, user = self.users[_id]
+            except KeyError:
+                return None
+            if self.ttl and time.time() - fetched_on > self.ttl:
+                self._remove(_id)
+                return None
+            self.users.move_to_end(_id)
+            return user
+
+    def add(self, user):
+        '''Adds user to the cache and returns the cached user object'''
+        if not user or user._id is None:
+            return user
+        with self.lock:
+            try:
+                _, cached = self.users.pop(user._id)
+                if cached is not user:
+                    self.ids.pop(cached.username, None)
+                    cached.dict = user.fields()
+                user = cached
+            except KeyError:
+                pass
+            self.users[user._id] = (time.time(), user)
+            if user.username:
+                self.ids[user.username] = user._id
+            while self.maxsize and len(self.users) > self.maxsize:
+                self._remove(next(iter(self.users)))
+        return user
+
+    def discard(self, user):
+        with self.lock:
+            self._remove(user._id or self.ids.get(user.username))
+
+    def clear(self):
+        with self.lock:
+            self.users.clear()
+            self.ids.clear()
+
+    def _remove(self, _id):
+        try:
+            _, user = self.users.pop(_id)
+        except KeyError:
+            return
+        if self.ids.get(user.username) == _id:
+            del self.ids[user.username]
+
+    def __len__(self):
+        return len(self.users)
+
+
+class DirectIndex(object):
+    '''
+    Maps usernames to direct message rooms. Rooms are listed from the server
+    once, after that the index is only updated as new rooms are opened.
+    '''
+    def __init__(self):
+        self.rooms = {}
+        self.loaded = False
+        self.lock = threading.RLock()
+
+    def get(self, username):
+        with self.lock:
+            if not self.loaded:
+                self.refresh()
+            return self.rooms.get(username)
+
+    def add(self, room, username=None):
+        '''Indexes room by the usernames of its members and returns the room'''
+        me = User.me.username
+        usernames = set(room.usernames or [])
+        if username:
+            usernames.add(username)
+        with self.lock:
+            for name in usernames:
+                if name != me or usernames == set([me]):
+                    self.rooms[name] = room
+        return room
+
+    def refresh(self):
+        '''Reloads the index with all direct message rooms from the server'''
+        with self.lock:
+            self.rooms.clear()
+            for room in Direct.iter_all():
+                self.add(room)
+            self.loaded = True
+
+    def warm(self, usernames, max_workers=8):
+        '''
+        Makes sure there is a direct message room for each of the given
+        usernames, opening the missing ones concurrently.
+        Returns mapping of username to room, or to the error raised opening it
+        '''
+        def open_room(username):
+            try:
+                # Direct.create indexes in direct_rooms, which need not be self
+                return self.add(Direct(username=username).create(), username)
+            except Exception as error:
+                return error
+
+        with self.lock:
+            if not self.loaded:
+                self.refresh()
+            result = dict((u, self.rooms.get(u)) for u in usernames)
+        missing = [u for u, room in result.items() if room is None]
+        with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            result.update(zip(missing, executor.map(open_room, missing)))
+        return result
+
+    def clear(self):
+        with self.lock:
+            self.rooms.clear()
+            self.loaded = False
+
+    def __contains__(self, username):
+        return username in self.rooms
+
+    def __len__(self):
+        return len(self.rooms)
+
+
+user_cache = UserCache()
+direct_rooms = DirectIndex()
+send_queue = SendQueue()
@@ -0,0 +1,232 @@
+'''
+Bulk creation and update of user accounts from CSV or JSON lines files.
+
+Records are read one at a time. Existing users are listed once, with a paged
+``users.list`` scan, and each record is then created, updated with the fields
+that differ, or left alone. Records are processed concurrently. A journal
+records each user done, so an interrupted import started again skips them.
+
+CSV columns and JSON keys are the fields of ``users.create``: ``username``,
+``email``, ``name``, ``password``, ``roles`` (comma separated in CSV),
+``active``, ``verified``, ``joinDefaultChannels``, ``requirePasswordChange``,
+``sendWelcomeEmail`` and ``customFields``.
+
+Usage::
+
+    >>> from rocketchat.provision import Provisioner, read_records
+    >>> report = Provisioner(journal='import.jsonl', max_workers=8).run(
+    ...     read_records('users.csv'))
+    >>> print(report)
+    48211 created, 1204 updated, 585 unchanged, 0 skipped, 2 failed in 1402.3s
+'''
+import csv
+import json
+import random
+import threading
+import time
+
+from concurrent import futures
+
+import requests
+
+from . import models, v1
+
+
+BOOLEAN_FIELDS = ['active', 'verified', 'joinDefaultChannels',
+                  'requirePasswordChange', 'sendWelcomeEmail']
+# Fields that only apply when a user is created
+CREATE_FIELDS = ['password', 'joinDefaultChannels', 'requirePasswordChange',
+                 'sendWelcomeEmail']
+# Fields of existing users compared with the records
+DIRECTORY_FIELDS = {'username': 1, 'name': 1, 'emails': 1, 'roles': 1,
+                    'active': 1, 'customFields': 1}
+
+
+def read_records(path):
+    '''Generator of user records of a CSV file, or of a JSON lines file'''
+    with open(path) as fobj:
+        if path.endswith('.csv'):
+            for row in csv.DictReader(fobj):
+                yield parse_row(row)
+        else:
+            for line in fobj:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def parse_row(row):
+    record = dict((key, value) for key, value in row.items() if value not in (None, ''))
+    for key in BOOLEAN_FIELDS:
+        if key in record:
+            record[key] = record[key].strip().lower() in ('1', 'true', 'yes')
+    if 'roles' in record:
+        record['roles'] = [role.strip() for role in record['roles'].split(',')]
+    if 'customFields' in record:
+        record['customFields'] = json.loads(record['customFields'])
+    return record
+
+
+class Report(object):
+    '''Usernames created, updated, unchanged, skipped as done, and failed'''
+
+    def __init__(self):
+        self.created = []
+        self.updated = []
+        self.unchanged = []
+        self.skipped = []
+        self.failed = {}
+        self.started = time.time()
+        self.finished = None
+
+    @property
+    def seconds(self):
+        return (self.finished or time.time()) - self.started
+
+    def __str__(self):
+        return ('{} created, {} updated, {} unchanged, {} skipped, {} failed '
+                'in {:.1f}s').format(
+                    len(self.created), len(self.updated), len(self.unchanged),
+                    len(self.skipped), len(self.failed), self.seconds)
+
+
+class Provisioner(object):
+    '''
+    :param journal: file recording the users done, to resume from
+    :param max_workers: number of records processed at the same time
+    :param update: if False, existing users are left unchanged
+    :param retries: times a failed create is attempted again. Default: ``RETRY_MAX``
+    '''
+    def __init__(self, journal=None, max_workers=8, update=True, retries=None):
+        self.journal = journal
+        self.max_workers = max_workers
+        self.update = update
+        self.retries = v1.api.get_config('RETRY_MAX') if retries is None else retries
+        self.users = None
+        self.lock = threading.Lock()
+
+    def directory(self):
+        '''Fields of all existing users by username, listed once'''
+        if self.users is None:
+            self.users = dict(
+                (user['username'], user) for user in v1.paginate(
+                    v1.users_list(params={'fields': DIRECTORY_FIELDS})))
+        return self.users
+
+    def read_journal(self):
+        '''Usernames done by earlier runs'''
+        done = set()
+        if not self.journal:
+            return done
+        try:
+            with open(self.journal) as fobj:
+                for line in fobj:
+                    try:
+                        done.add(json.loads(line)['username'])
+                    except (ValueError, KeyError):
+                        continue
+        except (IOError, OSError):
+            pass
+        return done
+
+    def record(self, username, action):
+        with self.lock:
+            if self.journal:
+                with open(self.journal, 'a') as fobj:
+                    fobj.write(json.dumps({'username': username, 'action': action}) + '\n')
+
+    def run(self, records):
+        '''Creates or updates the users of the records, returns a :class:`Report`'''
+        report = Report()
+        done = self.read_journal()
+        users = self.directory()
+        # Bounds the records read ahead of the workers
+        slots = threading.BoundedSemaphore(self.max_workers * 2)
+
+        def process(record):
+            try:
+                action = self.provision(record, users.get(record['username']))
+                getattr(report, action).append(record['username'])
+                self.record(record['username'], action)
+            except Exception as error:
+                report.failed[record['username']] = error
+            finally:
+                slots.release()
+
+        with futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for record in records:
+                if record['username'] in done:
+                    report.skipped.append(record['username'])
+                    continue
+                slots.acquire()
+                executor.submit(process, record)
+        report.finished = time.time()
+        return report
+
+    def provision(self, record, existing):
+        '''Creates or updates the user, returns what was done'''
+        if existing is None:
+            self.create(record)
+            return 'created'
+        data = self.changes(record, existing) if self.update else None
+        if not data:
+            return 'unchanged'
+        v1.users_update(json={'userId': existing['_id'], 'data': data}).post()
+        return 'updated'
+
+    def create(self, record):
+        '''
+        Creates the user. An attempt failing with a server or connection error
+        may still have created the user: it is looked up before trying again
+        '''
+        attempt = 0
+        while True:
+            try:
+                return v1.users_create(json=record).post()
+            except (v1.RocketChatError, requests.RequestException) as error:
+                status_code = getattr(error, 'status_code', None)
+                if status_code is not None and status_code < 500 and status_code != 429:
+                    raise
+                if self.exists(record['username']):
+                    return
+                if attempt >= self.retries:
+                    raise
+            backoff = v1.api.get_config('RETRY_BACKOFF') * 2 ** attempt
+            time.sleep(random.uniform(0, min(backoff, v1.api.get_config('RETRY_BACKOFF_MAX'))))
+            attempt += 1
+
+    @staticmethod
+    def exists(username):
+        try:
+            models.User(username=username).get()
+            return True
+        except v1.RocketChatError:
+            return False
+
+    @staticmethod
+    def changes(record, existing):
+        '''Fields of the record that differ from the existing user'''
+        data = {}
+        emails = existing.get('emails') or []
+        # The email of the record, or the first one if it has none
+        address = record.get('email')
+        email = next((email for email in emails
+                      if address is None or email.get('address') == address), None)
+        for key, value in record.items():
+            if key in CREATE_FIELDS or key == 'username':
+                continue
+            if key == 'email':
+                if email is None:
+                    data[key] = value
+            elif key == 'verified':
+                if email is None or bool(email.get('verified')) != value:
+                    data[key] = value
+            elif key == 'customFields':
+                current = existing.get('customFields') or {}
+                if any(current.get(name) != field for name, field in value.items()):
+                    data[key] = dict(current, **value)
+            elif key == 'roles':
+                if sorted(value) != sorted(existing.get('roles') or []):
+                    data[key] = value
+            elif existing.get(key) != value:
+                data[key] = value
+        return data
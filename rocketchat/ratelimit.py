@@ -0,0 +1,161 @@
+'''
+Client side pacing of requests, driven by the ``X-RateLimit-Limit``,
+``X-RateLimit-Remaining`` and ``X-RateLimit-Reset`` headers Rocket.Chat
+returns for each endpoint, and by an optional global requests per second rate.
+'''
+import threading
+import time
+
+
+# Seconds to wait when the server gave no hint of when requests are allowed again
+DEFAULT_DELAY = 1.0
+
+
+class Bucket(object):
+    '''Token bucket refilled with ``rate`` tokens per second, up to ``capacity``'''
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.time()
+
+    def reserve(self, now):
+        '''
+        Takes a token and returns 0, otherwise returns seconds to wait until
+        there is one
+        '''
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class Window(object):
+    '''Requests left for an endpoint until its limit resets'''
+
+    def __init__(self):
+        self.limit = None
+        self.remaining = None
+        self.reset = None
+
+    def reserve(self, now):
+        '''
+        Takes one of the remaining requests and returns 0, otherwise returns
+        seconds to wait before trying again
+        '''
+        if self.reset is not None and now >= self.reset:
+            self.remaining, self.reset = self.limit, None
+        if self.remaining is None:
+            return 0.0
+        if self.remaining > 0:
+            self.remaining -= 1
+            return 0.0
+        if self.reset is None:
+            # No reset time to wait for, try again after a delay as on a 429
+            self.reset = now + DEFAULT_DELAY
+        return self.reset - now
+
+    def update(self, now, limit=None, remaining=None, reset=None,
+               rejected=False, retry_after=None):
+        '''Updates the window from the headers of a response'''
+        if limit is not None:
+            self.limit = limit
+        if remaining is not None:
+            # Other requests may have been sent since this one was answered
+            same_window = reset is None or reset == self.reset
+            if self.remaining is not None and same_window:
+                remaining = min(remaining, self.remaining)
+            self.remaining = remaining
+        if reset is not None:
+            self.reset = reset
+        if rejected:
+            self.remaining = 0
+            if retry_after is not None:
+                self.reset = max(self.reset or 0, now + retry_after)
+            elif self.reset is None or self.reset <= now:
+                self.reset = now + DEFAULT_DELAY
+
+
+class RateLimiter(object):
+    '''
+    Paces requests per endpoint and globally. Callers that would exceed a
+    limit are told how long to wait instead of being sent and rejected.
+
+    Usage::
+
+        >>> limiter = RateLimiter()
+        >>> limiter.wait('/api/v1/users.info')
+        >>> response = session.get(url)
+        >>> limiter.update('/api/v1/users.info', response.headers, response.status_code)
+    '''
+    def __init__(self):
+        self.windows = {}
+        self.bucket = None
+        self.lock = threading.Lock()
+        self.waited = 0.0
+        self.rejected = 0
+
+    def reserve(self, endpoint, rate=None):
+        '''
+        Reserves a request to the endpoint. Returns seconds to wait before
+        sending it, or 0 if it can be sent right away
+        '''
+        now = time.time()
+        with self.lock:
+            window = self.windows.setdefault(endpoint, Window())
+            delay = window.reserve(now)
+            if delay > 0 or not rate:
+                return delay
+            if self.bucket is None or self.bucket.rate != rate:
+                self.bucket = Bucket(rate)
+            delay = self.bucket.reserve(now)
+            if delay > 0 and window.remaining is not None:
+                # The request is not sent yet, give it back to the endpoint
+                window.remaining += 1
+            return delay
+
+    def wait(self, endpoint, rate=None):
+        '''Blocks until a request to the endpoint can be sent'''
+        while True:
+            delay = self.reserve(endpoint, rate)
+            if delay <= 0:
+                return
+            self.waited += delay
+            time.sleep(delay)
+
+    def update(self, endpoint, headers, status_code):
+        '''Updates limits of the endpoint from response headers'''
+        rejected = status_code == 429
+        with self.lock:
+            self.rejected += rejected
+            self.windows.setdefault(endpoint, Window()).update(
+                time.time(),
+                limit=parse_int(headers.get('X-RateLimit-Limit')),
+                remaining=parse_int(headers.get('X-RateLimit-Remaining')),
+                reset=parse_reset(headers.get('X-RateLimit-Reset')),
+                rejected=rejected,
+                retry_after=parse_int(headers.get('Retry-After')))
+
+    def clear(self):
+        with self.lock:
+            self.windows.clear()
+            self.bucket = None
+
+
+def parse_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_reset(value):
+    '''Rocket.Chat sends the reset time as epoch milliseconds'''
+    reset = parse_int(value)
+    if reset is not None and reset > 1e11:
+        return reset / 1000.0
+    return reset
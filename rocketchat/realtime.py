@@ -0,0 +1,294 @@
+'''
+Client for the Rocket.Chat realtime api: DDP over a websocket.
+
+Messages are pushed by the server as they are posted, instead of being polled
+with :class:`rocketchat.models.Messages`. The client logs in with the token of
+:class:`rocketchat.v1.Token`, reconnects when the connection drops, and on
+reconnect reads the messages it missed through the REST api.
+
+Requires ``aiohttp``.
+
+Usage::
+
+    >>> from rocketchat import realtime
+    >>> async def main():
+    ...     client = realtime.Realtime()
+    ...     await client.subscribe_room(rocketchat.channels()['general'])
+    ...     await client.subscribe_user('message')
+    ...     async for message in client.messages():
+    ...         print(message.msg)
+'''
+import asyncio
+import collections
+import datetime
+import itertools
+import json
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from . import aio, models, v1
+
+
+ROOM_MESSAGES = 'stream-room-messages'
+NOTIFY_USER = 'stream-notify-user'
+# Subscribes to messages of all rooms the user is in
+MY_MESSAGES = '__my_messages__'
+ROOM_TYPES = {v1.CHANNELS: 'c', v1.GROUPS: 'p', v1.DIRECT: 'd'}
+CHANNEL_TYPES = dict((t, channel_type) for channel_type, t in ROOM_TYPES.items())
+
+
+class RealtimeError(Exception):
+    def __init__(self, error):
+        if isinstance(error, dict):
+            error = error.get('reason') or error.get('message') or error.get('error')
+        super(RealtimeError, self).__init__(
+            'Rocket.Chat Realtime Error: {!r}'.format(error))
+
+
+def websocket_url(domain):
+    '''Returns the realtime api url of the given server domain'''
+    scheme, _, host = domain.rstrip('/').partition('://')
+    return '{}://{}/websocket'.format('wss' if scheme == 'https' else 'ws', host)
+
+
+def from_ejson(obj):
+    '''Converts EJSON dates, ``{"$date": ms}``, to the ISO strings of the REST api'''
+    if isinstance(obj, dict):
+        if list(obj.keys()) == ['$date']:
+            date = datetime.datetime.utcfromtimestamp(obj['$date'] / 1000.0)
+            return date.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+        return dict((k, from_ejson(v)) for k, v in obj.items())
+    if isinstance(obj, list):
+        return [from_ejson(v) for v in obj]
+    return obj
+
+
+def make_message(fields, channel_type=None):
+    fields = from_ejson(fields)
+    fields.setdefault('channel_type', channel_type)
+    return models.Message(**dict(
+        (k, v) for k, v in fields.items() if k in models.Message.__slots__))
+
+
+class Realtime(object):
+    '''
+    :param url: websocket url. Default: derived from the configured domain
+    :param reconnect_delay: seconds to wait before reconnecting, doubled
+        after each failed attempt up to ``max_reconnect_delay``
+    :param on_event: callback for stream events that are not messages, called
+        with the stream name, event name and arguments
+    '''
+    def __init__(self, url=None, reconnect_delay=1, max_reconnect_delay=30,
+                 on_event=None):
+        self.url = url
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.on_event = on_event
+        self.ws = None
+        self.reader = None
+        self.closed = False
+        self.user_id = None
+        self.ids = itertools.count(1)
+        self.pending = {}
+        self.subscriptions = collections.OrderedDict()
+        self.channel_types = {}
+        self.last_seen = {}
+        self.events = None
+
+    @property
+    def connected(self):
+        return self.ws is not None and not self.ws.closed
+
+    async def connect(self):
+        '''Opens the websocket, logs in, and restores all subscriptions'''
+        if self.events is None:
+            self.events = asyncio.Queue()
+        url = self.url or websocket_url(v1.api.get_config('domain'))
+        self.reader = None
+        self.ws = await aio.session.get_session().ws_connect(url)
+        try:
+            await self.send({'msg': 'connect', 'version': '1', 'support': ['1']})
+            while True:
+                frame = await self.ws.receive_json()
+                if frame.get('msg') == 'connected':
+                    break
+                if frame.get('msg') == 'failed':
+                    raise RealtimeError('DDP version not supported')
+            self.reader = asyncio.ensure_future(self.read())
+            await self.login()
+            for name, params in self.subscriptions.values():
+                await self.subscribe(name, *params)
+            await self.catch_up()
+        except BaseException:
+            # Left disconnected, so that messages() connects again
+            if self.reader is not None:
+                self.reader.cancel()
+            await self.ws.close()
+            raise
+
+    async def login(self):
+        loop = asyncio.get_event_loop()
+        token = await loop.run_in_executor(None, v1.Token.authenticate)
+        try:
+            result = await self.call('login', {'resume': token.authToken})
+        except RealtimeError:
+            token = await loop.run_in_executor(
+                None, v1.Token.reauthenticate, token.authToken)
+            result = await self.call('login', {'resume': token.authToken})
+        self.user_id = result['id']
+
+    async def close(self):
+        self.closed = True
+        if self.ws is not None:
+            await self.ws.close()
+        if self.events is not None:
+            await self.events.put(None)
+
+    async def send(self, frame):
+        await self.ws.send_str(json.dumps(frame))
+
+    async def request(self, frame):
+        '''Sends a frame with a new id and waits for the reply to it'''
+        frame['id'] = str(next(self.ids))
+        future = asyncio.get_event_loop().create_future()
+        self.pending[frame['id']] = future
+        await self.send(frame)
+        return await future
+
+    async def call(self, method, *params):
+        '''Calls a server method and returns its result'''
+        return await self.request(
+            {'msg': 'method', 'method': method, 'params': list(params)})
+
+    async def subscribe(self, name, *params):
+        '''Subscribes to a stream, also after reconnecting'''
+        self.subscriptions[(name, json.dumps(params))] = (name, params)
+        if self.connected:
+            await self.request({'msg': 'sub', 'name': name, 'params': list(params)})
+
+    async def subscribe_room(self, room):
+        '''Subscribes to new messages of the room, or of all rooms of the user'''
+        rid = getattr(room, '_id', room) or MY_MESSAGES
+        if getattr(room, 'CHANNEL_TYPE', None):
+            self.channel_types[rid] = room.CHANNEL_TYPE
+        await self.subscribe(ROOM_MESSAGES, rid, False)
+
+    async def subscribe_user(self, event='message'):
+        '''Subscribes to a notification stream of the user, such as ``message``'''
+        if self.user_id is None:
+            await self.connect()
+        await self.subscribe(
+            NOTIFY_USER, '{}/{}'.format(self.user_id, event), False)
+
+    async def read(self):
+        try:
+            async for frame in self.ws:
+                if frame.type != aiohttp.WSMsgType.TEXT:
+                    continue
+                data = json.loads(frame.data)
+                msg = data.get('msg')
+                if msg == 'ping':
+                    await self.send(dict(data, msg='pong'))
+                elif msg == 'result':
+                    self.resolve(data['id'], data.get('result'), data.get('error'))
+                elif msg == 'ready':
+                    for sub_id in data.get('subs', []):
+                        self.resolve(sub_id, sub_id)
+                elif msg == 'nosub':
+                    self.resolve(data['id'], None, data.get('error') or 'nosub')
+                elif msg == 'changed':
+                    await self.events.put(data)
+        finally:
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(RealtimeError('disconnected'))
+            self.pending.clear()
+            await self.events.put(None)
+
+    def resolve(self, request_id, result, error=None):
+        future = self.pending.pop(request_id, None)
+        if future is None or future.done():
+            return
+        if error:
+            future.set_exception(RealtimeError(error))
+        else:
+            future.set_result(result)
+
+    async def channel_type(self, rid):
+        '''Returns the channel type of the room, looked up once with rooms.info'''
+        if self.channel_types.get(rid) is None:
+            loop = asyncio.get_event_loop()
+            room = await loop.run_in_executor(None, lambda: v1.rooms_info(
+                params={'roomId': rid}).get())
+            self.channel_types[rid] = CHANNEL_TYPES.get((room or {}).get('t'))
+        return self.channel_types[rid]
+
+    async def catch_up(self):
+        '''Reads messages posted to the rooms while disconnected'''
+        loop = asyncio.get_event_loop()
+        watcher = models.RoomWatcher()
+        for rid, oldest in list(self.last_seen.items()):
+            try:
+                channel_type = await self.channel_type(rid)
+                room = {'_id': rid, 't': ROOM_TYPES.get(channel_type)}
+                missed = await loop.run_in_executor(
+                    None, watcher.history, room, oldest)
+            except v1.RocketChatError:
+                # The room may have been deleted, or the user removed from it
+                continue
+            for message in missed:
+                message.channel_type = channel_type
+            if missed:
+                await self.events.put({'msg': 'missed', 'messages': missed})
+
+    async def to_messages(self, event):
+        if event.get('msg') == 'missed':
+            return event['messages']
+        fields = event.get('fields', {})
+        name, args = fields.get('eventName', ''), fields.get('args', [])
+        if event.get('collection') == ROOM_MESSAGES or name.endswith('/message'):
+            messages = [arg for arg in args if isinstance(arg, dict) and 'rid' in arg]
+            # Messages of __my_messages__ come with the type of their room
+            room_types = [CHANNEL_TYPES.get(arg.get('roomType'))
+                          for arg in args if isinstance(arg, dict)]
+            for message, room_type in itertools.product(messages, room_types):
+                if room_type and self.channel_types.get(message['rid']) is None:
+                    self.channel_types[message['rid']] = room_type
+            result = []
+            for message in messages:
+                try:
+                    channel_type = await self.channel_type(message['rid'])
+                except v1.RocketChatError:
+                    channel_type = None
+                result.append(make_message(message, channel_type))
+            return result
+        if self.on_event:
+            self.on_event(event.get('collection'), name, args)
+        return []
+
+    async def messages(self):
+        '''
+        Async generator of new messages, reconnecting until :func:`close`
+        is called
+        '''
+        delay = self.reconnect_delay
+        while not self.closed:
+            if not self.connected:
+                try:
+                    await self.connect()
+                    delay = self.reconnect_delay
+                except (aiohttp.ClientError, OSError, RealtimeError):
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, self.max_reconnect_delay)
+                    continue
+            event = await self.events.get()
+            if event is None:
+                continue
+            for message in await self.to_messages(event):
+                if message.rid and message.ts:
+                    self.last_seen[message.rid] = max(
+                        self.last_seen.get(message.rid, ''), message.ts)
+                yield message
@@ -0,0 +1,194 @@
+'''
+Purge of messages older than a retention period, room by room.
+
+The history of a room is deleted in windows of time, oldest first, one
+``cleanHistory`` request per window. Windows grow while requests return
+quickly and shrink when they are slow or fail, so each request stays small
+enough for the server to complete. Failed requests are retried with backoff.
+Rooms are purged concurrently. A journal records how far each room was purged,
+so an interrupted purge resumes where it stopped.
+
+The policy gives the days of history kept: one number for all rooms, a dict
+by room name or id with ``'*'`` for the other rooms, or a function of the
+room. ``None`` keeps the whole history of a room.
+
+Usage::
+
+    >>> from rocketchat.retention import Retention
+    >>> retention = Retention({'*': 365, 'audit': None, 'random': 30},
+    ...                       journal='purge.jsonl', max_workers=2)
+    >>> print(retention.purge())
+    154 rooms, 2210356 messages deleted with 1893 requests in 3120.4s, 0 rooms failed
+'''
+import datetime
+import itertools
+import json
+import random
+import threading
+import time
+
+from concurrent import futures
+
+import requests
+
+from . import models, v1
+
+
+class Report(object):
+    '''Messages deleted per room, and errors of failed rooms'''
+
+    def __init__(self):
+        self.rooms = {}
+        self.errors = {}
+        self.requests = 0
+        self.started = time.time()
+        self.finished = None
+        self.lock = threading.Lock()
+
+    @property
+    def seconds(self):
+        return (self.finished or time.time()) - self.started
+
+    @property
+    def deleted(self):
+        return sum(self.rooms.values())
+
+    def add(self, rid, deleted):
+        with self.lock:
+            self.rooms[rid] = self.rooms.get(rid, 0) + deleted
+            self.requests += 1
+
+    def __str__(self):
+        return ('{} rooms, {} messages deleted with {} requests in {:.1f}s, '
+                '{} rooms failed').format(
+                    len(self.rooms), self.deleted, self.requests, self.seconds,
+                    len(self.errors))
+
+
+class Retention(object):
+    '''
+    :param policy: days of history kept, see above
+    :param journal: file recording how far rooms were purged, to resume from
+    :param max_workers: number of rooms purged at the same time
+    :param window: seconds of history deleted by the first request of a room
+    :param min_window: smallest window, when requests are slow or fail
+    :param max_window: largest window, when requests are fast
+    :param target: seconds a request should take
+    :param retries: times a window is attempted again. Default: ``RETRY_MAX``
+    '''
+    def __init__(self, policy, journal=None, max_workers=2, window=86400,
+                 min_window=60, max_window=90 * 86400, target=2, retries=None):
+        self.policy = policy
+        self.journal = journal
+        self.max_workers = max_workers
+        self.window = window
+        self.min_window = min_window
+        self.max_window = max_window
+        self.target = target
+        self.retries = v1.api.get_config('RETRY_MAX') if retries is None else retries
+        self.lock = threading.Lock()
+
+    def rooms(self):
+        '''All channels and groups of the user'''
+        return itertools.chain(models.Channel.channels, models.Channel.groups)
+
+    def days(self, room):
+        '''Days of history kept in the room, or None to keep all of it'''
+        if callable(self.policy):
+            return self.policy(room)
+        if isinstance(self.policy, dict):
+            for key in (room._id, room.name, '*'):
+                if key in self.policy:
+                    return self.policy[key]
+            return None
+        return self.policy
+
+    def read_journal(self):
+        '''Date up to which each room was purged by earlier runs'''
+        purged = {}
+        if not self.journal:
+            return purged
+        try:
+            with open(self.journal) as fobj:
+                for line in fobj:
+                    try:
+                        entry = json.loads(line)
+                        purged[entry['rid']] = max(
+                            entry['latest'], purged.get(entry['rid'], ''))
+                    except (ValueError, KeyError):
+                        continue
+        except (IOError, OSError):
+            pass
+        return purged
+
+    def record(self, rid, latest, deleted):
+        if self.journal:
+            with self.lock:
+                with open(self.journal, 'a') as fobj:
+                    fobj.write(json.dumps(
+                        {'rid': rid, 'latest': latest, 'deleted': deleted}) + '\n')
+
+    def purge(self, rooms=None):
+        '''
+        Purges the rooms, by default :func:`rooms`, and returns a
+        :class:`Report`
+        '''
+        report = Report()
+        purged = self.read_journal()
+        now = datetime.datetime.utcnow()
+        with futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            jobs = {}
+            for room in rooms if rooms is not None else self.rooms():
+                days = self.days(room)
+                if days is None:
+                    continue
+                cutoff = now - datetime.timedelta(days=days)
+                jobs[executor.submit(
+                    self.purge_room, room, purged.get(room._id), cutoff, report)] = room
+            for job in futures.as_completed(jobs):
+                try:
+                    job.result()
+                except Exception as error:
+                    report.errors[jobs[job]._id] = error
+        report.finished = time.time()
+        return report
+
+    def purge_room(self, room, start, cutoff, report):
+        '''
+        Deletes the messages of the room from ``start``, an ISO date, or from
+        its oldest message, to ``cutoff``
+        '''
+        if start is None:
+            oldest = next(room.messages.walk('forward', count=1), None)
+            if oldest is None:
+                return
+            start = oldest.ts
+        start = models.parse_date(start)
+        window, limit, attempt = self.window, self.max_window, 0
+        while start < cutoff:
+            latest = min(start + datetime.timedelta(seconds=window), cutoff)
+            began = time.time()
+            try:
+                response = room.messages.inclusive.by_daterange(
+                    models.format_date(start), models.format_date(latest)).delete()
+            except (v1.RocketChatError, requests.RequestException) as error:
+                status_code = getattr(error, 'status_code', None)
+                if status_code is not None and status_code < 500 and status_code != 429:
+                    raise
+                if attempt >= self.retries:
+                    raise
+                # Windows this large are not tried again in this room
+                window = limit = max(window / 2, self.min_window)
+                backoff = v1.api.get_config('RETRY_BACKOFF') * 2 ** attempt
+                time.sleep(random.uniform(
+                    0, min(backoff, v1.api.get_config('RETRY_BACKOFF_MAX'))))
+                attempt += 1
+                continue
+            deleted = (response or {}).get('count') or 0
+            report.add(room._id, deleted)
+            self.record(room._id, models.format_date(latest), deleted)
+            elapsed, attempt, start = time.time() - began, 0, latest
+            if elapsed < self.target / 2:
+                window = min(window * 2, limit)
+            elif elapsed > self.target:
+                window = max(window / 2, self.min_window)
@@ -0,0 +1,66 @@
+'''
+Retrying of failed requests with jittered exponential backoff
+'''
+import collections
+import random
+import threading
+
+
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'])
+
+
+class RetryPolicy(object):
+    '''
+    Decides whether a failed request is sent again and how long to wait
+    before that. Requests are retried when they failed with a connection
+    error or one of the ``RETRY_STATUSES``, and resending them is safe:
+    the method is idempotent, the endpoint is listed in ``idempotent``,
+    or the request never reached the server.
+
+    :param get_config: callable returning config values
+    :param idempotent: endpoint names, such as ``chat.getMessage``, that are
+        safe to POST more than once
+
+    Counts retries, give-ups once ``RETRY_MAX`` is reached, and failures
+    that are not retried because resending them is not safe.
+    '''
+    def __init__(self, get_config, idempotent=None):
+        self.get_config = get_config
+        self.idempotent = frozenset(idempotent or [])
+        self.stats = collections.Counter()
+        self.lock = threading.Lock()
+
+    def is_idempotent(self, method, endpoint):
+        return (method.upper() in IDEMPOTENT_METHODS or
+                endpoint.rsplit('/', 1)[-1] in self.idempotent)
+
+    def is_failure(self, status_code=None, error=None):
+        return (error is not None or
+                status_code in (self.get_config('RETRY_STATUSES') or []))
+
+    def delay(self, method, endpoint, attempt, status_code=None, error=None,
+              sent=True):
+        '''
+        Returns seconds to wait before sending the request again, or None
+        if it should not be retried
+
+        :param attempt: number of retries made so far
+        :param status_code: response status code, if there was a response
+        :param error: exception raised sending the request
+        :param sent: False if the request failed before reaching the server
+        '''
+        if not self.is_failure(status_code, error):
+            return None
+        if sent and not self.is_idempotent(method, endpoint):
+            self.count('unsafe')
+            return None
+        if attempt >= (self.get_config('RETRY_MAX') or 0):
+            self.count('giveups')
+            return None
+        self.count('retries')
+        backoff = self.get_config('RETRY_BACKOFF') * 2 ** attempt
+        return random.uniform(0, min(backoff, self.get_config('RETRY_BACKOFF_MAX')))
+
+    def count(self, key):
+        with self.lock:
+            self.stats[key] += 1
@@ -0,0 +1,180 @@
+'''
+Routing of inbound messages to the handlers whose triggers they match.
+
+Each message is looked at once: the ids of the users it mentions are
+collected, and its text is scanned for all trigger keywords in a single pass
+(Aho-Corasick). Only handlers triggered by those, or by the room, are then
+checked, so routing costs about the same with a few or hundreds of triggers.
+
+Usage::
+
+    >>> router = Router()
+    >>> router.add(Handler(on_deploy, keywords=['deploy', 'roll back']))
+    >>> router.add(Handler(on_mention, mention=True))
+    >>> for handler, match in router.route(message, user_id=me._id):
+    ...     handler.func(message, match)
+'''
+import collections
+import re
+
+import six
+
+
+class KeywordIndex(object):
+    '''
+    Aho-Corasick automaton finding every occurrence of many keywords in one
+    pass over a text. Keywords are matched case-insensitively and, if
+    ``whole_words`` is True, only when not part of a longer word.
+    '''
+    def __init__(self, keywords=(), whole_words=True):
+        self.whole_words = whole_words
+        self.goto = [{}]
+        self.fail = [0]
+        self.terminal = [[]]
+        self.output = [[]]
+        self.built = True
+        for keyword in keywords:
+            self.add(keyword)
+
+    def add(self, keyword):
+        keyword = keyword.lower()
+        state = 0
+        for char in keyword:
+            next_state = self.goto[state].get(char)
+            if next_state is None:
+                next_state = len(self.goto)
+                self.goto[state][char] = next_state
+                self.goto.append({})
+                self.fail.append(0)
+                self.terminal.append([])
+                self.output.append([])
+            state = next_state
+        if keyword not in self.terminal[state]:
+            self.terminal[state].append(keyword)
+        self.built = False
+
+    def build(self):
+        '''Links each state to the longest suffix of it that is a state too'''
+        queue = collections.deque(self.goto[0].values())
+        for state in queue:
+            self.fail[state] = 0
+            self.output[state] = self.terminal[state]
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fail = self.fail[state]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                fail = self.goto[fail].get(char, 0)
+                self.fail[next_state] = fail if fail != next_state else 0
+                self.output[next_state] = (
+                    self.terminal[next_state] + self.output[self.fail[next_state]])
+        self.built = True
+
+    def find(self, text):
+        '''Returns the set of keywords found in the text'''
+        if not self.built:
+            self.build()
+        text = text.lower()
+        found = set()
+        state = 0
+        for end, char in enumerate(text):
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            for keyword in self.output[state]:
+                if not self.whole_words or self.is_word(text, end + 1 - len(keyword), end + 1):
+                    found.add(keyword)
+        return found
+
+    @staticmethod
+    def is_word(text, start, end):
+        return ((start == 0 or not text[start - 1].isalnum()) and
+                (end == len(text) or not text[end].isalnum()))
+
+
+class Handler(object):
+    '''
+    A handler is triggered by messages matching all of its conditions.
+
+    :param func: called with the message, and the regex match or None
+    :param room: room id, or list of room ids, the messages must be posted in
+    :param mention: if True, messages must mention the bot
+    :param keywords: words or phrases, one of which the message must contain
+    :param pattern: regex the message text must match
+    '''
+    def __init__(self, func, room=None, mention=False, keywords=None, pattern=None):
+        self.func = func
+        self.rooms = set([room] if isinstance(room, six.string_types) else room or [])
+        self.mention = mention
+        self.keywords = set(keyword.lower() for keyword in keywords or [])
+        self.pattern = re.compile(pattern) if pattern else None
+
+    def match(self, message, mentioned, found):
+        '''
+        Returns (matches, regex match) for the message, given whether it
+        mentions the bot and the keywords found in it
+        '''
+        if self.rooms and message.rid not in self.rooms:
+            return False, None
+        if self.mention and not mentioned:
+            return False, None
+        if self.keywords and not self.keywords & found:
+            return False, None
+        if self.pattern is None:
+            return True, None
+        match = self.pattern.search(message.msg or '')
+        return match is not None, match
+
+
+class Router(object):
+    '''
+    Index of handlers by their most selective trigger: a keyword, a mention,
+    a room, or none for handlers checked against every message
+    '''
+    def __init__(self):
+        self.handlers = []
+        self.keywords = KeywordIndex()
+        self.by_keyword = collections.defaultdict(list)
+        self.by_room = collections.defaultdict(list)
+        self.by_mention = []
+        self.unindexed = []
+
+    def add(self, handler):
+        number = len(self.handlers)
+        self.handlers.append(handler)
+        if handler.keywords:
+            for keyword in handler.keywords:
+                self.keywords.add(keyword)
+                self.by_keyword[keyword].append(number)
+        elif handler.mention:
+            self.by_mention.append(number)
+        elif handler.rooms:
+            for rid in handler.rooms:
+                self.by_room[rid].append(number)
+        else:
+            self.unindexed.append(number)
+        return handler
+
+    def route(self, message, user_id=None):
+        '''
+        Returns (handler, regex match) of the handlers triggered by the
+        message, in the order they were added
+        '''
+        mentions = set(mention.get('_id') for mention in message.mentions or [])
+        mentioned = user_id is not None and user_id in mentions
+        found = self.keywords.find(message.msg or '') if self.by_keyword else set()
+        candidates = set(self.unindexed)
+        candidates.update(self.by_room.get(message.rid, ()))
+        if mentioned:
+            candidates.update(self.by_mention)
+        for keyword in found:
+            candidates.update(self.by_keyword[keyword])
+        routes = []
+        for number in sorted(candidates):
+            handler = self.handlers[number]
+            matches, match = handler.match(message, mentioned, found)
+            if matches:
+                routes.append((handler, match))
+        return routes
@@ -0,0 +1,204 @@
+'''
+Client state, such as the date of the last message read in each channel.
+
+Values are read from memory and written behind: changes are collected and
+flushed together after ``CACHE_FLUSH_INTERVAL`` seconds, and when the process
+exits. Backends store them:
+
+- :class:`SQLiteBackend`, the default, keeps the state of all channels in one
+  SQLite file. Each flush is one transaction, and each key is its own row, so
+  processes sharing the file do not overwrite each other's changes.
+- :class:`JSONBackend` keeps one JSON file per channel, as earlier versions did.
+
+Usage::
+
+    >>> rocketchat.configure(config={'CACHE_BACKEND': 'json'})
+    >>> store = StateStore()
+    >>> store.set('GENERAL:general', 'last_message_dt', '2018-01-01')
+    >>> store.flush()
+'''
+import atexit
+import json
+import os
+import sqlite3
+import threading
+
+from . import v1
+
+
+# Marks keys deleted since the last flush
+DELETED = object()
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS state (
+    identifier TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (identifier, key)
+);
+'''
+
+
+class JSONBackend(object):
+    '''One JSON file per identifier in ``~/.cosmicray/rocketchat/cache``'''
+
+    def load(self, identifier):
+        try:
+            with open(v1.api.cache_dir(identifier)) as fobj:
+                return json.load(fobj)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def save(self, changes):
+        for identifier, values in changes.items():
+            data = self.load(identifier)
+            apply_changes(data, values)
+            fpath = v1.api.cache_dir(identifier)
+            # Written aside and renamed, readers never see a partial file
+            with open(fpath + '.tmp', 'w') as fobj:
+                json.dump(data, fobj)
+            os.rename(fpath + '.tmp', fpath)
+
+
+class SQLiteBackend(object):
+    '''
+    :param path: database file. Default: ``~/.cosmicray/rocketchat/state.db``
+    '''
+    def __init__(self, path=None):
+        self.path = path or v1.api.home_dir('state.db')
+        self._db = None
+        self.lock = threading.RLock()
+
+    @property
+    def db(self):
+        '''
+        Connection opened once and shared by the threads that load and flush,
+        each flush timer being a new thread. Only used under :attr:`lock`
+        '''
+        with self.lock:
+            if self._db is None:
+                db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+                db.execute('PRAGMA journal_mode=WAL')
+                db.executescript(SCHEMA)
+                self._db = db
+            return self._db
+
+    def load(self, identifier):
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT key, value FROM state WHERE identifier = ?',
+                (identifier,)).fetchall()
+        data = dict((key, json.loads(value)) for key, value in rows)
+        if not data:
+            # State left by the JSON files of earlier versions
+            data = JSONBackend().load(identifier)
+        return data
+
+    def save(self, changes):
+        with self.lock, self.db as db:
+            for identifier, values in changes.items():
+                for key, value in values.items():
+                    if value is DELETED:
+                        db.execute(
+                            'DELETE FROM state WHERE identifier = ? AND key = ?',
+                            (identifier, key))
+                    else:
+                        db.execute(
+                            'INSERT OR REPLACE INTO state VALUES (?, ?, ?)',
+                            (identifier, key, json.dumps(value)))
+
+
+BACKENDS = {'sqlite': SQLiteBackend, 'json': JSONBackend}
+
+
+def apply_changes(data, values):
+    for key, value in values.items():
+        if value is DELETED:
+            data.pop(key, None)
+        else:
+            data[key] = value
+
+
+class StateStore(object):
+    '''
+    In-memory state of all identifiers, written behind to a backend
+
+    :param backend: backend instance. Default: from ``CACHE_BACKEND``
+    '''
+    def __init__(self, backend=None):
+        self._backend = backend
+        self.data = {}
+        self.dirty = {}
+        self.timer = None
+        self.lock = threading.RLock()
+        self.flush_lock = threading.Lock()
+        atexit.register(self.flush)
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            self._backend = BACKENDS[v1.api.get_config('CACHE_BACKEND')]()
+        return self._backend
+
+    def load(self, identifier):
+        '''Returns the state of the identifier, read from the backend once'''
+        with self.lock:
+            if identifier not in self.data:
+                self.data[identifier] = self.backend.load(identifier)
+            return self.data[identifier]
+
+    def get(self, identifier, key, default=None):
+        return self.load(identifier).get(key, default)
+
+    def set(self, identifier, key, value):
+        with self.lock:
+            self.load(identifier)[key] = value
+            self.dirty.setdefault(identifier, {})[key] = value
+        self.schedule()
+
+    def delete(self, identifier, key):
+        with self.lock:
+            del self.load(identifier)[key]
+            self.dirty.setdefault(identifier, {})[key] = DELETED
+        self.schedule()
+
+    def schedule(self):
+        '''Flushes after the flush interval, coalescing changes made meanwhile'''
+        interval = v1.api.get_config('CACHE_FLUSH_INTERVAL')
+        if not interval:
+            return self.flush()
+        with self.lock:
+            if self.timer is None:
+                self.timer = threading.Timer(interval, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        '''Writes all pending changes to the backend'''
+        with self.flush_lock:
+            with self.lock:
+                changes, self.dirty = self.dirty, {}
+                if self.timer is not None:
+                    self.timer.cancel()
+                    self.timer = None
+            if not changes:
+                return
+            try:
+                self.backend.save(changes)
+            except Exception:
+                with self.lock:
+                    # Kept for the next flush, unless changed since
+                    for identifier, values in changes.items():
+                        pending = self.dirty.setdefault(identifier, {})
+                        for key, value in values.items():
+                            pending.setdefault(key, value)
+                raise
+
+    def clear(self):
+        '''Flushes pending changes and forgets the state read so far'''
+        self.flush()
+        with self.lock:
+            self.data.clear()
+
+
+store = StateStore()
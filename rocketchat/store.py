@@ -0,0 +1,230 @@
+'''
+Local SQLite store of room messages.
+
+Rooms are synced incrementally: the store remembers, per room, the range of
+history it holds, and only requests messages newer than that range. Queries
+are then answered from the local database, and message text is searched with
+a SQLite FTS5 full-text index kept up to date as messages are stored.
+
+Usage::
+
+    >>> store = MessageStore()
+    >>> room = rocketchat.channels()['general']
+    >>> store.sync(room)
+    >>> store.recent(room._id, count=10)
+    >>> store.by_user('foo', since='2018-01-01')
+    >>> store.search('deploy failed', room='general', since='2018-01-01')
+'''
+import json
+import sqlite3
+import threading
+
+from . import models, v1
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS messages (
+    _id TEXT PRIMARY KEY,
+    rid TEXT NOT NULL,
+    ts TEXT NOT NULL,
+    user_id TEXT,
+    username TEXT,
+    msg TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_rid_ts ON messages (rid, ts);
+CREATE INDEX IF NOT EXISTS messages_username_ts ON messages (username, ts);
+CREATE TABLE IF NOT EXISTS rooms (
+    rid TEXT PRIMARY KEY,
+    channel_type TEXT,
+    oldest TEXT NOT NULL,
+    latest TEXT,
+    name TEXT
+);
+CREATE INDEX IF NOT EXISTS rooms_name ON rooms (name);
+'''
+
+FTS_SCHEMA = '''
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+    msg, content='messages', content_rowid='rowid');
+CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts (rowid, msg) VALUES (new.rowid, new.msg);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+    INSERT INTO messages_fts (messages_fts, rowid, msg)
+    VALUES ('delete', old.rowid, old.msg);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE ON messages BEGIN
+    INSERT INTO messages_fts (messages_fts, rowid, msg)
+    VALUES ('delete', old.rowid, old.msg);
+    INSERT INTO messages_fts (rowid, msg) VALUES (new.rowid, new.msg);
+END;
+'''
+
+
+def to_fts_query(text):
+    '''
+    Quotes each word of the text as an FTS5 string, so all of them must
+    match and none is read as query syntax
+    '''
+    return ' '.join('"{}"'.format(word.replace('"', '""')) for word in text.split())
+
+
+def to_like_pattern(word):
+    '''LIKE pattern matching the word anywhere, with wildcards escaped'''
+    for char in '\\%_':
+        word = word.replace(char, '\\' + char)
+    return '%{}%'.format(word)
+
+
+class MessageStore(object):
+    '''
+    :param path: database file. Default: ``~/.cosmicray/rocketchat/messages.db``
+    :param count: number of messages requested per history page
+    '''
+    def __init__(self, path=None, count=100):
+        self.path = path or v1.api.home_dir('messages.db')
+        self.count = count
+        self.local = threading.local()
+        self.fts = True
+
+    @property
+    def db(self):
+        '''SQLite connection of the current thread'''
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            db.executescript(SCHEMA)
+            self.create_index(db)
+            self.local.db = db
+        return db
+
+    def create_index(self, db):
+        '''Creates the full-text index, and fills it if messages predate it'''
+        exists = db.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'").fetchone()
+        try:
+            db.executescript(FTS_SCHEMA)
+        except sqlite3.OperationalError:
+            # SQLite built without FTS5, search falls back to scanning
+            self.fts = False
+            return
+        if not exists:
+            with db:
+                db.execute(
+                    "INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+
+    @property
+    def has_index(self):
+        '''True if the database has a full-text index'''
+        return self.db is not None and self.fts
+
+    def close(self):
+        db = getattr(self.local, 'db', None)
+        if db is not None:
+            db.close()
+            self.local.db = None
+
+    def add(self, messages):
+        '''Inserts or updates the given messages'''
+        with self.db:
+            # An upsert rather than a replace, to run the index triggers
+            self.db.executemany(
+                'INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT (_id) DO UPDATE SET rid = excluded.rid, '
+                'ts = excluded.ts, user_id = excluded.user_id, '
+                'username = excluded.username, msg = excluded.msg, '
+                'data = excluded.data',
+                ((m._id, m.rid, m.ts, (m.u or {}).get('_id'),
+                  (m.u or {}).get('username'), m.msg, json.dumps(m.dict))
+                 for m in messages))
+
+    def watermarks(self, rid):
+        '''Returns the (oldest, latest) dates of the synced history of the room'''
+        row = self.db.execute(
+            'SELECT oldest, latest FROM rooms WHERE rid = ?', (rid,)).fetchone()
+        return row or (None, None)
+
+    def sync(self, channel, since=None):
+        '''
+        Stores messages posted to the channel since the last sync, and returns
+        how many were stored. The first sync of a room reads its history back
+        to ``since``, or to the beginning if not given.
+        '''
+        oldest, latest = self.watermarks(channel._id)
+        if oldest is None:
+            oldest = since or ''
+        messages = channel.messages.by_daterange(latest or oldest or None, None)
+        stored, newest, batch = 0, latest, []
+        for message in messages.walk(count=self.count):
+            newest = max(newest or '', message.ts)
+            batch.append(message)
+            if len(batch) == self.count:
+                self.add(batch)
+                stored, batch = stored + len(batch), []
+        self.add(batch)
+        stored += len(batch)
+        with self.db:
+            self.db.execute(
+                'INSERT OR REPLACE INTO rooms VALUES (?, ?, ?, ?, ?)',
+                (channel._id, channel.CHANNEL_TYPE, oldest, newest, channel.name))
+        return stored
+
+    def query(self, where, args, count=None, desc=False, tables='messages'):
+        sql = 'SELECT messages.data FROM {} WHERE {} ORDER BY ts {}'.format(
+            tables, where, 'DESC' if desc else 'ASC')
+        if count:
+            sql += ' LIMIT {:d}'.format(count)
+        return [models.Message(**json.loads(data))
+                for data, in self.db.execute(sql, args)]
+
+    def recent(self, rid, count=20):
+        '''Returns the last ``count`` messages of the room, oldest first'''
+        return self.query('rid = ?', (rid,), count=count, desc=True)[::-1]
+
+    def by_daterange(self, rid, start=None, end=None):
+        '''Returns messages of the room posted from start up to end'''
+        return self.query(
+            'rid = ? AND ts >= ? AND ts < ?', (rid, start or '', end or '~'))
+
+    def by_user(self, username, rid=None, since=None, count=None):
+        '''Returns messages posted by the user, in one room or in all of them'''
+        where, args = 'username = ? AND ts >= ?', [username, since or '']
+        if rid:
+            where, args = where + ' AND rid = ?', args + [rid]
+        return self.query(where, args, count=count)
+
+    def search(self, text, room=None, username=None, since=None, until=None,
+               count=50):
+        '''
+        Returns the most recent messages containing all words of the text
+
+        :param room: id or name of the room to search in. Default: all rooms
+        :param username: author of the messages
+        :param since: date of the oldest message
+        :param until: date the messages were posted before
+        '''
+        if not text or not text.split():
+            return []
+        where = ['ts >= ?', 'ts < ?']
+        args = [since or '', until or '~']
+        if room:
+            where.append(
+                '(rid = ? OR rid IN (SELECT rid FROM rooms WHERE name = ?))')
+            args.extend([room, room])
+        if username:
+            where.append('username = ?')
+            args.append(username)
+        if self.has_index:
+            where.append('messages_fts MATCH ?')
+            args.append(to_fts_query(text))
+            tables = ('messages_fts JOIN messages '
+                      'ON messages.rowid = messages_fts.rowid')
+        else:
+            where.extend(["msg LIKE ? ESCAPE '\\'"] * len(text.split()))
+            args.extend(to_like_pattern(word) for word in text.split())
+            tables = 'messages'
+        return self.query(
+            ' AND '.join(where), args, count=count, desc=True, tables=tables)
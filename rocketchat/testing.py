@@ -0,0 +1,433 @@
+'''
+Local stand-in for a Rocket.Chat server, to exercise the clients without one.
+
+It serves the realtime api (DDP over websocket) at ``/websocket``, and the
+REST routes the realtime and asyncio clients rely on: login, users, room info,
+listing and history, posting messages, opening direct rooms, inviting and
+kicking. Users, rooms and messages are kept in memory, and messages are pushed
+to subscribers as they are posted. Rooms are public channels unless added with
+another type by :func:`add_room`, and, as on a real server, they are only
+served by the routes of their own type.
+
+Requires ``aiohttp``.
+
+Usage::
+
+    >>> from rocketchat import realtime, testing
+    >>> async def main():
+    ...     server = testing.Server()
+    ...     await server.start()
+    ...     rocketchat.configure(domain=server.url)
+    ...     client = realtime.Realtime()
+    ...     await client.subscribe_room('GENERAL')
+    ...     server.post('GENERAL', 'hello')
+    ...     async for message in client.messages():
+    ...         print(message.msg)
+'''
+import asyncio
+import collections
+import datetime
+import itertools
+import json
+import time
+
+try:
+    from aiohttp import web
+except ImportError:
+    web = None
+
+
+ROOM_TYPES = {'channels': 'c', 'groups': 'p', 'im': 'd'}
+# Key of the room in the responses of each room type
+ROOM_KEYS = {'channels': 'channel', 'groups': 'group', 'im': 'room'}
+
+
+def to_ejson_date(timestamp):
+    return {'$date': int(timestamp * 1000)}
+
+
+def to_iso_date(timestamp):
+    date = datetime.datetime.utcfromtimestamp(timestamp)
+    return date.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+
+def matches(record, query):
+    '''True if the record matches the Mongo query, of fields, $in and $or'''
+    for key, value in query.items():
+        if key == '$or':
+            if not any(matches(record, alternative) for alternative in value):
+                return False
+        elif isinstance(value, dict) and '$in' in value:
+            if record.get(key) not in value['$in']:
+                return False
+        elif record.get(key) != value:
+            return False
+    return True
+
+
+def project(record, fields):
+    '''Fields of the record kept by the Mongo projection'''
+    if not fields:
+        return record
+    if any(fields.values()):
+        return dict((k, v) for k, v in record.items() if k == '_id' or fields.get(k))
+    return dict((k, v) for k, v in record.items() if k not in fields)
+
+
+def page(items, query):
+    '''Listing response of the items, paged by offset and count'''
+    offset = int(query.get('offset', 0))
+    count = int(query.get('count', 50))
+    return items[offset:offset + count], len(items)
+
+
+class Server(object):
+    '''
+    :param host: interface to listen on
+    :param port: port to listen on. Default: any free port
+    :param user_id: id of the user every login is accepted for
+    :param username: username of that user
+    '''
+    def __init__(self, host='127.0.0.1', port=0, user_id='stand-in-user',
+                 username='stand-in'):
+        self.host = host
+        self.port = port
+        self.user_id = user_id
+        self.username = username
+        self.tokens = set()
+        self.messages = collections.defaultdict(list)
+        self.rooms = {}
+        self.names = {}
+        self.members = collections.defaultdict(set)
+        self.users = {}
+        self.add_user(username, user_id)
+        # Rooms whose message streams are refused, as when the user was
+        # removed from them
+        self.refused = set()
+        self.connections = set()
+        self.ids = itertools.count(1)
+        self.runner = None
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(self.host, self.port)
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/websocket', self.websocket)
+        app.router.add_post('/api/v1/login', self.login)
+        app.router.add_get('/api/v1/me', self.me)
+        app.router.add_get('/api/v1/users.info', self.user_info)
+        app.router.add_get('/api/v1/users.list', self.user_list)
+        app.router.add_post('/api/v1/chat.postMessage', self.post_message)
+        app.router.add_post('/api/v1/im.create', self.im_create)
+        app.router.add_get('/api/v1/rooms.info', self.room_info)
+        app.router.add_get('/api/v1/{channel_type}.info', self.channel_info)
+        app.router.add_get('/api/v1/{channel_type}.list', self.channel_list)
+        app.router.add_get('/api/v1/{channel_type}.history', self.history)
+        app.router.add_get('/api/v1/{channel_type}.messages', self.channel_messages)
+        app.router.add_post('/api/v1/{channel_type}.invite', self.invite)
+        app.router.add_post('/api/v1/{channel_type}.kick', self.kick)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+        self.port = self.runner.addresses[0][1]
+
+    async def stop(self):
+        await self.drop_connections()
+        await self.runner.cleanup()
+
+    async def drop_connections(self):
+        '''Closes all websockets, as a server restart would'''
+        for connection in list(self.connections):
+            await connection.ws.close()
+
+    def expire_tokens(self):
+        self.tokens.clear()
+
+    def add_user(self, username, _id=None, **fields):
+        '''Adds a user, returns its record'''
+        user = dict(fields, _id=_id or 'id-{}'.format(username), username=username)
+        self.users[username] = user
+        return user
+
+    def add_room(self, rid, t='c', name=None, usernames=()):
+        '''Adds a room of type ``c`` (channel), ``p`` (group) or ``d`` (direct)'''
+        self.rooms[rid] = t
+        self.names[rid] = name
+        self.members[rid].update(usernames)
+
+    def find_user(self, _id=None, username=None):
+        return next((user for user in self.users.values()
+                     if user['_id'] == _id or user['username'] == username), None)
+
+    def find_room(self, query, channel_type):
+        '''Id of the room of the type given by roomId or roomName, or None'''
+        rid = query.get('roomId') or next(
+            (rid for rid, name in self.names.items()
+             if name and name == query.get('roomName')), None)
+        if self.rooms.get(rid) == ROOM_TYPES.get(channel_type):
+            return rid
+
+    def to_room(self, rid):
+        return {'_id': rid, 'rid': rid, 't': self.rooms[rid], 'name': self.names.get(rid),
+                'usernames': sorted(self.members[rid])}
+
+    def post(self, rid, text, username='someone', ts=None):
+        '''Stores a message and pushes it to the room's subscribers'''
+        self.rooms.setdefault(rid, 'c')
+        ts = ts or time.time()
+        message = {
+            '_id': 'msg{}'.format(next(self.ids)),
+            'rid': rid,
+            'msg': text,
+            'ts': ts,
+            'u': {'_id': 'id-{}'.format(username), 'username': username},
+        }
+        self.messages[rid].append(message)
+        for connection in list(self.connections):
+            connection.push(message)
+        return message
+
+    def to_api(self, message, as_ejson):
+        convert = to_ejson_date if as_ejson else to_iso_date
+        return dict(message, ts=convert(message['ts']),
+                    _updatedAt=convert(message['ts']))
+
+    async def login(self, request):
+        token = 'token{}'.format(next(self.ids))
+        self.tokens.add(token)
+        return web.json_response({'status': 'success', 'data': {
+            'authToken': token, 'userId': self.user_id}})
+
+    def unauthorized(self, request):
+        if request.headers.get('X-Auth-Token') not in self.tokens:
+            return web.json_response(
+                {'status': 'error', 'message': 'You must be logged in to do this.'},
+                status=401)
+
+    def error(self, error, error_type=None):
+        return web.json_response(
+            {'success': False, 'error': error, 'errorType': error_type}, status=400)
+
+    async def me(self, request):
+        denied = self.unauthorized(request)
+        if denied is not None:
+            return denied
+        return web.json_response(dict(self.users[self.username], success=True))
+
+    async def user_info(self, request):
+        denied = self.unauthorized(request)
+        if denied is not None:
+            return denied
+        user = self.find_user(request.query.get('userId'), request.query.get('username'))
+        if user is None:
+            return self.error('User not found.', 'error-invalid-user')
+        return web.json_response({'success': True, 'user': user})
+
+    async def user_list(self, request):
+        denied = self.unauthorized(request)
+        if denied is not None:
+            return denied
+        query = request.query
+        users = [project(user, json.loads(query.get('fields', '{}')))
+                 for user in self.users.values()
+                 if matches(user, json.loads(query.get('query', '{}')))]
+        users, total = page(users, query)
+        return web.json_response({'success': True, 'users': users, 'total': total})
+
+    async def post_message(self, request):
+        denied = self.unauthorized(request)
+        if denied is not None:
+            return denied
+        body = await request.json()
+        if body.get('roomId') not in self.rooms:
+            return self.room_not_found()
+        message = self.post(body['roomId'], body['text'], username=self.username)
+        return web.json_response(
+            {'success': True, 'message': self.to_api(message, False)})
+
+    async def im_create(self, request):
+        denied = self.unauthorized(request)
+        if denied is not None:
+            return denied
+        user = self.find_user(username=(await request.json()).get('username'))
+        if user is None:
+            return self.error('Failed to create direct message', 'error-invalid-user')
+        rid = ''.join(sorted([self.user_id, user['_id']]))
+        self.add_room(rid, 'd', usernames=[self.username, user['username']])
+        return web.json_response({'success': True, 'room': self.to_room(rid)})
+
+    def room_not_found(self):
+        return web.json_response({
+            'success': False, 'errorType': 'error-room-not-found',
+            'error': 'The required "roomId" or "roomName" param provided does '
+                     'not match any room [error-room-not-found]'}, status=400)
+
+    async def room_info(self, request):
+        denied = self.unauthorized(request)
+        if denied is not None:
+            return denied
+        rid = request.query.get('roomId')
+        if rid not in self.rooms:
+            return self.room_not_found()
+        return web.json_response(
+            {'success': True, 'room': {'_id': rid, 't': self.rooms[rid]}})
+
+    async def channel_info(self, request):
+        denied = self.unauthorized(request)
+        if denied is not None:
+            return denied
+        channel_type = request.match_info['channel_type']
+        rid = self.find_room(request.query, channel_type)
+        if rid is None:
+            return self.room_not_found()
+        return web.json_response(
+            {'success': True, ROOM_KEYS[channel_type]: self.to_room(rid)})
+
+    async def channel_list(self, request):
+        denied = self.unauthorized(request)
+        if denied is not None:
+            return denied
+        channel_type = request.match_info['channel_type']
+        if channel_type not in ROOM_TYPES:
+            return web.json_response({'success': False}, status=404)
+        query = request.query
+        rooms = [project(self.to_room(rid), json.loads(query.get('fields', '{}')))
+                 for rid, t in sorted(self.rooms.items())
+                 if t == ROOM_TYPES[channel_type]]
+        rooms, total = page(rooms, query)
+        key = 'ims' if channel_type == 'im' else channel_type
+        return web.json_response({'success': True, key: rooms, 'total': total})
+
+    async def history(self, request):
+        denied = self.unauthorized(request)
+        if denied is not None:
+            return denied
+        query = request.query
+        rid = self.find_room(query, request.match_info['channel_type'])
+        if rid is None:
+            return self.room_not_found()
+        inclusive = query.get('inclusive', '').lower() == 'true'
+        oldest, latest = query.get('oldest'), query.get('latest')
+        messages = [self.to_api(m, False) for m in self.messages[rid]]
+        messages = [m for m in messages
+                    if (not oldest or m['ts'] > oldest or inclusive and m['ts'] == oldest) and
+                    (not latest or m['ts'] < latest or inclusive and m['ts'] == latest)]
+        messages.sort(key=lambda m: m['ts'], reverse=True)
+        return web.json_response({
+            'success': True, 'messages': messages[:int(query.get('count', 20))]})
+
+    async def channel_messages(self, request):
+        denied = self.unauthorized(request)
+        if denied is not None:
+            return denied
+        query = request.query
+        rid = self.find_room(query, request.match_info['channel_type'])
+        if rid is None:
+            return self.room_not_found()
+        ts = json.loads(query.get('query', '{}')).get('ts', {})
+        oldest = ts.get('$gte', {}).get('$date', float('-inf')) / 1000.0
+        latest = ts.get('$lte', {}).get('$date', float('inf')) / 1000.0
+        messages = sorted((m for m in self.messages[rid] if oldest <= m['ts'] <= latest),
+                          key=lambda m: m['ts'],
+                          reverse=json.loads(query.get('sort', '{}')).get('ts') == -1)
+        messages, total = page([self.to_api(m, False) for m in messages], query)
+        return web.json_response(
+            {'success': True, 'messages': messages, 'total': total})
+
+    async def change_member(self, request, add):
+        denied = self.unauthorized(request)
+        if denied is not None:
+            return denied
+        channel_type = request.match_info['channel_type']
+        body = await request.json()
+        rid = self.find_room(body, channel_type)
+        if rid is None:
+            return self.room_not_found()
+        user = self.find_user(_id=body.get('userId'))
+        if user is None:
+            return self.error('The required "userId" param provided does not '
+                              'match any users', 'error-invalid-user')
+        if add:
+            self.members[rid].add(user['username'])
+        else:
+            self.members[rid].discard(user['username'])
+        return web.json_response(
+            {'success': True, ROOM_KEYS[channel_type]: self.to_room(rid)})
+
+    async def invite(self, request):
+        return await self.change_member(request, True)
+
+    async def kick(self, request):
+        return await self.change_member(request, False)
+
+    async def websocket(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        connection = Connection(self, ws)
+        self.connections.add(connection)
+        try:
+            async for frame in ws:
+                await connection.handle(json.loads(frame.data))
+        finally:
+            self.connections.discard(connection)
+        return ws
+
+
+class Connection(object):
+    '''DDP session of one websocket client'''
+
+    def __init__(self, server, ws):
+        self.server = server
+        self.ws = ws
+        self.user_id = None
+        self.subscriptions = {}
+
+    async def send(self, frame):
+        await self.ws.send_str(json.dumps(frame))
+
+    async def handle(self, frame):
+        msg = frame.get('msg')
+        if msg == 'connect':
+            await self.send({'msg': 'connected', 'session': str(id(self))})
+        elif msg == 'ping':
+            await self.send(dict(frame, msg='pong'))
+        elif msg == 'method' and frame['method'] == 'login':
+            token = frame['params'][0].get('resume')
+            if token in self.server.tokens:
+                self.user_id = self.server.user_id
+                await self.send({'msg': 'result', 'id': frame['id'], 'result': {
+                    'id': self.user_id, 'token': token}})
+            else:
+                await self.send({'msg': 'result', 'id': frame['id'], 'error': {
+                    'error': 403, 'reason': "You've been logged out by the server."}})
+        elif msg == 'method':
+            await self.send({'msg': 'result', 'id': frame['id'], 'error': {
+                'error': 404, 'reason': 'Method not found'}})
+        elif msg == 'sub':
+            if self.user_id is None:
+                await self.send({'msg': 'nosub', 'id': frame['id'], 'error': {
+                    'error': 'not-authorized'}})
+            elif frame['params'] and frame['params'][0] in self.server.refused:
+                await self.send({'msg': 'nosub', 'id': frame['id'], 'error': {
+                    'error': 'error-not-allowed', 'reason': 'Not allowed'}})
+            else:
+                self.subscriptions[frame['id']] = (frame['name'], frame['params'])
+                await self.send({'msg': 'ready', 'subs': [frame['id']]})
+        elif msg == 'unsub':
+            self.subscriptions.pop(frame['id'], None)
+
+    def push(self, message):
+        for name, params in self.subscriptions.values():
+            if name == 'stream-room-messages' and params[0] in (
+                    message['rid'], '__my_messages__'):
+                args = [self.server.to_api(message, True)]
+                if params[0] == '__my_messages__':
+                    args.append({'roomParticipant': True,
+                                 'roomType': self.server.rooms[message['rid']]})
+                asyncio.ensure_future(self.send({
+                    'msg': 'changed', 'collection': name, 'id': 'id',
+                    'fields': {'eventName': message['rid'], 'args': args}}))
+                return
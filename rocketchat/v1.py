@@ -1,7 +1,25 @@
+import contextlib
 import json
 import os
+import threading
+import time
+
+from concurrent import futures
 
 import cosmicray
+import requests
+
+from requests.packages.urllib3.exceptions import (
+    ConnectTimeoutError, NewConnectionError)
+from six.moves.urllib.parse import urlparse
+
+from . import ratelimit, retry
+
+try:
+    import fcntl
+except ImportError:
+    # No cross-process locking of the token file on this platform
+    fcntl = None
 
 
 api = cosmicray.Cosmicray('rocketchat')
@@ -15,6 +33,41 @@ os.environ['RCHAT_USER'] = ''
 os.environ['RCHAT_PASSWORD'] = ''
 # Store token response to file
 api.config['AUTH_STORE_TOKEN'] = True
+# Users cache: seconds before an entry expires and max number of entries
+api.config['USER_CACHE_TTL'] = 300
+api.config['USER_CACHE_SIZE'] = 10000
+# Number of uncached users from which models.User.resolve fetches them with
+# users.list queries instead of one users.info request each
+api.config['USER_RESOLVE_QUERY_MIN'] = 10
+# Number of items requested per page by listing endpoints
+api.config['PAGE_SIZE'] = 100
+# Max requests per second over all endpoints, None for no client side limit
+api.config['RATE_LIMIT_PER_SECOND'] = None
+# Times a request rejected with 429 is queued and sent again
+api.config['RATE_LIMIT_RETRIES'] = 3
+# Retries of requests failing with a connection error or one of RETRY_STATUSES,
+# waiting a random time of up to RETRY_BACKOFF * 2 ** retry seconds
+api.config['RETRY_MAX'] = 3
+api.config['RETRY_STATUSES'] = [502, 503, 504]
+api.config['RETRY_BACKOFF'] = 0.5
+api.config['RETRY_BACKOFF_MAX'] = 30
+# Connection pools: number of hosts to keep pools for, connections kept per
+# host, whether to wait for a free connection instead of opening a throwaway
+# one, seconds idle connections are kept open (0 disables keep-alive), and the
+# default request timeout in seconds
+api.config['HTTP_POOL_CONNECTIONS'] = 10
+api.config['HTTP_POOL_MAXSIZE'] = 10
+api.config['HTTP_POOL_BLOCK'] = False
+api.config['HTTP_KEEP_ALIVE'] = 60
+api.config['HTTP_TIMEOUT'] = None
+# Backend of the channels state (sqlite or json), and seconds changes are held
+# in memory before being written together (0 writes them right away)
+api.config['CACHE_BACKEND'] = 'sqlite'
+api.config['CACHE_FLUSH_INTERVAL'] = 1.0
+# Rooms models.send_queue sends to at the same time, and seconds it waits for
+# more messages to a room to join them into one (0 never joins them)
+api.config['SEND_QUEUE_WORKERS'] = 4
+api.config['SEND_QUEUE_COALESCE'] = 0
 
 MESSAGE = 'chat'
 CHANNELS = 'channels'
@@ -38,6 +91,17 @@ PLURAL_OBJECT_RESPONSE_MAP = {
     USERS: 'users'
 }
 
+# POST endpoints that are safe to send more than once
+IDEMPOTENT_POSTS = set(
+    ['chat.getMessage', 'im.create', 'integrations.list', 'users.getAvatar',
+     'users.update'] +
+    ['{}.{}'.format(channel_type, action)
+     for channel_type in [CHANNELS, GROUPS, DIRECT]
+     for action in ['open', 'close', 'addAll', 'invite', 'kick', 'archive',
+                    'unarchive', 'setDescription', 'setPurpose',
+                    'setReadOnly', 'setTopic', 'setType']])
+
+
 def authenticator(request):
     # All requests must be authenticated except for login and info
     if not request.is_request_for(login, info):
@@ -48,6 +112,186 @@ def authenticator(request):
     return request
 
 
+class Session(requests.Session):
+    '''
+    Paces requests to stay within the rate limits reported by the server, and
+    resends requests rejected with 429 once the limit resets.
+    Retries requests that failed with a connection error or a gateway error,
+    see :class:`rocketchat.retry.RetryPolicy`.
+    Logs in again and replays the request once when the server rejects the
+    token of an authenticated request with 401.
+    Closes the pooled connections when no request was sent for
+    ``HTTP_KEEP_ALIVE`` seconds.
+    '''
+    rate_limiter = ratelimit.RateLimiter()
+    retry_policy = retry.RetryPolicy(api.get_config, IDEMPOTENT_POSTS)
+
+    def __init__(self):
+        super(Session, self).__init__()
+        self.pool_settings = None
+        self.last_used = time.time()
+        self.lock = threading.Lock()
+        self.configure()
+
+    def configure(self):
+        '''
+        Mounts connection pools sized by the ``HTTP_POOL_*`` settings, if
+        they changed since the pools were mounted
+        '''
+        pool_settings = (api.get_config('HTTP_POOL_CONNECTIONS'),
+                         api.get_config('HTTP_POOL_MAXSIZE'),
+                         api.get_config('HTTP_POOL_BLOCK'))
+        if pool_settings != self.pool_settings:
+            for adapter in self.adapters.values():
+                adapter.close()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=pool_settings[0],
+                pool_maxsize=pool_settings[1],
+                pool_block=pool_settings[2])
+            self.mount('https://', adapter)
+            self.mount('http://', adapter)
+            self.pool_settings = pool_settings
+        if api.get_config('HTTP_KEEP_ALIVE'):
+            self.headers.pop('Connection', None)
+        else:
+            self.headers['Connection'] = 'close'
+
+    def request(self, method, url, headers=None, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = api.get_config('HTTP_TIMEOUT')
+        response = self.send_retried(method, url, headers, **kwargs)
+        if response.status_code == 401 and headers and 'X-Auth-Token' in headers:
+            token = Token.reauthenticate(headers['X-Auth-Token'])
+            headers = dict(headers, **{
+                'X-Auth-Token': token.authToken,
+                'X-User-Id': token.userId})
+            response = self.send_retried(method, url, headers, **kwargs)
+        return response
+
+    def send_retried(self, method, url, headers, **kwargs):
+        endpoint = urlparse(url).path
+        attempt = 0
+        while True:
+            failure = None
+            try:
+                response = self.send_paced(method, url, headers, **kwargs)
+                delay = self.retry_policy.delay(
+                    method, endpoint, attempt, status_code=response.status_code)
+            except (requests.ConnectionError, requests.Timeout) as error:
+                failure = error
+                delay = self.retry_policy.delay(
+                    method, endpoint, attempt, error=error, sent=is_sent(error))
+            if delay is None:
+                if failure is not None:
+                    raise failure
+                return response
+            time.sleep(delay)
+            attempt += 1
+
+    def send_paced(self, method, url, headers, **kwargs):
+        endpoint = urlparse(url).path
+        retries = api.get_config('RATE_LIMIT_RETRIES') or 0
+        for _ in range(retries + 1):
+            self.rate_limiter.wait(
+                endpoint, api.get_config('RATE_LIMIT_PER_SECOND'))
+            self.close_idle()
+            response = super(Session, self).request(
+                method, url, headers=headers, **kwargs)
+            self.rate_limiter.update(
+                endpoint, response.headers, response.status_code)
+            if response.status_code != 429:
+                break
+        return response
+
+    def close_idle(self):
+        '''
+        Closes the pooled connections if no request was sent for
+        ``HTTP_KEEP_ALIVE`` seconds, as the server may have dropped them
+        '''
+        keep_alive = api.get_config('HTTP_KEEP_ALIVE')
+        with self.lock:
+            now = time.time()
+            idle, self.last_used = now - self.last_used, now
+        if keep_alive and idle > keep_alive:
+            for adapter in set(self.adapters.values()):
+                adapter.close()
+
+
+api.session = Session()
+
+
+def is_sent(error):
+    '''False if the request failed before it could reach the server'''
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return False
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return not isinstance(reason, (ConnectTimeoutError, NewConnectionError))
+
+
+def json_param(value, context):
+    '''Encodes a ``fields`` or ``query`` parameter given as a dict to JSON'''
+    return json.dumps(value) if isinstance(value, dict) else value
+
+
+# Optional Mongo projection, such as {"usernames": 0}, and Mongo query of
+# listing routes, as dicts or JSON strings
+LIST_PARAMS = [
+    cosmicray.Param('fields', default=json_param),
+    cosmicray.Param('query', default=json_param)]
+
+
+# Total of the last listing response handled by each thread, see paginate
+listing = threading.local()
+
+
+def paginate(request, count=None, prefetch=False):
+    '''
+    Generator that pages through a listing request with the ``offset`` and
+    ``count`` query parameters and yields the items one at a time, up to the
+    ``total`` of the responses. Only the current page is held in memory. If
+    ``prefetch`` is True, the next page is requested in the background while
+    the current one is consumed.
+
+    Usage::
+
+        >>> for user in paginate(users_list(models.User), prefetch=True):
+        ...     print(user.username)
+    '''
+    count = count or api.get_config('PAGE_SIZE')
+
+    def fetch(offset):
+        page = request.route(
+            request.model_cls, urlargs=request.urlargs, headers=request.headers,
+            params=dict(request.params, offset=offset, count=count))
+        listing.total = None
+        return list(page.get() or []), listing.total
+
+    executor = futures.ThreadPoolExecutor(max_workers=1) if prefetch else None
+    try:
+        offset, (page, total) = 0, fetch(0)
+        # The server may cap count, so a short page is not the last one. Without
+        # a total, only an empty page marks the end
+        while page:
+            offset += len(page)
+            last = total is not None and offset >= total
+            following = executor.submit(fetch, offset) if executor and not last else None
+            for item in page:
+                yield item
+            if last:
+                return
+            page, total = following.result() if following else fetch(offset)
+    finally:
+        if executor:
+            executor.shutdown(wait=False)
+
+
+def validate_listing(response):
+    '''Validates a listing response, and keeps its total for :func:`paginate`'''
+    jdata = validate_response(response)
+    listing.total = jdata.get('total')
+    return jdata
+
+
 def validate_response(response):
     try:
         jdata = response.json()
@@ -219,12 +463,23 @@ def channels_private_messages(response):
     return validate_response(response).get(PLURAL_OBJECT_RESPONSE_MAP[MESSAGE])
 
 
-@api.route('/api/v1/im.list.everyone', ['GET'])
+@api.route('/api/v1/im.list.everyone', ['GET'], params=LIST_PARAMS)
 def channels_private_rooms(response):
     """Lists all private channels in the server.
     NOTE: Requires the permission ``view-room-administration``.
     """
-    return validate_response(response).get('ims')
+    return validate_listing(response).get('ims')
+
+
+@api.route('/api/v1/im.create', ['POST'])
+def im_create(response):
+    """Create a direct message session with another user."""
+    room = validate_response(response).get('room')
+    # Older servers only return the id as rid, which rooms have no field for
+    if room and 'rid' in room:
+        rid = room.pop('rid')
+        room.setdefault('_id', rid)
+    return room
 
 
 @api.route('/api/v1/channels.cleanHistory', ['POST'])
@@ -233,10 +488,16 @@ def channels_remove_messages(response):
     return validate_response(response)
 
 
-@api.route('/api/v1/channels.list.joined', ['GET'])
+@api.route('/api/v1/rooms.cleanHistory', ['POST'])
+def rooms_clean_history(response):
+    '''Cleans up the history of any room type, requires special permission.'''
+    return validate_response(response)
+
+
+@api.route('/api/v1/channels.list.joined', ['GET'], params=LIST_PARAMS)
 def channels_list_joined(response):
     '''Gets only the channels the calling user has joined.'''
-    return validate_response(response).get(CHANNELS)
+    return validate_listing(response).get(CHANNELS)
 
 
 @api.route('/api/v1/channels.setJoinCode', ['POST'])
@@ -245,19 +506,22 @@ def channels_set_join_code(response):
     return validate_response(response)
 
 
-@api.route('/api/v1/{channel_type}.list', ['GET'], urlargs=[
-    cosmicray.Param('channel_type', options=[CHANNELS, GROUPS, DIRECT])])
+@api.route('/api/v1/{channel_type}.list', ['GET'], params=LIST_PARAMS,
+           urlargs=[cosmicray.Param(
+               'channel_type', options=[CHANNELS, GROUPS, DIRECT])])
 def channels_list(context, response):
     '''Retrives all of the channels from the server.'''
     key = PLURAL_OBJECT_RESPONSE_MAP.get(context.urlargs['channel_type'])
-    return validate_response(response).get(key)
+    return validate_listing(response).get(key)
 
 
 @api.route('/api/v1/{channel_type}.info', ['GET'], params=[
     # Required (if no roomName) The channels id
     cosmicray.Param('roomId'),
     # Required (if no roomId) The channels name
-    cosmicray.Param('roomName')], urlargs=[
+    cosmicray.Param('roomName'),
+    # Optional Mongo projection of the channel
+    cosmicray.Param('fields', default=json_param)], urlargs=[
         cosmicray.Param('channel_type', options=[CHANNELS, GROUPS])])
 def channels_info(context, response):
     ''' Gets a channels information.'''
@@ -294,6 +558,29 @@ def channels_messages(context, response):
     return messages
 
 
+@api.route('/api/v1/{channel_type}.messages', ['GET'],
+           params=[
+               # Required The channels id
+               cosmicray.Param('roomId', required=True),
+               # Optional Mongo query on the messages, such as a ts range
+               cosmicray.Param('query', default=json_param),
+               # Optional Sort order, such as {"ts": 1}
+               cosmicray.Param('sort'),
+               cosmicray.Param('offset'),
+               cosmicray.Param('count')
+           ],
+           urlargs=[
+               cosmicray.Param(
+                   'channel_type', options=[CHANNELS, DIRECT, GROUPS])
+           ])
+def channels_list_messages(context, response):
+    """Lists the messages of a channel, filtered and sorted on the server."""
+    messages = validate_listing(response).get(PLURAL_OBJECT_RESPONSE_MAP[MESSAGE])
+    for message in messages:
+        message['channel_type'] = context.urlargs['channel_type']
+    return messages
+
+
 @api.route('/api/v1/{channel_type}.open', ['POST'], urlargs=[
     cosmicray.Param('channel_type', options=[CHANNELS, GROUPS, DIRECT])
 ])
@@ -446,6 +733,38 @@ def channels_set_type(context, response):
     return validate_response(response).get(key)
 
 
+# https://rocket.chat/docs/developer-guides/rest-api/rooms
+
+
+@api.route('/api/v1/rooms.get', ['GET'], params=[
+    # Optional Only rooms updated after this date
+    cosmicray.Param('updatedSince')])
+def rooms_get(response):
+    '''Get all rooms of the user, or only the ones updated since a date.'''
+    return validate_response(response)
+
+
+@api.route('/api/v1/rooms.info', ['GET'], params=[
+    # Required (if no roomName) The room id
+    cosmicray.Param('roomId'),
+    # Required (if no roomId) The room name
+    cosmicray.Param('roomName')])
+def rooms_info(response):
+    '''Gets the information of a room of any type.'''
+    return validate_response(response).get('room')
+
+
+# https://rocket.chat/docs/developer-guides/rest-api/subscriptions
+
+
+@api.route('/api/v1/subscriptions.get', ['GET'], params=[
+    # Optional Only subscriptions updated after this date
+    cosmicray.Param('updatedSince')])
+def subscriptions_get(response):
+    '''Get all subscriptions of the user, or only the ones updated since a date.'''
+    return validate_response(response)
+
+
 # https://rocket.chat/docs/developer-guides/rest-api/settings
 
 
@@ -491,16 +810,17 @@ def users_get_presence(response):
 
 
 @api.route('/api/v1/users.info', ['GET'], params=[
-    cosmicray.Param('userId'), cosmicray.Param('username')])
+    cosmicray.Param('userId'), cosmicray.Param('username'),
+    cosmicray.Param('fields', default=json_param)])
 def users_info(response):
     """Gets a user's information, limited to the caller's permissions."""
     return validate_response(response).get(OBJECT_RESPONSE_MAP[USERS])
 
 
-@api.route('/api/v1/users.list', ['GET'])
+@api.route('/api/v1/users.list', ['GET'], params=LIST_PARAMS)
 def users_list(response):
     """All of the users and their information, limited to permissions."""
-    return validate_response(response).get(PLURAL_OBJECT_RESPONSE_MAP[USERS])
+    return validate_listing(response).get(PLURAL_OBJECT_RESPONSE_MAP[USERS])
 
 
 @api.route('/api/v1/users.register', ['POST'])
@@ -536,6 +856,7 @@ class Token(cosmicray.model.Model):
         '_credentials',
     ]
     token = None
+    lock = threading.RLock()
 
     @property
     def credentials(self):
@@ -566,15 +887,57 @@ class Token(cosmicray.model.Model):
 
     @classmethod
     def authenticate(cls):
-        if Token.token is None:
-            Token.token = Token().read_from_storage()
-        if not Token.token:
-            Token.token = Token().create()
-            Token.token.write_to_storage()
+        '''
+        Returns the current token. Only one thread logs in if there is none,
+        and only one process if tokens are stored to file.
+        '''
+        if Token.token:
+            return Token.token
+        with Token.lock:
+            if not Token.token:
+                Token.token = Token().load_or_create()
+        return Token.token
+
+    @classmethod
+    def reauthenticate(cls, auth_token):
+        '''
+        Replaces the given expired token. Threads that find it already
+        replaced use the new token instead of logging in again.
+        '''
+        with Token.lock:
+            if not Token.token or Token.token.authToken == auth_token:
+                Token.token = Token().load_or_create(expired=auth_token)
         return Token.token
 
+    def load_or_create(self, expired=None):
+        '''
+        Returns token stored by another process, unless it is the expired
+        one, otherwise logs in and stores the new token
+        '''
+        with self.storage_lock():
+            token = self.read_from_storage()
+            if not token or token.authToken == expired:
+                token = self.create()
+                token.write_to_storage()
+        return token
+
+    @contextlib.contextmanager
+    def storage_lock(self):
+        '''Exclusive lock on the token file shared by all processes'''
+        if not api.config['AUTH_STORE_TOKEN'] or fcntl is None:
+            yield
+            return
+        fpath = api.config['AUTH_TOKEN_FILENAME'].format(user=self.user)
+        with open(fpath + '.lock', 'a') as fobj:
+            fcntl.flock(fobj, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fobj, fcntl.LOCK_UN)
+
     @classmethod
     def clear_from_storage(cls):
+        Token.token = None
         fpath = api.config['AUTH_TOKEN_FILENAME'].format(user=Token().user)
         cosmicray.util.write_artifact_file(fpath, 'session-expired')
 
@@ -582,8 +945,9 @@ class Token(cosmicray.model.Model):
         if api.config['AUTH_STORE_TOKEN']:
             try:
                 fpath = api.config['AUTH_TOKEN_FILENAME'].format(user=self.user)
-                data = cosmicray.util.read_artifact_file(fpath, json.loads)
-                return Token(**data)
+                # Read from disk, the file may have been written by another process
+                with open(fpath) as fobj:
+                    return Token(**json.load(fobj))
             except Exception as error:
                 pass
 
@@ -594,7 +958,10 @@ class Token(cosmicray.model.Model):
 
 
 class RocketChatError(Exception):
-    def __init__(self, error, error_type, status_code):
+    def __init__(self, error, error_type, status_code=None):
+        self.error = error
+        self.error_type = error_type
+        self.status_code = status_code
         message = 'Rocket.Chat Error {!r}: {!r} [{!r}]'.format(
             error_type, error, status_code)
         super(RocketChatError, self).__init__(message)
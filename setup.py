@@ -23,6 +23,9 @@ REQUIRED = [
     'cosmicray>=0.0.9',
     'six==1.11.0'
 ]
+EXTRAS = {
+    'aio': ['aiohttp>=3.0']
+}
 
 here = os.path.abspath(os.path.dirname(__file__))
 
@@ -82,6 +85,7 @@ setup(
     url=URL,
     packages=PACKAGES,
     install_requires=REQUIRED,
+    extras_require=EXTRAS,
     include_package_data=True,
     license='MIT',
     classifiers=[
@@ -0,0 +1,102 @@
+import collections
+import datetime
+import inspect
+import json
+import os
+import tempfile
+import threading
+
+# cosmicray still calls inspect.getargspec, removed in Python 3.11
+if not hasattr(inspect, 'getargspec'):
+    inspect.getargspec = inspect.getfullargspec
+
+os.environ['HOME'] = tempfile.mkdtemp()
+
+import pytest
+import requests
+
+from requests.adapters import BaseAdapter
+from six.moves.urllib.parse import parse_qs, urlparse
+
+from rocketchat import models, v1
+
+
+os.environ['RCHAT_USER'] = 'bot'
+os.environ['RCHAT_PASSWORD'] = 'password'
+v1.api.config['AUTH_STORE_TOKEN'] = False
+v1.api.config['AUTH_CREDS_FROM_ENV'] = True
+v1.api.config['RETRY_BACKOFF'] = 0.01
+
+
+class FakeServer(BaseAdapter):
+    '''
+    Transport adapter answering REST requests with the handler registered for
+    their path. Handlers are called with the query parameters and JSON body,
+    and return the response data, or a (status code, data) tuple. The headers
+    of the request being handled are in ``local.headers``.
+    '''
+    def __init__(self):
+        super(FakeServer, self).__init__()
+        self.handlers = {}
+        self.calls = collections.Counter()
+        self.local = threading.local()
+        self.route('/api/v1/login', lambda query, body: {
+            'status': 'success', 'data': {'authToken': 'token', 'userId': 'U0'}})
+        self.route('/api/v1/me', lambda query, body: {
+            'success': True, '_id': 'U0', 'username': 'bot'})
+
+    def route(self, path, handler):
+        self.handlers[path] = handler
+
+    def send(self, request, **kwargs):
+        url = urlparse(request.url)
+        self.calls[url.path] += 1
+        query = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+        body = json.loads(request.body) if request.body else {}
+        self.local.headers = request.headers
+        handler = self.handlers.get(url.path)
+        if handler is None:
+            status, data = 404, {'success': False, 'error': 'Not found'}
+        else:
+            result = handler(query, body)
+            status, data = result if isinstance(result, tuple) else (200, result)
+        response = requests.Response()
+        response.status_code = status
+        response._content = json.dumps(data).encode()
+        response.url = request.url
+        response.request = request
+        response.elapsed = datetime.timedelta(0)
+        return response
+
+    def close(self):
+        pass
+
+
+def reset():
+    v1.Token.token = None
+    models.user_cache.clear()
+    models.direct_rooms.clear()
+    # Static relationships such as User.me keep the first value they fetched
+    for cls in (models.User, models.Channel):
+        for attr in vars(cls).values():
+            if getattr(attr, 'is_static', False):
+                attr._static = None
+
+
+@pytest.fixture(autouse=True)
+def clean_state():
+    reset()
+    yield
+    reset()
+
+
+@pytest.fixture
+def server():
+    session = v1.api.session
+    adapters = dict(session.adapters)
+    fake = FakeServer()
+    session.mount('http://', fake)
+    session.mount('https://', fake)
+    yield fake
+    session.adapters.clear()
+    session.adapters.update(adapters)
@@ -0,0 +1,126 @@
+import asyncio
+
+import pytest
+
+import rocketchat
+
+from rocketchat import aio, models, store, testing, v1
+
+pytest.importorskip('aiohttp')
+
+EPOCH = 1514764800
+
+
+def run(test):
+    async def main():
+        server = testing.Server()
+        await server.start()
+        domain = v1.api.get_config('domain')
+        rocketchat.configure(domain=server.url)
+        try:
+            await test(server)
+        finally:
+            await aio.close()
+            await server.stop()
+            rocketchat.configure(domain=domain)
+    asyncio.run(main())
+
+
+async def collect(iterator):
+    return [item async for item in iterator]
+
+
+def test_looked_up_users_are_async():
+    async def test(server):
+        server.add_user('foo')
+        message = aio.Message(u={'_id': 'id-foo'})
+        user = await message.user
+        assert isinstance(user, aio.User) and user.username == 'foo'
+        await user.send('hello foo')
+        cached = await aio.User.lookup(username='foo')
+        assert isinstance(cached, aio.User) and cached._id == 'id-foo'
+        room, = [rid for rid, t in server.rooms.items() if t == 'd']
+        assert [m['msg'] for m in server.messages[room]] == ['hello foo']
+    run(test)
+
+
+def test_iter_all_pages_with_prefetch(monkeypatch):
+    monkeypatch.setitem(v1.api.config, 'PAGE_SIZE', 2)
+
+    async def test(server):
+        for i in range(5):
+            server.add_user('user{}'.format(i))
+        for prefetch in (False, True):
+            users = await collect(aio.User.iter_all(prefetch=prefetch))
+            assert sorted(user.username for user in users) == [
+                'stand-in', 'user0', 'user1', 'user2', 'user3', 'user4']
+            assert all(isinstance(user, aio.User) for user in users)
+    run(test)
+
+
+def test_iter_all_with_fields_and_query():
+    async def test(server):
+        for i in range(3):
+            server.add_user('user{}'.format(i), name='User {}'.format(i))
+        user, = await collect(aio.User.iter_all(
+            fields={'username': 1}, query={'name': 'User 1'}))
+        assert user.username == 'user1'
+        with pytest.raises(AttributeError):
+            user.name
+        await user.load()
+        assert user.name == 'User 1'
+
+        server.add_room('C1', 'c', name='general', usernames=['user0', 'user1'])
+        channel, = await collect(aio.Channel.iter_all(fields={'usernames': 0}))
+        assert channel.name == 'general'
+        with pytest.raises(AttributeError):
+            channel.usernames
+        await channel.load()
+        assert channel.usernames == ['user0', 'user1']
+        assert [user.username for user in await channel.users] == ['user0', 'user1']
+    run(test)
+
+
+def test_walk():
+    async def test(server):
+        server.add_room('C1', 'c')
+        for i, second in enumerate([1, 2, 2, 3, 4, 4, 4, 5, 6, 7]):
+            server.post('C1', 'message {}'.format(i), ts=EPOCH + second)
+        messages = aio.Channel(_id='C1').messages
+        backward = await collect(messages.walk(count=3))
+        forward = await collect(messages.walk('forward', count=3))
+        assert sorted(m.msg for m in backward) == sorted(m.msg for m in forward)
+        assert len(set(m._id for m in backward)) == 10
+        assert [m.ts for m in backward] == sorted((m.ts for m in backward), reverse=True)
+        assert [m.msg for m in forward] == ['message {}'.format(i) for i in range(10)]
+        assert all(isinstance(m, aio.Message) for m in forward + backward)
+    run(test)
+
+
+def test_sync_members():
+    async def test(server):
+        for username in ('foo', 'bar', 'baz'):
+            server.add_user(username)
+        server.add_room('C1', 'c', name='general',
+                        usernames=['stand-in', 'foo', 'bar'])
+        channel = aio.Channel(_id='C1')
+        assert await channel.sync_members(['baz', 'foo'], dry_run=True) == {
+            'baz': 'invite', 'bar': 'kick'}
+        assert server.members['C1'] == set(['stand-in', 'foo', 'bar'])
+        result = await channel.sync_members(['baz', 'foo', 'nobody'])
+        assert result['baz'] == 'invited' and result['bar'] == 'kicked'
+        assert isinstance(result['nobody'], v1.RocketChatError)
+        assert server.members['C1'] == set(['stand-in', 'foo', 'baz'])
+    run(test)
+
+
+def test_sync_to_message_store(tmp_path):
+    async def test(server):
+        server.add_room('C1', 'c', name='general')
+        for i in range(5):
+            server.post('C1', 'message {}'.format(i), ts=EPOCH + i)
+        messages = store.MessageStore(path=str(tmp_path / 'messages.db'), count=2)
+        assert await aio.Channel(_id='C1', name='general').messages.sync(messages) == 5
+        assert [m.msg for m in messages.search('message', room='general')] == [
+            'message {}'.format(i) for i in reversed(range(5))]
+    run(test)
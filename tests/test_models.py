@@ -0,0 +1,280 @@
+import json
+import threading
+
+import pytest
+
+from rocketchat import models, v1
+
+
+def timestamp(second):
+    return '2018-01-01T00:00:{:02d}.000Z'.format(second)
+
+
+def make_messages(seconds):
+    return [{'_id': 'M{}'.format(i), 'rid': 'GENERAL', 'msg': 'message {}'.format(i),
+             'ts': timestamp(second)} for i, second in enumerate(seconds)]
+
+
+def history(messages):
+    '''channels.history: newest first, up to latest, from oldest on'''
+    def handler(query, body):
+        inclusive = query.get('inclusive') == 'True'
+        oldest, latest = query.get('oldest'), query.get('latest')
+        page = [m for m in messages
+                if (not oldest or m['ts'] > oldest or inclusive and m['ts'] == oldest) and
+                (not latest or m['ts'] < latest or inclusive and m['ts'] == latest)]
+        page.sort(key=lambda m: m['ts'], reverse=True)
+        return {'success': True, 'messages': page[:int(query['count'])]}
+    return handler
+
+
+def list_messages(messages):
+    '''channels.messages: filtered by the ts range of the query, oldest first'''
+    def handler(query, body):
+        ts = json.loads(query['query'])['ts'] if 'query' in query else {}
+        page = [m for m in messages
+                if ts.get('$gte', {'$date': 0})['$date'] <=
+                models.to_ejson_date(m['ts'])['$date'] <=
+                ts.get('$lte', {'$date': float('inf')})['$date']]
+        page.sort(key=lambda m: m['ts'])
+        return {'success': True, 'messages': page[:int(query['count'])],
+                'total': len(page)}
+    return handler
+
+
+def walk(server, seconds, direction, count, **daterange):
+    messages = make_messages(seconds)
+    server.route('/api/v1/channels.history', history(messages))
+    server.route('/api/v1/channels.messages', list_messages(messages))
+    channel = models.Channel(_id='GENERAL')
+    walked = channel.messages
+    if daterange:
+        walked = walked.by_daterange(daterange.get('start'), daterange.get('end'))
+    return [m.msg for m in walked.walk(direction, count=count)]
+
+
+def test_walk_backward_yields_each_message_once(server):
+    walked = walk(server, [1, 2, 2, 3, 4, 4, 4, 5, 6, 7], 'backward', 3)
+    assert walked == ['message {}'.format(i) for i in
+                      [9, 8, 7, 4, 5, 6, 3, 1, 2, 0]]
+
+
+def test_walk_forward_yields_each_message_once(server):
+    walked = walk(server, [1, 2, 2, 3, 4, 4, 4, 5, 6, 7], 'forward', 3)
+    assert walked == ['message {}'.format(i) for i in range(10)]
+
+
+def test_walk_past_more_messages_on_one_date_than_fit_a_page(server):
+    walked = walk(server, [1] + [2] * 7 + [3], 'backward', 2)
+    assert len(walked) == len(set(walked)) == 9
+
+
+def test_walk_within_a_daterange(server):
+    walked = walk(server, range(10), 'backward', 3,
+                  start=timestamp(2), end=timestamp(6))
+    assert walked == ['message {}'.format(i) for i in [5, 4, 3]]
+
+
+def post_message(posted, release=None):
+    def handler(query, body):
+        if release is not None:
+            release.wait(5)
+        posted.append((body['roomId'], body['text']))
+        return {'success': True, 'message': {
+            '_id': 'M{}'.format(len(posted)), 'rid': body['roomId'],
+            'msg': body['text']}}
+    return handler
+
+
+def test_send_queue_keeps_the_order_of_each_room(server):
+    posted = []
+    server.route('/api/v1/chat.postMessage', post_message(posted))
+    queue = models.SendQueue(workers=4, coalesce=0)
+    sent = [queue.send(rid, '{} {}'.format(rid, i))
+            for i in range(20) for rid in ('A', 'B', 'C')]
+    queue.join()
+    assert all(future.result().msg for future in sent)
+    for rid in ('A', 'B', 'C'):
+        assert [text for room, text in posted if room == rid] == [
+            '{} {}'.format(rid, i) for i in range(20)]
+    queue.close()
+    assert queue.rooms == {}
+
+
+def test_send_queue_skips_cancelled_messages(server):
+    posted, release = [], threading.Event()
+    server.route('/api/v1/chat.postMessage', post_message(posted, release))
+    queue = models.SendQueue(workers=1, coalesce=0)
+    first = queue.send('A', 'first')
+    cancelled = queue.send('A', 'cancelled')
+    last = queue.send('A', 'last')
+    assert cancelled.cancel()
+    release.set()
+    queue.join()
+    assert [text for _, text in posted] == ['first', 'last']
+    assert first.result().msg == 'first' and last.result().msg == 'last'
+    queue.close()
+    assert queue.rooms == {}
+
+
+def test_send_queue_join_waits_for_messages_being_sent(server):
+    posted, release = [], threading.Event()
+    server.route('/api/v1/chat.postMessage', post_message(posted, release))
+    queue = models.SendQueue(workers=2, coalesce=0)
+    sent = [queue.send('A', 'a'), queue.send('B', 'b')]
+    joined = threading.Thread(target=queue.join)
+    joined.start()
+    joined.join(0.2)
+    assert joined.is_alive()
+    release.set()
+    joined.join(5)
+    assert not joined.is_alive()
+    assert all(future.done() for future in sent)
+    assert sorted(text for _, text in posted) == ['a', 'b']
+    queue.close()
+
+
+def test_send_queue_fails_only_the_batch_that_failed(server):
+    posted = []
+    sent_ok = post_message(posted)
+
+    def handler(query, body):
+        if body['text'] == 'bad':
+            return 400, {'success': False, 'error': 'rejected'}
+        return sent_ok(query, body)
+
+    server.route('/api/v1/chat.postMessage', handler)
+    queue = models.SendQueue(workers=1, coalesce=0)
+    sent = [queue.send('A', text) for text in ('good', 'bad', 'better')]
+    queue.join()
+    assert sent[0].result().msg == 'good'
+    assert sent[1].exception() is not None
+    assert sent[2].result().msg == 'better'
+    queue.close()
+
+
+USERS = [{'_id': 'U{}'.format(i), 'username': 'user{}'.format(i),
+          'name': 'User {}'.format(i), 'email': 'user{}@example.com'.format(i)}
+         for i in range(3)]
+
+
+def project(record, fields):
+    if any(fields.values()):
+        return dict((k, v) for k, v in record.items() if k == '_id' or fields.get(k))
+    return dict((k, v) for k, v in record.items() if k not in fields)
+
+
+def user_routes(server):
+    server.route('/api/v1/users.list', lambda query, body: {
+        'success': True, 'total': len(USERS),
+        'users': [project(u, json.loads(query.get('fields', '{}'))) for u in USERS]})
+
+    def info(query, body):
+        user = next((u for u in USERS if u['_id'] == query.get('userId') or
+                     u['username'] == query.get('username')), None)
+        if user is None:
+            return 400, {'success': False, 'error': 'User not found.'}
+        return {'success': True, 'user': user}
+    server.route('/api/v1/users.info', info)
+
+
+def test_projection_of_included_fields():
+    projection = models.Projection(models.User, {'name': 1})
+    assert projection.loaded == set(['_id', 'name'])
+    user = projection._make({'_id': 'U0', 'name': 'User 0'})
+    assert dict(user.items()) == {'_id': 'U0', 'name': 'User 0', '_direct': None}
+
+
+def test_projection_of_excluded_fields():
+    projection = models.Projection(models.Channel, '{"usernames": 0}')
+    assert projection.loaded == set(models.Channel.__slots__) - set(['usernames'])
+    channel = projection._make({'_id': 'C0', 'name': 'general'})
+    assert 'usernames' not in dict(channel.items())
+    assert channel.name == 'general'
+
+
+def test_partial_user_loads_unset_fields_once(server):
+    user_routes(server)
+    user = next(models.User.iter_all(fields={'name': 1}))
+    repr(user)
+    assert server.calls['/api/v1/users.info'] == 0
+    assert user.email == 'user0@example.com'
+    assert user.username == 'user0'
+    assert server.calls['/api/v1/users.info'] == 1
+
+
+def test_partial_user_stays_partial_when_loading_fails(server):
+    user_routes(server)
+    user = next(models.User.iter_all(fields={'name': 1}))
+    server.route('/api/v1/users.info', lambda query, body: (
+        400, {'success': False, 'error': 'User not found.'}))
+    with pytest.raises(v1.RocketChatError):
+        user.email
+    user_routes(server)
+    assert user.email == 'user0@example.com'
+
+
+def test_partial_channel_loads_unset_fields(server):
+    server.route('/api/v1/channels.list', lambda query, body: {
+        'success': True, 'total': 1,
+        'channels': [{'_id': 'C0', 'name': 'general'}]})
+    server.route('/api/v1/channels.info', lambda query, body: {
+        'success': True, 'channel': {'_id': query['roomId'], 'name': 'general',
+                                     'usernames': ['user0', 'user1']}})
+    channel = next(models.Channel.iter_all(fields={'usernames': 0}))
+    assert server.calls['/api/v1/channels.info'] == 0
+    assert channel.usernames == ['user0', 'user1']
+    assert channel.name == 'general'
+    assert server.calls['/api/v1/channels.info'] == 1
+
+
+def direct_routes(server, rooms):
+    '''im.list of the rooms, and im.create answering as older servers, with rid'''
+    server.route('/api/v1/im.list', lambda query, body: {
+        'success': True, 'ims': rooms, 'total': len(rooms)})
+
+    def create(query, body):
+        if body['username'] == 'nobody':
+            return 400, {'success': False, 'error': 'Invalid user'}
+        return {'success': True, 'room': {
+            'rid': 'D-{}'.format(body['username']), 't': 'd',
+            'usernames': ['bot', body['username']]}}
+    server.route('/api/v1/im.create', create)
+
+
+def test_direct_index_lists_rooms_once(server):
+    direct_routes(server, [
+        {'_id': 'D-foo', 'usernames': ['bot', 'foo']},
+        {'_id': 'D-bar', 'usernames': ['bar', 'bot']},
+        {'_id': 'D-bot', 'usernames': ['bot']}])
+    index = models.DirectIndex()
+    assert index.get('foo')._id == 'D-foo'
+    assert index.get('bar')._id == 'D-bar'
+    assert index.get('bot')._id == 'D-bot'
+    assert index.get('baz') is None
+    assert server.calls['/api/v1/im.list'] == 1
+
+
+def test_direct_room_opened_with_rid_only(server):
+    direct_routes(server, [])
+    posted = []
+    server.route('/api/v1/chat.postMessage', post_message(posted))
+    models.User(_id='U1', username='foo').send('hello')
+    assert posted == [('D-foo', 'hello')]
+    room = models.direct_rooms.get('foo')
+    assert room._id == 'D-foo' and 'bot' not in models.direct_rooms
+    models.User(_id='U1', username='foo').send('again')
+    assert server.calls['/api/v1/im.create'] == 1
+    assert server.calls['/api/v1/im.list'] == 1
+
+
+def test_direct_index_warm_opens_missing_rooms(server):
+    direct_routes(server, [{'_id': 'D-foo', 'usernames': ['bot', 'foo']}])
+    index = models.DirectIndex()
+    rooms = index.warm(['foo', 'bar', 'baz', 'nobody'], max_workers=3)
+    assert dict((u, r._id) for u, r in rooms.items() if u != 'nobody') == {
+        'foo': 'D-foo', 'bar': 'D-bar', 'baz': 'D-baz'}
+    assert isinstance(rooms['nobody'], v1.RocketChatError)
+    assert server.calls['/api/v1/im.create'] == 3
+    assert index.get('bar')._id == 'D-bar'
+    assert 'nobody' not in index
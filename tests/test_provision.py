@@ -0,0 +1,62 @@
+from rocketchat.provision import Provisioner, parse_row
+
+
+EXISTING = {
+    '_id': 'U1',
+    'username': 'foo',
+    'name': 'Foo',
+    'emails': [{'address': 'foo@example.com', 'verified': True},
+               {'address': 'foo@example.org', 'verified': False}],
+    'roles': ['user', 'admin'],
+    'active': True,
+    'customFields': {'team': 'web', 'site': 'berlin'},
+}
+
+
+def test_unchanged_user_has_no_changes():
+    record = {'username': 'foo', 'name': 'Foo', 'email': 'foo@example.com',
+              'verified': True, 'roles': ['admin', 'user'], 'active': True,
+              'customFields': {'team': 'web'}, 'password': 'secret',
+              'sendWelcomeEmail': True}
+    assert Provisioner.changes(record, EXISTING) == {}
+
+
+def test_changed_fields():
+    record = {'username': 'foo', 'name': 'Foo Bar', 'roles': ['user'],
+              'active': False}
+    assert Provisioner.changes(record, EXISTING) == {
+        'name': 'Foo Bar', 'roles': ['user'], 'active': False}
+
+
+def test_verified_is_compared_with_the_email_of_the_record():
+    assert Provisioner.changes(
+        {'username': 'foo', 'email': 'foo@example.org', 'verified': False},
+        EXISTING) == {}
+    assert Provisioner.changes(
+        {'username': 'foo', 'email': 'foo@example.org', 'verified': True},
+        EXISTING) == {'verified': True}
+    # Without an email, with the first email of the user
+    assert Provisioner.changes(
+        {'username': 'foo', 'verified': True}, EXISTING) == {}
+
+
+def test_new_email_is_changed():
+    assert Provisioner.changes(
+        {'username': 'foo', 'email': 'foo@example.net', 'verified': True},
+        EXISTING) == {'email': 'foo@example.net', 'verified': True}
+
+
+def test_custom_fields_are_merged_with_those_of_the_user():
+    assert Provisioner.changes(
+        {'username': 'foo', 'customFields': {'team': 'api'}},
+        EXISTING) == {'customFields': {'team': 'api', 'site': 'berlin'}}
+    assert Provisioner.changes(
+        {'username': 'bar', 'customFields': {'team': 'api'}},
+        {'_id': 'U2', 'username': 'bar'}) == {'customFields': {'team': 'api'}}
+
+
+def test_parse_row():
+    assert parse_row({'username': 'foo', 'email': '', 'active': 'Yes',
+                      'roles': 'user, admin', 'customFields': '{"team": "web"}'}) == {
+        'username': 'foo', 'active': True, 'roles': ['user', 'admin'],
+        'customFields': {'team': 'web'}}
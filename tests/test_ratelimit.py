@@ -0,0 +1,109 @@
+import pytest
+
+from rocketchat import ratelimit
+
+
+class Clock(object):
+    '''Stands in for time.time and time.sleep'''
+
+    def __init__(self, now=1514764800.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ratelimit.time, 'time', clock.time)
+    monkeypatch.setattr(ratelimit.time, 'sleep', clock.sleep)
+    return clock
+
+
+def test_bucket_refills_at_its_rate():
+    bucket = ratelimit.Bucket(2)
+    bucket.updated = 0.0
+    assert [bucket.reserve(0.0) for _ in range(3)] == [0.0, 0.0, 0.5]
+    assert bucket.reserve(0.25) == 0.25
+    assert bucket.reserve(0.5) == 0.0
+    # Idle time refills no more than the capacity
+    assert [bucket.reserve(100.0) for _ in range(3)] == [0.0, 0.0, 0.5]
+
+
+def test_window_without_headers_is_unlimited():
+    window = ratelimit.Window()
+    assert all(window.reserve(0.0) == 0.0 for _ in range(100))
+
+
+def test_window_waits_for_the_reset():
+    window = ratelimit.Window()
+    window.update(0.0, limit=2, remaining=2, reset=10.0)
+    assert [window.reserve(1.0) for _ in range(3)] == [0.0, 0.0, 9.0]
+    assert window.reserve(10.0) == 0.0
+    assert window.remaining == 1
+
+
+def test_window_without_reset_waits_the_default_delay():
+    window = ratelimit.Window()
+    window.update(0.0, remaining=0)
+    assert window.reserve(0.0) == ratelimit.DEFAULT_DELAY
+    assert window.reserve(0.5) == ratelimit.DEFAULT_DELAY - 0.5
+    assert window.reserve(ratelimit.DEFAULT_DELAY) == 0.0
+
+
+def test_window_keeps_the_lowest_remaining_of_the_same_window():
+    window = ratelimit.Window()
+    window.update(0.0, limit=10, remaining=5, reset=10.0)
+    # Answered before requests sent since then
+    window.update(0.0, limit=10, remaining=8, reset=10.0)
+    assert window.remaining == 5
+    window.update(11.0, limit=10, remaining=9, reset=20.0)
+    assert window.remaining == 9
+
+
+def test_rejected_window_waits_retry_after():
+    window = ratelimit.Window()
+    window.update(0.0, rejected=True, retry_after=5)
+    assert window.reserve(1.0) == 4.0
+    window.update(6.0, rejected=True)
+    assert window.reserve(6.0) == ratelimit.DEFAULT_DELAY
+
+
+def test_rate_limiter_paces_each_endpoint(clock):
+    limiter = ratelimit.RateLimiter()
+    limiter.update('/api/v1/users.info', {
+        'X-RateLimit-Limit': '1', 'X-RateLimit-Remaining': '0',
+        'X-RateLimit-Reset': str(int((clock.now + 3) * 1000))}, 200)
+    assert limiter.reserve('/api/v1/users.info') == 3.0
+    assert limiter.reserve('/api/v1/users.list') == 0.0
+    limiter.wait('/api/v1/users.info')
+    assert clock.now == 1514764803.0 and limiter.waited == 3.0
+
+
+def test_rate_limiter_gives_back_requests_the_bucket_delayed(clock):
+    limiter = ratelimit.RateLimiter()
+    limiter.update('/api/v1/users.info', {
+        'X-RateLimit-Limit': '10', 'X-RateLimit-Remaining': '5'}, 200)
+    assert limiter.reserve('/api/v1/users.info', rate=1) == 0.0
+    assert limiter.reserve('/api/v1/users.info', rate=1) == 1.0
+    assert limiter.windows['/api/v1/users.info'].remaining == 4
+
+
+def test_rate_limiter_counts_rejections(clock):
+    limiter = ratelimit.RateLimiter()
+    limiter.update('/api/v1/users.info', {'Retry-After': '2'}, 429)
+    assert limiter.rejected == 1
+    assert limiter.reserve('/api/v1/users.info') == 2.0
+    limiter.clear()
+    assert limiter.reserve('/api/v1/users.info') == 0.0
+
+
+def test_parse_reset():
+    assert ratelimit.parse_reset('1514764800000') == 1514764800.0
+    assert ratelimit.parse_reset('1514764800') == 1514764800
+    assert ratelimit.parse_reset(None) is None
+    assert ratelimit.parse_reset('soon') is None
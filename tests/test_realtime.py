@@ -0,0 +1,128 @@
+import asyncio
+
+import pytest
+
+import rocketchat
+
+from rocketchat import aio, realtime, testing, v1
+
+pytest.importorskip('aiohttp')
+
+
+async def receive(messages, count, timeout=5):
+    received = []
+    while len(received) < count:
+        received.append(await asyncio.wait_for(messages.__anext__(), timeout))
+    return received
+
+
+async def reconnect(server, client, messages, posts, count):
+    '''Drops the connection, posts while disconnected, returns the messages read'''
+    server.expire_tokens()
+    await server.drop_connections()
+    while client.connected:
+        await asyncio.sleep(0.01)
+    for rid, text in posts:
+        server.post(rid, text)
+    return await receive(messages, count)
+
+
+async def closed(server):
+    while server.connections:
+        await asyncio.sleep(0.01)
+
+
+def run(test):
+    async def main():
+        server = testing.Server()
+        await server.start()
+        domain = v1.api.get_config('domain')
+        rocketchat.configure(domain=server.url)
+        client = realtime.Realtime(reconnect_delay=0.05)
+        try:
+            await test(server, client)
+        finally:
+            await client.close()
+            await aio.close()
+            await server.stop()
+            rocketchat.configure(domain=domain)
+    asyncio.run(main())
+
+
+def test_catch_up_after_reconnect():
+    async def test(server, client):
+        await client.subscribe_room('GENERAL')
+        messages = client.messages()
+        server.add_room('GENERAL', 'c')
+        await client.connect()
+        server.post('GENERAL', 'live')
+        live, = await receive(messages, 1)
+        missed = await reconnect(server, client, messages,
+                                 [('GENERAL', 'missed 1'), ('GENERAL', 'missed 2')], 2)
+        assert live.msg == 'live'
+        assert [m.msg for m in missed] == ['missed 1', 'missed 2']
+        assert set(m.channel_type for m in [live] + missed) == {'channels'}
+    run(test)
+
+
+def test_catch_up_of_rooms_of_all_types():
+    async def test(server, client):
+        await client.subscribe_room(None)
+        messages = client.messages()
+        server.add_room('DM', 'd')
+        server.add_room('PRIVATE', 'p')
+        await client.connect()
+        server.post('DM', 'live dm')
+        server.post('PRIVATE', 'live group')
+        live = await receive(messages, 2)
+        missed = await reconnect(server, client, messages,
+                                 [('DM', 'missed dm'), ('PRIVATE', 'missed group')], 2)
+        types = dict((m.msg, m.channel_type) for m in live + missed)
+        assert types == {'live dm': 'im', 'live group': 'groups',
+                         'missed dm': 'im', 'missed group': 'groups'}
+    run(test)
+
+
+def test_catch_up_continues_past_failing_rooms():
+    async def test(server, client):
+        await client.subscribe_room(None)
+        messages = client.messages()
+        server.add_room('GONE', 'p')
+        server.add_room('GENERAL', 'c')
+        await client.connect()
+        server.post('GONE', 'before')
+        server.post('GENERAL', 'before')
+        await receive(messages, 2)
+        # The room is deleted while the client is disconnected
+        del server.rooms['GONE']
+        missed = await reconnect(server, client, messages, [('GENERAL', 'missed')], 1)
+        assert [(m.rid, m.msg) for m in missed] == [('GENERAL', 'missed')]
+    run(test)
+
+
+def test_refused_subscription_leaves_the_client_disconnected():
+    async def test(server, client):
+        server.add_room('GENERAL', 'c')
+        await client.subscribe_room('GENERAL')
+        await client.connect()
+        server.refused.add('GENERAL')
+        await server.drop_connections()
+        while client.connected:
+            await asyncio.sleep(0.01)
+        with pytest.raises(realtime.RealtimeError):
+            await client.connect()
+        assert not client.connected
+        assert client.reader.done()
+        await asyncio.wait_for(closed(server), 5)
+
+        # Connects again once the subscription is allowed
+        server.refused.clear()
+        messages = client.messages()
+        receiving = asyncio.ensure_future(receive(messages, 1))
+        while not client.connected or not server.connections:
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.05)
+        server.post('GENERAL', 'back')
+        back, = await receiving
+        assert back.msg == 'back'
+    run(test)
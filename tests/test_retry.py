@@ -0,0 +1,92 @@
+import pytest
+import requests
+
+from urllib3.exceptions import MaxRetryError, NewConnectionError, ReadTimeoutError
+
+from rocketchat import retry, v1
+
+URL = 'http://chat.example.com/api/v1/{}'
+
+
+@pytest.fixture
+def policy(monkeypatch):
+    policy = retry.RetryPolicy(v1.api.get_config, v1.IDEMPOTENT_POSTS)
+    monkeypatch.setattr(v1.Session, 'retry_policy', policy)
+    return policy
+
+
+def failing(statuses, error=None):
+    '''Answers with each of the statuses in turn, or raises error for None'''
+    statuses = list(statuses)
+
+    def handler(query, body):
+        status = statuses.pop(0) if statuses else 200
+        if status is None:
+            raise error
+        return status, {'success': status == 200}
+    return handler
+
+
+def refused():
+    reason = NewConnectionError(None, 'Connection refused')
+    return requests.ConnectionError(MaxRetryError(None, URL, reason))
+
+
+def test_delay_backs_off_exponentially(monkeypatch):
+    config = {'RETRY_MAX': 3, 'RETRY_STATUSES': [503], 'RETRY_BACKOFF': 1,
+              'RETRY_BACKOFF_MAX': 3}
+    policy = retry.RetryPolicy(config.get)
+    monkeypatch.setattr(retry.random, 'uniform', lambda low, high: high)
+    assert [policy.delay('GET', '/api/v1/info', attempt, status_code=503)
+            for attempt in range(4)] == [1, 2, 3, None]
+    assert policy.delay('GET', '/api/v1/info', 0, status_code=200) is None
+    assert policy.delay('GET', '/api/v1/info', 0, status_code=500) is None
+    assert policy.stats == {'retries': 3, 'giveups': 1}
+
+
+def test_idempotent_posts_are_retried():
+    policy = retry.RetryPolicy(v1.api.get_config, ['im.create'])
+    assert policy.delay('POST', '/api/v1/im.create', 0, status_code=503) is not None
+    assert policy.delay('POST', '/api/v1/chat.postMessage', 0, status_code=503) is None
+    assert policy.stats == {'retries': 1, 'unsafe': 1}
+
+
+def test_get_is_retried_on_503(server, policy):
+    server.route('/api/v1/info', failing([503, 503]))
+    response = v1.api.session.request('GET', URL.format('info'))
+    assert response.status_code == 200
+    assert server.calls['/api/v1/info'] == 3
+    assert policy.stats == {'retries': 2}
+
+
+def test_post_is_not_retried_once_sent(server, policy):
+    timeout = requests.ReadTimeout(ReadTimeoutError(None, URL, 'timed out'))
+    server.route('/api/v1/chat.postMessage', failing([None], timeout))
+    with pytest.raises(requests.ReadTimeout):
+        v1.api.session.request('POST', URL.format('chat.postMessage'), json={})
+    server.route('/api/v1/chat.postMessage', failing([503]))
+    response = v1.api.session.request('POST', URL.format('chat.postMessage'), json={})
+    assert response.status_code == 503
+    assert server.calls['/api/v1/chat.postMessage'] == 2
+    assert policy.stats == {'unsafe': 2}
+
+
+def test_post_is_retried_when_the_connection_was_never_established(server, policy):
+    server.route('/api/v1/chat.postMessage', failing([None], refused()))
+    response = v1.api.session.request('POST', URL.format('chat.postMessage'), json={})
+    assert response.status_code == 200
+    assert server.calls['/api/v1/chat.postMessage'] == 2
+    assert policy.stats == {'retries': 1}
+    assert not v1.is_sent(requests.ConnectTimeout())
+
+
+def test_retries_give_up_at_retry_max(server, policy, monkeypatch):
+    monkeypatch.setitem(v1.api.config, 'RETRY_MAX', 2)
+    server.route('/api/v1/info', failing([503] * 10))
+    response = v1.api.session.request('GET', URL.format('info'))
+    assert response.status_code == 503
+    server.route('/api/v1/info', failing([None] * 10, refused()))
+    with pytest.raises(requests.ConnectionError):
+        v1.api.session.request('GET', URL.format('info'))
+    assert server.calls['/api/v1/info'] == 6
+    assert policy.stats == {'retries': 4, 'giveups': 2}
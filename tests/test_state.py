@@ -0,0 +1,108 @@
+import json
+import os
+
+import pytest
+
+from rocketchat import state, v1
+
+
+class Backend(object):
+    '''Keeps the changes of each save, failing the number of saves in ``fail``'''
+
+    def __init__(self, data=None):
+        self.data = data or {}
+        self.saves = []
+        self.fail = 0
+
+    def load(self, identifier):
+        return dict(self.data.get(identifier, {}))
+
+    def save(self, changes):
+        if self.fail:
+            self.fail -= 1
+            raise IOError('disk full')
+        self.saves.append(changes)
+
+
+@pytest.fixture(autouse=True)
+def home_dir(tmp_path, monkeypatch):
+    monkeypatch.setitem(v1.api.config, 'home_dir', str(tmp_path))
+    monkeypatch.setitem(v1.api.config, 'CACHE_FLUSH_INTERVAL', 60)
+    return tmp_path
+
+
+def test_changes_are_written_behind_together():
+    backend = Backend({'GENERAL': {'last_message_dt': '2018-01-01', 'old': 1}})
+    store = state.StateStore(backend)
+    assert store.get('GENERAL', 'last_message_dt') == '2018-01-01'
+    store.set('GENERAL', 'last_message_dt', '2018-01-02')
+    store.set('GENERAL', 'last_message_dt', '2018-01-03')
+    store.set('RANDOM', 'last_message_dt', '2018-01-04')
+    store.delete('GENERAL', 'old')
+    assert backend.saves == [] and store.timer is not None
+    assert store.get('GENERAL', 'last_message_dt') == '2018-01-03'
+    store.flush()
+    assert backend.saves == [{
+        'GENERAL': {'last_message_dt': '2018-01-03', 'old': state.DELETED},
+        'RANDOM': {'last_message_dt': '2018-01-04'}}]
+    assert store.timer is None
+    store.flush()
+    assert len(backend.saves) == 1
+
+
+def test_changes_are_written_at_once_without_flush_interval(monkeypatch):
+    monkeypatch.setitem(v1.api.config, 'CACHE_FLUSH_INTERVAL', 0)
+    backend = Backend()
+    store = state.StateStore(backend)
+    store.set('GENERAL', 'key', 'value')
+    assert backend.saves == [{'GENERAL': {'key': 'value'}}]
+
+
+def test_changes_are_kept_after_a_failed_flush():
+    backend = Backend()
+    store = state.StateStore(backend)
+    store.set('GENERAL', 'first', 1)
+    store.set('GENERAL', 'second', 1)
+    backend.fail = 1
+    with pytest.raises(IOError):
+        store.flush()
+    # Changed since the failed flush, the newer value is written
+    store.set('GENERAL', 'second', 2)
+    store.flush()
+    assert backend.saves == [{'GENERAL': {'first': 1, 'second': 2}}]
+
+
+@pytest.mark.parametrize('backend', [state.SQLiteBackend, state.JSONBackend])
+def test_backends_apply_changes(backend):
+    backend().save({'GENERAL': {'first': 1, 'second': {'nested': [2]}}})
+    backend().save({'GENERAL': {'first': state.DELETED, 'third': 3},
+                    'RANDOM': {'first': 4}})
+    assert backend().load('GENERAL') == {'second': {'nested': [2]}, 'third': 3}
+    assert backend().load('RANDOM') == {'first': 4}
+    assert backend().load('unknown') == {}
+
+
+def test_sqlite_falls_back_to_the_json_file():
+    with open(v1.api.cache_dir('GENERAL'), 'w') as fobj:
+        json.dump({'last_message_dt': '2018-01-01'}, fobj)
+    backend = state.SQLiteBackend()
+    assert backend.load('GENERAL') == {'last_message_dt': '2018-01-01'}
+    backend.save({'GENERAL': {'last_message_dt': '2018-01-02'}})
+    assert backend.load('GENERAL') == {'last_message_dt': '2018-01-02'}
+
+
+def test_json_file_is_replaced_only_once_written(monkeypatch):
+    backend = state.JSONBackend()
+    backend.save({'GENERAL': {'key': 'old'}})
+    fpath = v1.api.cache_dir('GENERAL')
+
+    def rename(src, dst):
+        raise OSError('interrupted')
+
+    with monkeypatch.context() as patched, pytest.raises(OSError):
+        patched.setattr(state.os, 'rename', rename)
+        backend.save({'GENERAL': {'key': 'new'}})
+    assert backend.load('GENERAL') == {'key': 'old'}
+    backend.save({'GENERAL': {'key': 'new'}})
+    assert backend.load('GENERAL') == {'key': 'new'}
+    assert not os.path.exists(fpath + '.tmp')
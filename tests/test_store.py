@@ -0,0 +1,61 @@
+import pytest
+
+from rocketchat import models, store
+
+
+@pytest.fixture(params=[True, False], ids=['fts', 'like'])
+def messages(request, tmp_path):
+    messages = store.MessageStore(path=str(tmp_path / 'messages.db'))
+    if not request.param:
+        messages.fts = False
+    messages.add(models.Message(
+        _id='M{}'.format(i), rid=rid, ts='2018-01-01T00:00:{:02d}.000Z'.format(i),
+        u={'_id': 'U1', 'username': username}, msg=msg)
+        for i, (rid, username, msg) in enumerate([
+            ('GENERAL', 'foo', 'deploy failed on web'),
+            ('GENERAL', 'bar', 'deploy done'),
+            ('RANDOM', 'foo', 'the deploy failed again'),
+            ('GENERAL', 'foo', 'NOT "quoted" AND* (syntax)'),
+            ('GENERAL', 'bar', '100% of_the builds'),
+        ]))
+    yield messages
+    messages.close()
+
+
+def search(messages, text, **kwargs):
+    return [m._id for m in messages.search(text, **kwargs)]
+
+
+def test_search_matches_all_words_newest_first(messages):
+    assert search(messages, 'deploy failed') == ['M2', 'M0']
+    assert search(messages, 'deploy') == ['M2', 'M1', 'M0']
+
+
+def test_search_filters(messages):
+    assert search(messages, 'deploy', room='GENERAL') == ['M1', 'M0']
+    assert search(messages, 'deploy', username='bar') == ['M1']
+    assert search(messages, 'deploy', since='2018-01-01T00:00:01.000Z') == ['M2', 'M1']
+
+
+@pytest.mark.parametrize('text', ['', '   ', None])
+def test_search_of_no_words_finds_nothing(messages, text):
+    assert messages.search(text) == []
+
+
+def test_search_quotes_query_syntax(messages):
+    assert search(messages, 'NOT "quoted" AND*') == ['M3']
+    assert search(messages, '(syntax)') == ['M3']
+
+
+def test_search_wildcards_are_literal(messages):
+    assert search(messages, '100% of_the') == ['M4']
+    assert search(messages, '1_0') == []
+    assert store.to_like_pattern('100%') == '%100\\%%'
+    assert store.to_like_pattern('of_the') == '%of\\_the%'
+
+
+def test_search_by_room_name(messages, server):
+    server.route('/api/v1/channels.history', lambda query, body: {
+        'success': True, 'messages': []})
+    messages.sync(models.Channel(_id='RANDOM', name='random'))
+    assert search(messages, 'deploy', room='random') == ['M2']
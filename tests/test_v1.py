@@ -0,0 +1,135 @@
+import json
+import threading
+import time
+
+import pytest
+
+from rocketchat import models, v1
+
+
+def users(count, total=True, offsets=True):
+    listed = [{'_id': 'U{}'.format(i), 'username': 'user{}'.format(i)}
+              for i in range(count)]
+
+    def handler(query, body):
+        offset = int(query['offset']) if offsets else 0
+        data = {'success': True,
+                'users': listed[offset:offset + int(query['count'])]}
+        if total:
+            data['total'] = len(listed)
+        return data
+    return handler
+
+
+@pytest.mark.parametrize('prefetch', [False, True])
+def test_paginate_stops_at_the_total(server, prefetch):
+    server.route('/api/v1/users.list', users(250))
+    listed = list(v1.paginate(v1.users_list(models.User), count=100, prefetch=prefetch))
+    assert [user.username for user in listed] == ['user{}'.format(i) for i in range(250)]
+    assert server.calls['/api/v1/users.list'] == 3
+
+
+def test_paginate_without_total_stops_at_an_empty_page(server):
+    server.route('/api/v1/users.list', users(250, total=False))
+    assert len(list(v1.paginate(v1.users_list(models.User), count=100))) == 250
+    assert server.calls['/api/v1/users.list'] == 4
+
+
+def test_paginate_stops_when_the_server_ignores_offset(server):
+    server.route('/api/v1/users.list', users(50, offsets=False))
+    assert len(list(v1.paginate(v1.users_list(models.User), count=100))) == 50
+    assert server.calls['/api/v1/users.list'] == 1
+
+
+def token_routes(server, delay=0):
+    '''login issuing a new token each time, users.info accepting only the last'''
+    tokens = []
+
+    def login(query, body):
+        time.sleep(delay)
+        tokens.append('token{}'.format(len(tokens) + 1))
+        return {'status': 'success', 'data': {'authToken': tokens[-1], 'userId': 'U0'}}
+
+    def info(query, body):
+        if server.local.headers['X-Auth-Token'] != tokens[-1]:
+            return 401, {'status': 'error', 'message': 'You must be logged in to do this.'}
+        return {'success': True, 'user': {'_id': query['userId'], 'username': 'foo'}}
+
+    server.route('/api/v1/login', login)
+    server.route('/api/v1/users.info', info)
+    return tokens
+
+
+def fetch_concurrently(threads):
+    fetched = []
+    workers = [threading.Thread(target=lambda: fetched.append(
+        models.User(_id='U1')(params={'userId': 'U1'}).get()))
+        for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(5)
+    return fetched
+
+
+def test_threads_log_in_once(server):
+    tokens = token_routes(server, delay=0.1)
+    assert len(fetch_concurrently(8)) == 8
+    assert tokens == ['token1'] and server.calls['/api/v1/login'] == 1
+
+
+def test_expired_token_is_replaced_and_the_request_replayed(server):
+    tokens = token_routes(server)
+    v1.Token.authenticate()
+    tokens.append('token2')
+    user = models.User(_id='U1')(params={'userId': 'U1'}).get()
+    assert user.username == 'foo'
+    assert v1.Token.token.authToken == 'token3'
+    assert server.calls['/api/v1/login'] == 2
+    assert server.calls['/api/v1/users.info'] == 2
+
+
+def test_expired_token_already_replaced_is_not_replaced_again(server):
+    tokens = token_routes(server)
+    v1.Token.authenticate()
+    tokens.append('token2')
+    rejected = threading.Barrier(4)
+    info = server.handlers['/api/v1/users.info']
+
+    def handler(query, body):
+        if server.local.headers['X-Auth-Token'] == 'token1':
+            # All threads are rejected before any logs in again
+            rejected.wait(5)
+        return info(query, body)
+
+    server.route('/api/v1/users.info', handler)
+    assert len(fetch_concurrently(4)) == 4
+    assert tokens == ['token1', 'token2', 'token3']
+    assert server.calls['/api/v1/users.info'] == 8
+
+
+def test_token_rejected_again_is_not_replaced_in_a_loop(server):
+    token_routes(server)
+    server.route('/api/v1/users.info', lambda query, body: (
+        401, {'status': 'error', 'message': 'You must be logged in to do this.'}))
+    with pytest.raises(v1.RocketChatError):
+        models.User(_id='U1')(params={'userId': 'U1'}).get()
+    assert server.calls['/api/v1/login'] == 2
+    assert server.calls['/api/v1/users.info'] == 2
+
+
+def test_paginate_all_direct_rooms_with_fields(server):
+    rooms = [{'_id': 'D{}'.format(i), 'usernames': ['bot', 'user{}'.format(i)]}
+             for i in range(5)]
+
+    def everyone(query, body):
+        assert json.loads(query['fields']) == {'usernames': 1}
+        offset, count = int(query['offset']), int(query['count'])
+        return {'success': True, 'ims': rooms[offset:offset + count],
+                'total': len(rooms)}
+
+    server.route('/api/v1/im.list.everyone', everyone)
+    listed = list(v1.paginate(v1.channels_private_rooms(
+        models.Direct, params={'fields': {'usernames': 1}}), count=2))
+    assert [room._id for room in listed] == ['D0', 'D1', 'D2', 'D3', 'D4']
+    assert server.calls['/api/v1/im.list.everyone'] == 3